@@ -0,0 +1,370 @@
+"""
+Filename: Benchmark NY Bus Loader.py
+Author: Meet Gandhi, Hrishit Kotadia, Prabhav Karve
+ID: mg1905, hjk5029, pk6004
+
+This code benchmarks Load NY Bus Dataset.py end to end on datasets made by Generate NY Bus Dataset.py.
+Every combination of scale factor and loader mode is loaded into an emptied database in its own process,
+so the memory of one run does not show up in the next.
+
+For every run it records:
+1. The rows and rows/sec of each table
+2. The total wall time and rows/sec of the load
+3. The peak resident memory of the loader and of its worker processes, 0 where it cannot be measured (Windows)
+4. The WAL bytes the load generated
+
+Steps to take before running this code:
+1. Enter your database connection details in pipeline.ini (see pipeline_db.py)
+2. Enter the scale factors and modes to benchmark in the fields given in the code below
+3. Run the code, the benchmark drops and recreates the tables of the loader
+
+The results are written to BENCHMARK_REPORT as JSON and as CSV, and compared against BENCHMARK_BASELINE.
+A run that is more than REGRESSION_TOLERANCE slower than the baseline is reported and makes the code
+exit with status 1, so a load-time regression fails the benchmark instead of going unnoticed.
+"""
+import csv
+import importlib.util
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import pipeline_db
+
+# Benchmark settings
+# Scale factors of the generated datasets
+BENCHMARK_SCALE_FACTORS = [0.1, 1.0]
+# Loader modes, "statement", "row", "batch" and "copy" load the tables one after another, "parallel" uses COPY
+# in worker processes. "statement" is the unprepared per-row INSERT of the original loader, "row" prepares it
+BENCHMARK_MODES = ["statement", "row", "batch", "copy", "parallel"]
+# Directory the datasets are generated into, one subdirectory per scale factor
+BENCHMARK_DATA_DIRECTORY = "benchmark_data"
+# Report of the runs, written as .json and .csv
+BENCHMARK_REPORT = "load_benchmark"
+# Report the runs are compared against, None to skip the comparison
+BENCHMARK_BASELINE = "load_benchmark_baseline.json"
+# Store the report of this benchmark as the new baseline
+SAVE_AS_BASELINE = False
+# A run whose rows/sec falls more than this fraction below the baseline is a regression
+REGRESSION_TOLERANCE = 0.10
+
+# The scripts this code runs, next to this file
+CODE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+LOADER_FILE = os.path.join(CODE_DIRECTORY, "Load NY Bus Dataset.py")
+GENERATOR_FILE = os.path.join(CODE_DIRECTORY, "Generate NY Bus Dataset.py")
+
+
+def load_module(filename, module_name):
+    """
+    Import one of the scripts, whose file names are not valid module names
+    :param filename: Path of the script
+    :param module_name: Name to give the module
+    :return: The imported module
+    """
+    spec = importlib.util.spec_from_file_location(module_name, filename)
+    module = importlib.util.module_from_spec(spec)
+    # The parallel load pickles functions of the module for its worker processes, which look it up by name
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def can_fork() -> bool:
+    """
+    Check if worker processes can be forked. The loader is imported under a made-up module name,
+    which the workers of the parallel mode only find when they are forked from this process.
+    :return: True if the fork start method exists on this platform
+    """
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def get_peak_memory() -> tuple:
+    """
+    Get the peak resident memory of this process and of its finished child processes
+    :return: Tuple of the two peaks in bytes, zeros where the resource module is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0, 0
+
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    unit = 1 if sys.platform == "darwin" else 1024
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def get_data_directory(scale_factor) -> str:
+    """
+    Get the directory with the dataset of a scale factor, generating the dataset the first time
+    :param scale_factor: The scale factor
+    :return: Path of the directory
+    """
+    data_directory = os.path.abspath(os.path.join(BENCHMARK_DATA_DIRECTORY, f"sf_{scale_factor}"))
+
+    if not os.path.exists(os.path.join(data_directory, "real_time_data_temp.text")):
+        generator = load_module(GENERATOR_FILE, "generate_ny_bus_dataset")
+        generator.OUTPUT_DIRECTORY = data_directory
+        generator.generate_dataset(scale_factor)
+
+    return data_directory
+
+
+def reset_database(loader) -> None:
+    """
+    Drop everything an earlier run of the loader created, so every run starts from an empty database
+    :param loader: The loader module
+    :return: None
+    """
+    table_names = list(loader.TABLE_DEFINITIONS)
+    table_names += [f"{entity}_keys" for entity in sorted(set(loader.IDENTIFIER_COLUMNS.values()))]
+    table_names += [loader.CHECKPOINT_TABLE, loader.WATERMARK_TABLE]
+
+    conn = pipeline_db.connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        # CASCADE also drops the time views
+        cur.execute(f"DROP TABLE IF EXISTS {', '.join(table_names)} CASCADE")
+        conn.commit()
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def get_wal_lsn():
+    """
+    Get the current write-ahead log position of the server
+    :return: The WAL position
+    """
+    conn = pipeline_db.connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT pg_current_wal_lsn()")
+        return cur.fetchone()[0]
+
+    finally:
+        cur.close()
+        conn.close()
+
+
+def get_wal_bytes(start_lsn, end_lsn) -> int:
+    """
+    Get the number of WAL bytes written between two WAL positions
+    :param start_lsn: The WAL position before the load
+    :param end_lsn: The WAL position after the load
+    :return: The number of bytes
+    """
+    conn = pipeline_db.connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT pg_wal_lsn_diff(%s, %s)::bigint", (end_lsn, start_lsn))
+        return cur.fetchone()[0]
+
+    finally:
+        cur.close()
+        conn.close()
+
+
+def run_load(scale_factor, mode) -> dict:
+    """
+    Create the tables and load the dataset of a scale factor with one loader mode, in this process.
+    The load goes through create_table_load_data, the same path the loader runs, with the other
+    loader settings as they are in Load NY Bus Dataset.py
+    :param scale_factor: The scale factor
+    :param mode: "statement", "row", "batch", "copy" or "parallel"
+    :return: Dictionary with the measurements of the run
+    """
+    loader = load_module(LOADER_FILE, "load_ny_bus_dataset")
+    os.chdir(get_data_directory(scale_factor))
+    reset_database(loader)
+
+    if mode == "parallel":
+        # The workers must be forked, the default on macOS and on Python 3.14 and later is to spawn them
+        multiprocessing.set_start_method("fork", force=True)
+        loader.LOAD_MODE = "copy"
+        loader.PARALLEL_LOAD = True
+    else:
+        loader.LOAD_MODE = mode
+        loader.PARALLEL_LOAD = False
+
+    start_lsn = get_wal_lsn()
+    start_time = time.time()
+
+    timings = {}
+    loaded_rows = loader.create_table_load_data(timings)
+
+    wall_time = time.time() - start_time
+    wal_bytes = get_wal_bytes(start_lsn, get_wal_lsn())
+
+    # The parallel workers are children of this process
+    peak_rss, peak_worker_rss = get_peak_memory()
+
+    total_rows = sum(loaded_rows.values())
+    tables = {table_name: {"rows": rows,
+                           "seconds": round(timings.get(table_name, 0), 3),
+                           "rows_per_sec": round(rows / timings[table_name]) if timings.get(table_name) else 0}
+              for table_name, rows in loaded_rows.items()}
+
+    return {
+        "scale_factor": scale_factor,
+        "mode": mode,
+        "succeeded": bool(loaded_rows),
+        "total_rows": total_rows,
+        "wall_time": round(wall_time, 3),
+        "rows_per_sec": round(total_rows / wall_time) if wall_time else 0,
+        "peak_rss_mb": round(peak_rss / (1 << 20), 1),
+        "peak_worker_rss_mb": round(peak_worker_rss / (1 << 20), 1),
+        "wal_bytes": wal_bytes,
+        "tables": tables,
+    }
+
+
+def run_load_in_process(scale_factor, mode) -> dict:
+    """
+    Run one load in a new process of this code, so its peak memory is measured on its own
+    :param scale_factor: The scale factor
+    :param mode: "statement", "row", "batch", "copy" or "parallel"
+    :return: Dictionary with the measurements of the run
+    """
+    print("\n======================================================\n")
+    print(f"Benchmarking the {mode} load at scale factor {scale_factor}...")
+
+    handle, result_file = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), str(scale_factor), mode, result_file],
+                       check=True, cwd=os.getcwd())
+        with open(result_file) as file:
+            result = json.load(file)
+
+    except subprocess.CalledProcessError as e:
+        print(f"Error occurred: {e}")
+        result = {"scale_factor": scale_factor, "mode": mode, "succeeded": False, "total_rows": 0,
+                  "wall_time": 0, "rows_per_sec": 0, "peak_rss_mb": 0, "peak_worker_rss_mb": 0,
+                  "wal_bytes": 0, "tables": {}}
+
+    finally:
+        os.remove(result_file)
+
+    print(f"\nLoaded {result['total_rows']} rows in {result['wall_time']} seconds "
+          f"({result['rows_per_sec']} rows/sec), peak memory {result['peak_rss_mb']} MB, "
+          f"{result['wal_bytes']} WAL bytes")
+
+    return result
+
+
+def write_report(results, report=BENCHMARK_REPORT) -> None:
+    """
+    Write the results as JSON, and as CSV with one line per table and one total line per run
+    :param results: List of the measurements of each run
+    :param report: Name of the report files, without the extension
+    :return: None
+    """
+    with open(report + ".json", "w") as file:
+        json.dump(results, file, indent=2)
+
+    with open(report + ".csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["scale_factor", "mode", "table", "rows", "seconds", "rows_per_sec",
+                         "peak_rss_mb", "peak_worker_rss_mb", "wal_bytes"])
+        for result in results:
+            for table_name, table in sorted(result["tables"].items()):
+                writer.writerow([result["scale_factor"], result["mode"], table_name, table["rows"],
+                                 table["seconds"], table["rows_per_sec"], "", "", ""])
+            writer.writerow([result["scale_factor"], result["mode"], "total", result["total_rows"],
+                             result["wall_time"], result["rows_per_sec"], result["peak_rss_mb"],
+                             result["peak_worker_rss_mb"], result["wal_bytes"]])
+
+    print(f"\nReport written to {report}.json and {report}.csv")
+
+    return None
+
+
+def compare_with_baseline(results, baseline_file=BENCHMARK_BASELINE, tolerance=REGRESSION_TOLERANCE) -> list:
+    """
+    Compare the rows/sec of every run with the same scale factor and mode in the baseline
+    :param results: List of the measurements of each run
+    :param baseline_file: Name of the baseline report
+    :param tolerance: Fraction of the baseline rows/sec a run may lose before it is a regression
+    :return: List of the (scale factor, mode) runs that regressed
+    """
+    print("\n======================================================\n")
+    if not baseline_file or not os.path.exists(baseline_file):
+        print("No baseline to compare with.")
+        return []
+
+    with open(baseline_file) as file:
+        baseline = {(run["scale_factor"], run["mode"]): run for run in json.load(file)}
+
+    regressions = []
+    for result in results:
+        key = (result["scale_factor"], result["mode"])
+        if key not in baseline or not baseline[key]["rows_per_sec"]:
+            print(f"Scale factor {key[0]}, {key[1]} load: not in the baseline")
+            continue
+
+        change = result["rows_per_sec"] / baseline[key]["rows_per_sec"] - 1
+        regressed = not result["succeeded"] or change < -tolerance
+        print(f"Scale factor {key[0]}, {key[1]} load: {result['rows_per_sec']} rows/sec, "
+              f"{change:+.1%} against the baseline{' REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+
+    return regressions
+
+
+def main() -> None:
+    """
+    Main function of the code that calls the required functions in order.
+    :return: None
+    """
+
+    # A run started by run_load_in_process, with the scale factor, mode and result file as arguments
+    if len(sys.argv) == 4:
+        result = run_load(float(sys.argv[1]), sys.argv[2])
+        with open(sys.argv[3], "w") as file:
+            json.dump(result, file)
+        return None
+
+    start_time = time.time()
+
+    # Generate the datasets first, so the generator does not add to the memory of the first run
+    for scale_factor in BENCHMARK_SCALE_FACTORS:
+        get_data_directory(float(scale_factor))
+
+    modes = BENCHMARK_MODES
+    if "parallel" in modes and not can_fork():
+        print("\nWorker processes cannot be forked on this platform, skipping the parallel mode.")
+        modes = [mode for mode in modes if mode != "parallel"]
+
+    results = [run_load_in_process(scale_factor, mode)
+               for scale_factor in BENCHMARK_SCALE_FACTORS for mode in modes]
+
+    write_report(results)
+    regressions = compare_with_baseline(results)
+
+    if SAVE_AS_BASELINE:
+        write_report(results, os.path.splitext(BENCHMARK_BASELINE)[0])
+
+    print("\n======================================================\n")
+    print(f"Benchmark finished in {time.time() - start_time:.2f} seconds.")
+
+    if regressions:
+        sys.exit(1)
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
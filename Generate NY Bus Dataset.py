@@ -0,0 +1,457 @@
+"""
+Filename: Generate NY Bus Dataset.py
+Author: Meet Gandhi, Hrishit Kotadia, Prabhav Karve
+ID: mg1905, hjk5029, pk6004
+
+This code generates a synthetic NY Bus dataset in the same tab-separated format as the text files that
+Load NY Bus Dataset.py loads, so the load, the queries and the mining can be benchmarked on any machine.
+The output is deterministic: the same scale factor and seed always give the same files.
+
+The data follows the shape of the real dataset:
+1. A few routes, stops and trips carry most of the traffic (Zipf skew)
+2. Late night trips run past 24:00:00 on the service day they started on
+3. Real-time observations are concentrated in the rush hours
+4. Every trip, shape, stop and service a row refers to exists in its own table
+
+Steps to take before running this code:
+1. Enter the scale factor, seed and output directory in the fields given in the code below
+2. Run the code
+3. Run Load NY Bus Dataset.py in the output directory
+
+A scale factor of 1 gives about 1.3 million rows, the real dataset is close to a scale factor of 25.
+"""
+import datetime
+import math
+import os
+import random
+import time
+
+# Generator settings
+# Size of the dataset, the rows of the large tables grow linearly with it
+SCALE_FACTOR = 1.0
+# Seed of the random numbers, every table gets its own generator derived from it
+RANDOM_SEED = 2014
+# Directory the .text files are written to
+OUTPUT_DIRECTORY = "."
+
+# Rows of the large tables at a scale factor of 1
+BASE_TRIPS = 20000
+BASE_REAL_TIME_ROWS = 400000
+# Routes, stops and services grow with the square root of the scale factor, like a bigger city would
+BASE_ROUTES = 300
+BASE_STOPS = 15000
+BASE_SERVICES = 60
+# Skew of the route, stop and vehicle popularity, 0 for uniform
+ZIPF_SKEW = 1.1
+# Number of stops on a trip
+MIN_TRIP_STOPS = 15
+MAX_TRIP_STOPS = 60
+# Number of points of a shape
+MIN_SHAPE_POINTS = 80
+MAX_SHAPE_POINTS = 400
+# Days of real-time observations, starting on REAL_TIME_START
+REAL_TIME_DAYS = 31
+REAL_TIME_START = datetime.datetime(2014, 8, 1)
+# Offset of the New York time zone in August
+UTC_OFFSET = "-04"
+
+# Area of New York City the coordinates are drawn from
+MIN_LAT, MAX_LAT = 40.50, 40.91
+MIN_LON, MAX_LON = -74.25, -73.70
+
+# Agencies as (agency_id, agency_name), each route belongs to one of them
+AGENCIES = [
+    ("MTA NYCT", "MTA New York City Transit"),
+    ("MTABC", "MTA Bus Company"),
+]
+
+# Route prefixes of each borough and their share of the routes
+ROUTE_PREFIXES = [("B", 0.3), ("BX", 0.2), ("M", 0.2), ("Q", 0.2), ("S", 0.05), ("X", 0.05)]
+
+# Relative number of trips starting and observations recorded in each hour of the day
+HOUR_WEIGHTS = [1, 1, 1, 1, 2, 4, 8, 12, 12, 9, 7, 7, 7, 7, 8, 10, 12, 12, 9, 6, 4, 3, 2, 1]
+
+# Service day types and their share of the services
+SERVICE_TYPES = [("Weekday", 0.6), ("Saturday", 0.2), ("Sunday", 0.2)]
+
+# Street names for the stop names
+STREETS = ["BROADWAY", "AMSTERDAM AV", "LEXINGTON AV", "FLATBUSH AV", "FORDHAM RD", "JAMAICA AV",
+           "MAIN ST", "RICHMOND AV", "NOSTRAND AV", "GRAND CONCOURSE", "NORTHERN BLVD", "KINGS HWY",
+           "HYLAN BLVD", "QUEENS BLVD", "ATLANTIC AV", "3 AV", "5 AV", "MADISON AV", "W 34 ST", "E 86 ST"]
+
+
+def get_random(table_name) -> random.Random:
+    """
+    Get the random number generator of a table, so every table is reproducible on its own
+    :param table_name: Name of the table
+    :return: Random number generator seeded from RANDOM_SEED and the table name
+    """
+    return random.Random(f"{RANDOM_SEED}-{table_name}")
+
+
+def scaled(base, scale_factor, sublinear=False) -> int:
+    """
+    Get the number of rows of a table at a scale factor
+    :param base: The number of rows at a scale factor of 1
+    :param scale_factor: The scale factor
+    :param sublinear: Grow with the square root of the scale factor
+    :return: The number of rows, at least 1
+    """
+    return max(1, round(base * (math.sqrt(scale_factor) if sublinear else scale_factor)))
+
+
+def get_zipf_weights(count, skew=ZIPF_SKEW) -> list:
+    """
+    Get Zipf weights, the first item is the most popular
+    :param count: The number of items
+    :param skew: The Zipf exponent
+    :return: List of the cumulative weights of the items, for random.choices
+    """
+    cumulative_weights = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** skew
+        cumulative_weights.append(total)
+
+    return cumulative_weights
+
+
+def format_time(seconds) -> str:
+    """
+    Format a number of seconds since the start of the service day as a GTFS time, which can go past 24:00:00
+    :param seconds: The number of seconds
+    :return: The time, for example '25:03:10.000000'
+    """
+    hours, remaining_seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(remaining_seconds, 60)
+
+    return f"{hours:02}:{minutes:02}:{seconds:02}.000000"
+
+
+def format_timestamp(timestamp) -> str:
+    """
+    Format a timestamp like the real-time data files do
+    :param timestamp: The datetime, in New York time
+    :return: The timestamp, for example '2014-08-01 04:00:01-04'
+    """
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S") + UTC_OFFSET
+
+
+def random_coordinates(rng) -> tuple:
+    """
+    Get a random point in New York City
+    :param rng: Random number generator
+    :return: Tuple containing the latitude and the longitude
+    """
+    return round(rng.uniform(MIN_LAT, MAX_LAT), 6), round(rng.uniform(MIN_LON, MAX_LON), 6)
+
+
+def write_table(table_name, rows) -> int:
+    """
+    Write the rows of a table to its data file, with NULL for missing values
+    :param table_name: Name of the table, the data file is named after it
+    :param rows: Iterable of the rows, each a list of values
+    :return: The number of rows written
+    """
+    start_time = time.time()
+    count = 0
+    filename = os.path.join(OUTPUT_DIRECTORY, f"{table_name}.text")
+
+    with open(filename, "w", newline="\n") as file:
+        for row in rows:
+            file.write('\t'.join('NULL' if value is None else str(value) for value in row) + '\n')
+            count += 1
+
+    print(f"Wrote {count} rows to {filename} in {time.time() - start_time:.2f} seconds.")
+
+    return count
+
+
+def generate_agencies() -> list:
+    """
+    Generate the agency table
+    :return: List of the agency rows
+    """
+    return [[agency_id, agency_name, "http://www.mta.info", "America/New_York", "en", "718-330-1234"]
+            for agency_id, agency_name in AGENCIES]
+
+
+def generate_routes(rng, count) -> list:
+    """
+    Generate the routes table. generate_trips makes a route busier the earlier it is in the list, so the
+    routes are shuffled for the busiest ones not to always be the lowest numbered ones.
+    :param rng: Random number generator
+    :param count: The number of routes
+    :return: List of the route rows
+    """
+    prefixes = [prefix for prefix, _ in ROUTE_PREFIXES]
+    shares = [share for _, share in ROUTE_PREFIXES]
+    numbers = {prefix: 0 for prefix in prefixes}
+
+    routes = []
+    for _ in range(count):
+        prefix = rng.choices(prefixes, shares)[0]
+        numbers[prefix] += 1
+        route_id = f"{prefix}{numbers[prefix]}"
+        agency_id = AGENCIES[0][0] if prefix in ("B", "M", "BX", "S") else AGENCIES[1][0]
+        first_street, last_street = rng.sample(STREETS, 2)
+        routes.append([route_id, agency_id, route_id, f"{first_street} - {last_street}", None, 3,
+                       f"{rng.randrange(1 << 24):06X}", "FFFFFF"])
+
+    rng.shuffle(routes)
+
+    return routes
+
+
+def generate_calendar(rng, count) -> tuple:
+    """
+    Generate the calendar and calendar_dates tables
+    :param rng: Random number generator
+    :param count: The number of services
+    :return: Tuple containing the calendar rows and the calendar_dates rows
+    """
+    names = [name for name, _ in SERVICE_TYPES]
+    weights = [weight for _, weight in SERVICE_TYPES]
+    start_date = REAL_TIME_START.date() - datetime.timedelta(days=30)
+    end_date = REAL_TIME_START.date() + datetime.timedelta(days=REAL_TIME_DAYS + 30)
+
+    calendar = []
+    calendar_dates = []
+    for i in range(count):
+        service_type = rng.choices(names, weights)[0]
+        service_id = f"D{i // 4 + 1:02}_{'ABCD'[i % 4]}4-{service_type}"
+        days = [service_type == "Weekday"] * 5 + [service_type == "Saturday", service_type == "Sunday"]
+        calendar.append([service_id] + [int(day) for day in days] + [start_date, end_date])
+
+        # Holidays and detours remove or add the service on a few dates
+        for date in sorted(rng.sample(range((end_date - start_date).days), rng.randint(0, 4))):
+            calendar_dates.append([service_id, start_date + datetime.timedelta(days=date), rng.choice((1, 2))])
+
+    return calendar, calendar_dates
+
+
+def generate_stops(rng, count) -> list:
+    """
+    Generate the stops table. The stop ids are numbers, like in the real dataset.
+    :param rng: Random number generator
+    :param count: The number of stops
+    :return: List of the stop rows
+    """
+    stops = []
+    for i in range(count):
+        lat, lon = random_coordinates(rng)
+        first_street, second_street = rng.sample(STREETS, 2)
+        stops.append([str(100000 + i), f"{first_street}/{second_street}", None, lat, lon, None, None, 0, None])
+
+    return stops
+
+
+def generate_shapes(rng, routes) -> tuple:
+    """
+    Generate two shapes, one for each direction, for every route
+    :param rng: Random number generator
+    :param routes: List of the route rows
+    :return: Tuple containing the list of shape rows and the dictionary of the shape ids of each route
+    """
+    shapes = []
+    route_shapes = {}
+    for route in routes:
+        route_id = route[0]
+        route_shapes[route_id] = []
+        for direction in range(2):
+            shape_id = f"{route_id}_{direction}"
+            route_shapes[route_id].append(shape_id)
+
+            # A random walk through the city
+            lat, lon = random_coordinates(rng)
+            for sequence in range(1, rng.randint(MIN_SHAPE_POINTS, MAX_SHAPE_POINTS) + 1):
+                lat = min(MAX_LAT, max(MIN_LAT, lat + rng.gauss(0, 0.001)))
+                lon = min(MAX_LON, max(MIN_LON, lon + rng.gauss(0, 0.001)))
+                shapes.append([shape_id, round(lat, 6), round(lon, 6), sequence])
+
+    return shapes, route_shapes
+
+
+def generate_trips(rng, routes, services, route_shapes, stops, count) -> tuple:
+    """
+    Generate the trips table and the stop pattern of every route. Busy routes get most of the trips,
+    and the busy stops are on many routes.
+    :param rng: Random number generator
+    :param routes: List of the route rows, the busiest first
+    :param services: List of the calendar rows
+    :param route_shapes: Dictionary of the shape ids of each route
+    :param stops: List of the stop rows
+    :param count: The number of trips
+    :return: Tuple containing the list of trip rows and the dictionary of the stop pattern of each route
+    """
+    stop_weights = get_zipf_weights(len(stops))
+    route_weights = get_zipf_weights(len(routes))
+
+    patterns = {}
+    for route in routes:
+        pattern_length = min(len(stops), rng.randint(MIN_TRIP_STOPS, MAX_TRIP_STOPS))
+        pattern = []
+        while len(pattern) < pattern_length:
+            stop_id = rng.choices(stops, cum_weights=stop_weights)[0][0]
+            if stop_id not in pattern:
+                pattern.append(stop_id)
+        patterns[route[0]] = pattern
+
+    trips = []
+    for i, route in enumerate(rng.choices(routes, cum_weights=route_weights, k=count)):
+        route_id = route[0]
+        service_id = rng.choice(services)[0]
+        direction = rng.randrange(2)
+        trips.append([route_id, service_id, f"{service_id}-{i:06}_{route_id}_{direction}",
+                      route[3].split(" - ")[direction], str(direction), route_shapes[route_id][direction]])
+
+    return trips, patterns
+
+
+def generate_stop_times(rng, trips, patterns):
+    """
+    Generate the stop_times table. Trips start all through the service day, and the ones starting late
+    in the evening run past 24:00:00.
+    :param rng: Random number generator
+    :param trips: List of the trip rows
+    :param patterns: Dictionary of the stop pattern of each route
+    :return: Generator of the stop_times rows
+    """
+    # Trips can start until 03:00 of the next calendar day, on the same service day
+    start_hours = list(range(4, 27))
+    hour_weights = [HOUR_WEIGHTS[hour % 24] for hour in start_hours]
+
+    for route_id, _, trip_id, _, direction_id, _ in trips:
+        pattern = patterns[route_id] if direction_id == "0" else patterns[route_id][::-1]
+        seconds = rng.choices(start_hours, hour_weights)[0] * 3600 + rng.randrange(3600)
+
+        for sequence, stop_id in enumerate(pattern, start=1):
+            arrival = seconds
+            seconds += rng.randint(0, 30)
+            yield [trip_id, format_time(arrival), format_time(seconds), stop_id, sequence, 0, 0]
+            seconds += rng.randint(45, 240)
+
+
+def generate_real_time_data(rng, routes, trips, patterns, count, arrival_counts):
+    """
+    Generate the real_time_data_temp table. Observations are more frequent in the rush hours and
+    busy vehicles report more often. A vehicle never reports twice in the same second.
+    The aimed arrival times are whole minutes, which the arrival_time table counts the observations of.
+    :param rng: Random number generator
+    :param routes: List of the route rows
+    :param trips: List of the trip rows
+    :param patterns: Dictionary of the stop pattern of each route
+    :param count: The number of observations
+    :param arrival_counts: Dictionary the number of observations and late observations of each aimed arrival
+                           time are added to
+    :return: Generator of the real_time_data_temp rows
+    """
+    vehicles = [f"{AGENCIES[i % len(AGENCIES)][0]}_{1000 + i}" for i in range(max(1, len(trips) // 10))]
+    vehicle_weights = get_zipf_weights(len(vehicles), ZIPF_SKEW / 2)
+    route_agencies = {route[0]: route[1] for route in routes}
+
+    # The mean gap between observations over the whole period, shortened in the busy hours
+    mean_gap = REAL_TIME_DAYS * 86400 / count
+    mean_weight = sum(HOUR_WEIGHTS) / len(HOUR_WEIGHTS)
+    recorded_time = REAL_TIME_START
+    last_seen = {}
+
+    for _ in range(count):
+        recorded_time += datetime.timedelta(
+            seconds=rng.expovariate(HOUR_WEIGHTS[recorded_time.hour] / mean_weight / mean_gap))
+        recorded_second = recorded_time.replace(microsecond=0)
+
+        vehicle = rng.choices(range(len(vehicles)), cum_weights=vehicle_weights)[0]
+        while last_seen.get(vehicle) == recorded_second:
+            vehicle = (vehicle + 1) % len(vehicles)
+        last_seen[vehicle] = recorded_second
+
+        route_id, _, trip_id, _, direction_id, _ = rng.choice(trips)
+        pattern = patterns[route_id] if direction_id == "0" else patterns[route_id][::-1]
+        next_stop_index = rng.randrange(1, len(pattern))
+        lat, lon = random_coordinates(rng)
+        distance = round(rng.uniform(0, 20000), 2)
+
+        # Some observations have no aimed arrival, and buses run late more often than early
+        if rng.random() < 0.1:
+            aimed_arrival_time = None
+        else:
+            aimed_arrival_time = recorded_second.replace(second=0) + datetime.timedelta(minutes=rng.randint(-10, 5))
+            all_count, late_count = arrival_counts.get(aimed_arrival_time, (0, 0))
+            arrival_counts[aimed_arrival_time] = (all_count + 1, late_count + (aimed_arrival_time < recorded_second))
+
+        yield [route_id, direction_id, trip_id, route_agencies[route_id],
+               pattern[0], lat, lon, round(rng.uniform(0, 360), 2), vehicles[vehicle],
+               format_timestamp(aimed_arrival_time) if aimed_arrival_time else None,
+               distance, round(distance / 1609.34, 1), f"{rng.uniform(0, 1000):.2f}",
+               pattern[next_stop_index], format_timestamp(recorded_second)]
+
+
+def generate_arrival_time(arrival_counts) -> list:
+    """
+    Generate the arrival_time table from the real-time observations, one row per aimed arrival time,
+    so every observation with an aimed arrival is embedded in an Arrival_Time document by Phase 2
+    :param arrival_counts: Dictionary of the number of observations and late observations of each aimed arrival time
+    :return: List of the arrival_time rows
+    """
+    return [[format_timestamp(time_span), all_count, late_count]
+            for time_span, (all_count, late_count) in sorted(arrival_counts.items())]
+
+
+def generate_dataset(scale_factor=SCALE_FACTOR) -> dict:
+    """
+    Generate all ten data files of the dataset
+    :param scale_factor: Size of the dataset, 1 gives about 1.3 million rows
+    :return: Dictionary of the number of rows written for each table
+    """
+    print("\n======================================================\n")
+    print(f"Generating the NY Bus dataset at scale factor {scale_factor} into {os.path.abspath(OUTPUT_DIRECTORY)}")
+    os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+
+    rows = {"agency": write_table("agency", generate_agencies())}
+
+    routes = generate_routes(get_random("routes"), scaled(BASE_ROUTES, scale_factor, sublinear=True))
+    rows["routes"] = write_table("routes", routes)
+
+    calendar, calendar_dates = generate_calendar(get_random("calendar"),
+                                                 scaled(BASE_SERVICES, scale_factor, sublinear=True))
+    rows["calendar"] = write_table("calendar", calendar)
+    rows["calendar_dates"] = write_table("calendar_dates", calendar_dates)
+
+    stops = generate_stops(get_random("stops"), scaled(BASE_STOPS, scale_factor, sublinear=True))
+    rows["stops"] = write_table("stops", stops)
+
+    shapes, route_shapes = generate_shapes(get_random("shapes"), routes)
+    rows["shapes"] = write_table("shapes", shapes)
+
+    trips, patterns = generate_trips(get_random("trips"), routes, calendar, route_shapes, stops,
+                                     scaled(BASE_TRIPS, scale_factor))
+    rows["trips"] = write_table("trips", trips)
+    rows["stop_times"] = write_table("stop_times", generate_stop_times(get_random("stop_times"), trips, patterns))
+
+    arrival_counts = {}
+    rows["real_time_data_temp"] = write_table("real_time_data_temp", generate_real_time_data(
+        get_random("real_time_data_temp"), routes, trips, patterns, scaled(BASE_REAL_TIME_ROWS, scale_factor),
+        arrival_counts))
+    rows["arrival_time"] = write_table("arrival_time", generate_arrival_time(arrival_counts))
+
+    return rows
+
+
+def main() -> None:
+    """
+    Main function of the code that calls the required functions in order.
+    :return: None
+    """
+    start_time = time.time()
+
+    rows = generate_dataset()
+
+    print("\n======================================================\n")
+    print(f"Generated {sum(rows.values())} rows in {time.time() - start_time:.2f} seconds.")
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,8 @@ This code also creates the tables needed for this data.
 Steps to take before running this code:
 1. Create database
 2. Place this code file in the directory where all the data files are located
-3. Enter your database connection details in the fields given in the code below
+3. Enter your database connection details in pipeline.ini (see pipeline_db.py) and the loader settings
+   in the fields given in the code below
 4. Run the code
 
 In the console, a few details are printed on running the code:
@@ -21,30 +22,311 @@ In the console, a few details are printed on running the code:
 During testing the entire operation took approximately: 1.0 Hours, 20.0 Minutes, and 53.37177515029907 seconds.
 and it loaded: 32550921 rows
 """
+import bz2
+import datetime
+import functools
+import gzip
+import io
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import psycopg2
-
-# Postgres connection settings
-DB_NAME = "Project"
-DB_USER = "postgres"
-DB_PASSWORD = ""
-DB_HOST = "localhost"
-DB_PORT = ""
+import psycopg2.extras
+import pipeline_db
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+# Loader settings
+# "copy" streams each file through COPY FROM STDIN, "batch" sends multi-row INSERTs,
+# "row" runs one prepared INSERT per line, "statement" one unprepared INSERT per line like the original loader
+LOAD_MODE = "copy"
+# Number of lines in each multi-row INSERT of the "batch" mode
+INSERT_BATCH_ROWS = 1000
+# Number of characters handed to COPY in each read
+COPY_BUFFER_SIZE = 1 << 20
+# Feed uncompressed data files to COPY straight from a memory map, working on the raw bytes
+MMAP_READER = True
+# Load the tables at the same time with one process and connection per table
+PARALLEL_LOAD = False
+# Number of worker processes for the parallel load
+LOAD_WORKERS = os.cpu_count() or 1
+# Files larger than this many bytes are split into line-aligned ranges that are loaded concurrently
+CHUNK_SIZE = 256 << 20
+# Commit in batches and record the progress of each table so a failed load can be resumed
+RESUMABLE_LOAD = False
+# Number of lines loaded and committed in each batch of the resumable load
+CHECKPOINT_BATCH_ROWS = 100000
+# Table that keeps the byte offset and row count of each table for the resumable load
+CHECKPOINT_TABLE = "load_checkpoints"
+# Move malformed or conflicting lines to a rejects file instead of aborting the load
+QUARANTINE_BAD_ROWS = False
+# Number of lines loaded under one savepoint when quarantining outside the resumable load
+QUARANTINE_BATCH_ROWS = 10000
+# Rejected lines of a table are appended to <table_name>.rejects with the reason in front
+REJECTS_EXTENSION = ".rejects"
+# Create the tables without primary keys and build the keys and indexes after the load
+FAST_BUILD = False
+# Number of tables whose keys and indexes are built at the same time
+INDEX_BUILD_WORKERS = 4
+# Value of maintenance_work_mem for each key and index build
+INDEX_BUILD_MEMORY = "1GB"
+# Reload into UNLOGGED staging tables and swap them in for the live tables once loaded
+STAGING_RELOAD = False
+# Suffix of the staging copies of the tables
+STAGING_SUFFIX = "_staging"
+# Ingest new real-time observation files into the existing tables instead of a full reload
+DELTA_INGEST = False
+# Files with new observations for the incremental ingest, in the same format as real_time_data_temp.text
+DELTA_FILES = []
+# Table the incremental ingest upserts into and the column its high-water mark is taken from
+DELTA_TABLE = "real_time_data_temp"
+DELTA_TIME_COLUMN = "recorded_time"
+# Table that keeps the high-water mark of each incrementally ingested table
+WATERMARK_TABLE = "ingest_watermarks"
+# Range-partition real_time_data_temp by recorded_time, None, "day" or "month"
+PARTITION_GRANULARITY = None
+PARTITIONED_TABLE = "real_time_data_temp"
+PARTITION_COLUMN = "recorded_time"
+# Partitions whose range ends on or before this UTC date, for example '2014-08-01', are detached after the load,
+# None to keep them all
+DETACH_PARTITIONS_BEFORE = None
+# Drop the detached partitions instead of keeping them as tables of their own
+DROP_DETACHED_PARTITIONS = False
+# Directory for the per-partition files the rows are routed to, None for the system temporary directory
+PARTITION_SPOOL_DIR = None
+# Store the string identifiers as integer keys, the strings are kept in one <entity>_keys lookup table per entity.
+# Set in pipeline.ini for this code and NY Bus Data_Phase2.py, which decodes the keys again.
+ENCODE_IDENTIFIERS = pipeline_db.get_boolean_setting("pipeline", "encode_identifiers")
+# Count the rows of every table with COUNT(*) after the load instead of reading the estimates from the statistics
+EXACT_ROW_COUNTS = False
+# Number of tables counted at the same time for the exact counts
+COUNT_WORKERS = 4
+# Set in pipeline.ini, which Phase 2 reads too. "time" stores the time columns as time and wraps
+# times past 24:00:00 into the same day, "seconds" stores them as integer seconds since the start
+# of the service day and adds views with the time form
+TIME_STORAGE = pipeline_db.SETTINGS["pipeline"]["time_storage"]
+# Suffix of the views that show the time columns of a table as time when TIME_STORAGE is "seconds"
+TIME_VIEW_SUFFIX = "_time"
+# Only run the parsing micro-benchmark on the data file of BENCHMARK_TABLE instead of loading
+RUN_TRANSFORM_BENCHMARK = False
+BENCHMARK_TABLE = "stop_times"
+BENCHMARK_LINES = 1000000
+# Tables the copy mode loads with binary COPY, the rows are encoded on the client instead of parsed by the server.
+# Run the COPY format benchmark on a table first, it checks that both formats load the same rows on your server.
+BINARY_COPY_TABLES = []
+# Only compare text and binary COPY on the data files of COPY_BENCHMARK_TABLES instead of loading,
+# the tables must exist
+RUN_COPY_FORMAT_BENCHMARK = False
+COPY_BENCHMARK_TABLES = ["real_time_data_temp", "shapes"]
+
+# Compressed data files (<table>.text.gz, .text.bz2 or .text.zst) are decompressed while they are read,
+# .zst files need the zstandard package
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".zst")
+# Size of the buffer between a decompressor and the loader
+DECOMPRESS_BUFFER_SIZE = 1 << 20
+
+# Data files to load, each named after its table with the .text extension
+DATA_FILES = [
+    "agency",
+    "arrival_time",
+    "calendar",
+    "calendar_dates",
+    "real_time_data_temp",
+    "routes",
+    "shapes",
+    "stop_times",
+    "stops",
+    "trips"
+]
+
+# Columns of each table
+TABLE_DEFINITIONS = {
+    "agency": """
+        agency_id varchar(255) NOT NULL,
+        agency_name varchar(255),
+        agency_url varchar(255),
+        agency_timezone varchar(255),
+        agency_lang varchar(255),
+        agency_phone varchar(255)
+    """,
+    "arrival_time": """
+        time_span TIMESTAMP WITH TIME ZONE NOT NULL,
+        all_count int NULL,
+        late_count int NULL
+    """,
+    "calendar": """
+        service_id varchar(255) NOT NULL,
+        monday boolean NULL,
+        tuesday boolean NULL,
+        wednesday boolean NULL,
+        thursday boolean NULL,
+        friday boolean NULL,
+        saturday boolean NULL,
+        sunday boolean NULL,
+        start_date date NULL,
+        end_date date NULL
+    """,
+    "calendar_dates": """
+        service_id varchar(255) NOT NULL,
+        date date NOT NULL,
+        exception_type int NULL
+    """,
+    "real_time_data_temp": """
+        route_id varchar(255) NULL,
+        direction varchar(255) NULL,
+        trip_id varchar(255) NULL,
+        agency_id varchar(255) NULL,
+        origin_stop varchar(255) NULL,
+        lat float NULL,
+        lon float NULL,
+        bearing float NULL,
+        vehicle_id varchar(255) NOT NULL,
+        aimed_arrival_time TIMESTAMP WITH TIME ZONE NULL,
+        distance_from_origin float NULL,
+        presentable_distance float NULL,
+        distance_from_next_stop varchar(255) NULL,
+        next_stop varchar(255) NULL,
+        recorded_time TIMESTAMP WITH TIME ZONE NOT NULL
+    """,
+    "routes": """
+        route_id varchar(255) NOT NULL,
+        agency_id varchar(255),
+        route_short_name varchar(255),
+        route_long_name varchar(255),
+        route_desc varchar(255),
+        route_type int NULL,
+        route_color varchar(255),
+        route_text_color varchar(255)
+    """,
+    "shapes": """
+        shape_id varchar(255) NOT NULL,
+        shape_pt_lat float NULL,
+        shape_pt_lon float NULL,
+        shape_pt_sequence int NOT NULL
+    """,
+    # "split_shape": """
+    #     route_id varchar(255) NOT NULL,
+    #     shape_id varchar(255) NOT NULL,
+    #     split_id int NOT NULL,
+    #     pt_id int NOT NULL,
+    #     lat float NOT NULL,
+    #     lon float NOT NULL,
+    #     PRIMARY KEY (shape_id, split_id, pt_id)
+    # """,
+    # "split_shape_speed": """
+    #     route_id varchar(255) NOT NULL,
+    #     shape_id varchar(255) NOT NULL,
+    #     split_id int NOT NULL,
+    #     speed float NOT NULL,
+    #     PRIMARY KEY (shape_id, split_id)
+    # """,
+    "stop_times": """
+        trip_id varchar(255) NOT NULL,
+        arrival_time time NULL,
+        departure_time time NULL,
+        stop_id varchar(255) NOT NULL,
+        stop_sequence int NOT NULL,
+        pickup_type int NULL,
+        drop_off_type int NULL
+    """,
+    "stops": """
+        stop_id varchar(255) NOT NULL,
+        stop_name varchar(255) NULL,
+        stop_desc varchar(255) NULL,
+        stop_lat float NULL,
+        stop_lon float NULL,
+        zone_id varchar(255) NULL,
+        stop_url varchar(255) NULL,
+        location_type varchar(255) NULL,
+        parent_station varchar(255) NULL
+    """,
+    "trips": """
+        route_id varchar(255) NOT NULL,
+        service_id varchar(255) NULL,
+        trip_id varchar(255) NOT NULL,
+        trip_headsign varchar(255) NULL,
+        direction_id varchar(255) NULL,
+        shape_id varchar(255) NULL
+    """,
+}
+
+# Data types of TABLE_DEFINITIONS as information_schema reports them
+DEFINED_TYPE_NAMES = {
+    "varchar(255)": "character varying",
+    "int": "integer",
+    "float": "double precision",
+    "time": "time without time zone",
+    "timestamp with time zone": "timestamp with time zone",
+    "boolean": "boolean",
+    "date": "date",
+}
+
+# Primary keys of the tables, added at creation or after the load in the fast build
+PRIMARY_KEYS = {
+    "agency": "agency_id",
+    "arrival_time": "time_span",
+    "calendar": "service_id",
+    "calendar_dates": "service_id, date",
+    "real_time_data_temp": "recorded_time, vehicle_id",
+    "routes": "route_id",
+    "shapes": "shape_id, shape_pt_sequence",
+    "stop_times": "trip_id, stop_id",
+    "stops": "stop_id",
+    "trips": "trip_id",
+}
+
+# Indexes from create_indexes in NY Bus Data_Phase2.py as (index name, columns),
+# built after the load in the fast build
+INDEX_DEFINITIONS = {
+    "routes": [("ROUTEINDEX", "ROUTE_ID")],
+    "real_time_data_temp": [("RTDTINDEX", "aimed_arrival_time, route_id")],
+    "stop_times": [("STOPTIMEINDEX", "ARRIVAL_TIME, TRIP_ID, STOP_ID")],
+    "stops": [("STOPINDEX", "STOP_ID")],
+    "trips": [("TRIPINDEX", "TRIP_ID, ROUTE_ID, SERVICE_ID")],
+    "calendar": [("CALENDARINDEX", "SERVICE_ID")],
+}
+
+# Identifier columns that are dictionary-encoded with ENCODE_IDENTIFIERS, and the entity each one refers to.
+# The stops of the real-time observations are stop ids too and share the keys of stop_id.
+IDENTIFIER_COLUMNS = pipeline_db.IDENTIFIER_COLUMNS
+IDENTIFIER_TYPE_PATTERN = re.compile(r'\b(' + '|'.join(IDENTIFIER_COLUMNS) + r') varchar\(255\)')
+
+# Time columns of TABLE_DEFINITIONS, stored as integer seconds when TIME_STORAGE is "seconds"
+TIME_TYPE_PATTERN = re.compile(r'\b(\w+) time\b')
+TIME_COLUMNS = {column for columns in TABLE_DEFINITIONS.values() for column in TIME_TYPE_PATTERN.findall(columns)}
+
+# GTFS times, which can go past 24:00:00
+TIME_PATTERN = re.compile(r'^\d+:\d{2}:\d{2}(\.\d+)?$')
+# Timestamps of the data files, for example '2014-08-01 04:00:01-04', with an optional UTC offset
+TIMESTAMP_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}):(\d{2}):(\d{2})(\.\d{1,6})?(?:([+-])(\d{2}):?(\d{2})?|(Z))?$')
+# Partition names end with their key, for example real_time_data_temp_p2014_08_01 or real_time_data_temp_p2014_08
+PARTITION_NAME_PATTERN = re.compile(r'_p(\d{4})_(\d{2})(?:_(\d{2}))?$')
+# ASCII characters str.strip() removes, and a block of raw lines with one of them, or a blank line,
+# at the start or end of a line, after framing the block with a newline
+ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+LINE_EDGE_WHITESPACE_PATTERN = re.compile(rb'[ \t\r\x0b\x0c\x1c-\x1f]\n|\n[ \t\r\n\x0b\x0c\x1c-\x1f]')
 
 
 def connect_to_db():
     """
-    Connect to the Postgres Database using the parameters defined above.
-    :return: connection to the Postgres Database
+    Connect to the Postgres Database using the settings of pipeline_db.py.
+    :return: connection to the Postgres Database, borrowed from the shared pool until it is closed
     """
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-    return conn
+    return pipeline_db.connect_to_db()
 
 
 # Function to adjust time values greater than or equal to '24:00:00' to the next day
@@ -68,101 +350,1704 @@ def adjust_time(time_str) -> str:
         # Subtract 24 hours' worth of seconds
         total_seconds -= 24 * 3600
 
-        # Calculate the adjusted time
-        adjusted_hours, remaining_seconds = divmod(total_seconds, 3600)
-        adjusted_minutes, adjusted_seconds = divmod(remaining_seconds, 60)
+        # Calculate the adjusted time
+        adjusted_hours, remaining_seconds = divmod(total_seconds, 3600)
+        adjusted_minutes, adjusted_seconds = divmod(remaining_seconds, 60)
+
+        # Format the adjusted time including milliseconds
+        adjusted_time = f'{adjusted_hours:02}:{adjusted_minutes:02}:{adjusted_seconds:02}.{milliseconds:06}'
+
+        return adjusted_time
+    else:
+        return time_str
+
+
+def parse_seconds(time_str) -> str:
+    """
+    Convert a GTFS time to the number of seconds since the start of the service day.
+    Times past 24:00:00 keep their day overflow, for example 25:00:00 is 90000.
+    :param time_str: The time, for example '25:03:10.000000'
+    :return: String formatted number of seconds
+    """
+    hours, minutes, seconds = time_str.split(':', 2)
+
+    # GTFS times have whole seconds, so the fraction is dropped
+    return str(int(hours) * 3600 + int(minutes) * 60 + int(seconds[:2]))
+
+
+def get_table_columns(cur, table_name) -> tuple:
+    """
+    Get the column names and data types for a table from the schema catalog of pipeline_db.py,
+    which reads the database schema once instead of once per table
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table
+    :return: Tuple containing the list of column names and the dictionary of column data types
+    """
+    return pipeline_db.schema_catalog.get_columns(cur, table_name)
+
+
+def transform_values(values, columns, data_types) -> list:
+    """
+    Apply the loader transforms to the values of one line of a data file by checking
+    the type of every column. Kept as the baseline for benchmark_transform_plan,
+    the loader itself uses TransformPlan.
+    :param values: List of string values read from the line
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :return: List of values with adjusted times and None in place of 'NULL'
+    """
+    # Adjust time values if the column is detected as a time column
+    for i, column in enumerate(columns):
+        if data_types[column] == 'time without time zone':
+            values[i] = adjust_time(values[i])
+
+    # Replace 'NULL' values with None
+    for i in range(len(values)):
+        if values[i] == 'NULL':
+            values[i] = None
+
+    return values
+
+
+def get_column_coercer(column, data_type):
+    """
+    Get the function that converts the values of a column before they are loaded
+    :param column: Name of the column
+    :param data_type: Data type of the column
+    :return: The conversion function, or None if the values are loaded as they are
+    """
+    if data_type == 'time without time zone':
+        return adjust_time
+
+    # Time columns created as integers hold the seconds since the start of the service day
+    if column in TIME_COLUMNS and data_type == 'integer':
+        return parse_seconds
+
+    # Identifier columns created as integers hold the keys of the encoded strings
+    if column in IDENTIFIER_COLUMNS and data_type == 'integer':
+        return functools.partial(identifier_encoder.encode, IDENTIFIER_COLUMNS[column])
+
+    return None
+
+
+class IdentifierEncoder:
+    """
+    Dictionary encoding of the string identifiers. Every distinct id of an entity is given
+    the next integer key, and the new pairs are written to the <entity>_keys lookup table
+    in the same transaction as the rows that use them.
+    """
+
+    def __init__(self):
+        self.keys = {entity: {} for entity in IDENTIFIER_COLUMNS.values()}
+        self.next_key = {entity: 1 for entity in IDENTIFIER_COLUMNS.values()}
+        self.pending = {entity: [] for entity in IDENTIFIER_COLUMNS.values()}
+
+    def load(self, cur) -> None:
+        """
+        Read the keys that are already assigned from the lookup tables, so ids keep their key between loads
+        :param cur: Cursor of the Postgres connection
+        :return: None
+        """
+        for entity in self.keys:
+            cur.execute(f"SELECT {entity}_id, {entity}_key FROM {entity}_keys")
+            self.keys[entity] = dict(cur.fetchall())
+            self.next_key[entity] = max(self.keys[entity].values(), default=0) + 1
+            self.pending[entity] = []
+
+        return None
+
+    def encode(self, entity, value) -> str:
+        """
+        Get the key of an id, assigning the next key to an id that was not seen before
+        :param entity: Entity the id refers to, for example "trip"
+        :param value: The string id
+        :return: The key of the id as a string, ready for the COPY line or the INSERT
+        """
+        keys = self.keys[entity]
+        key = keys.get(value)
+        if key is None:
+            key = self.next_key[entity]
+            self.next_key[entity] += 1
+            keys[value] = key
+            self.pending[entity].append((key, value))
+
+        return str(key)
+
+    def flush(self, cur) -> int:
+        """
+        Write the keys assigned since the last flush to the lookup tables. Called right
+        before every commit of the rows that use them.
+        :param cur: Cursor of the Postgres connection
+        :return: The number of new keys written
+        """
+        written = 0
+        for entity, pending in self.pending.items():
+            if pending:
+                psycopg2.extras.execute_values(cur, f"INSERT INTO {entity}_keys ({entity}_key, {entity}_id) "
+                                                    f"VALUES %s", pending, page_size=10000)
+                written += len(pending)
+                self.pending[entity] = []
+
+        return written
+
+
+# The keys are assigned in the loading process, so the encoded load runs on one connection
+identifier_encoder = IdentifierEncoder()
+
+
+class TransformPlan:
+    """
+    The loader transforms of one table, compiled once from its columns so each
+    line is converted in one pass without looking up the column types again.
+    """
+
+    def __init__(self, columns, data_types):
+        """
+        :param columns: List of column names of the table
+        :param data_types: Dictionary of the data type of each column
+        """
+        self.coercers = []
+        for i, column in enumerate(columns):
+            coercer = get_column_coercer(column, data_types[column])
+            if coercer is not None:
+                self.coercers.append((i, coercer))
+
+    def coerce(self, values) -> list:
+        """
+        Convert the values of the columns that need it, leaving 'NULL' values as they are
+        :param values: List of string values read from a line
+        :return: The same list with the converted values
+        """
+        for i, coercer in self.coercers:
+            if values[i] != 'NULL':
+                values[i] = coercer(values[i])
+
+        return values
+
+    def apply(self, values) -> list:
+        """
+        Apply the plan to the values of one line for an INSERT statement
+        :param values: List of string values read from a line
+        :return: List of converted values with None in place of 'NULL'
+        """
+        return [None if value == 'NULL' else value for value in self.coerce(values)]
+
+    def copy_line(self, line) -> str:
+        """
+        Apply the plan to one stripped line and format it as a line of the COPY text format
+        :param line: The stripped line read from the data file
+        :return: The line in COPY text format
+        """
+        values = self.coerce(line.split('\t'))
+
+        # COPY treats the backslash as an escape character, which is rare in the data
+        if '\\' in line:
+            values = [value.replace('\\', '\\\\') for value in values]
+
+        # COPY uses \N for NULL
+        return '\t'.join(['\\N' if value == 'NULL' else value for value in values]) + '\n'
+
+
+def find_data_file(table_name) -> str:
+    """
+    Find the data file of a table, which can be plain text or compressed
+    :param table_name: Name of the table, the data file is named after it
+    :return: Name of the data file, the plain .text name if no file is found
+    """
+    for extension in ("",) + tuple(COMPRESSED_EXTENSIONS):
+        filename = table_name + ".text" + extension
+        if os.path.exists(filename):
+            return filename
+
+    return table_name + ".text"
+
+
+def is_compressed(filename) -> bool:
+    """
+    Check if a data file is compressed, based on its extension
+    :param filename: Name of the data file
+    :return: True if the file is read through a decompressor
+    """
+    return os.path.splitext(filename)[1] in COMPRESSED_EXTENSIONS
+
+
+def open_data_file(filename, start=0):
+    """
+    Open a data file for reading in binary mode. Compressed files are decompressed as they are
+    read through a fixed-size buffer, so they never have to be decompressed to disk first.
+    :param filename: Name of the data file
+    :param start: Byte offset in the uncompressed data to start reading from
+    :return: The open binary file object
+    """
+    extension = os.path.splitext(filename)[1]
+    if extension not in COMPRESSED_EXTENSIONS:
+        file = open(filename, "rb")
+        file.seek(start)
+        return file
+
+    if extension == ".gz":
+        file = io.BufferedReader(gzip.GzipFile(filename, "rb"), DECOMPRESS_BUFFER_SIZE)
+    elif extension == ".bz2":
+        file = io.BufferedReader(bz2.BZ2File(filename, "rb"), DECOMPRESS_BUFFER_SIZE)
+    else:
+        if zstandard is None:
+            raise ImportError(f"The zstandard package is needed to read {filename}")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+        file = io.BufferedReader(reader, DECOMPRESS_BUFFER_SIZE)
+
+    # Compressed streams can only move forward by decompressing, so skip to the start offset
+    while start > 0:
+        skipped = len(file.read(min(start, DECOMPRESS_BUFFER_SIZE)))
+        if not skipped:
+            break
+        start -= skipped
+
+    return file
+
+
+def read_file_lines(filename, start=0, end=None):
+    """
+    Read the lines of a data file that start inside the byte range [start, end)
+    :param filename: Name of the data file
+    :param start: Byte offset of the first line, must be at the start of a line
+    :param end: Byte offset to stop at, None to read until the end of the file
+    :return: Generator of the decoded lines
+    """
+    with open_data_file(filename, start) as file:
+        position = start
+        while end is None or position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode("utf-8")
+
+
+def read_line_batches(filename, start, batch_rows, end=None):
+    """
+    Read the lines of a data file that start inside the byte range [start, end) in batches
+    :param filename: Name of the data file
+    :param start: Byte offset of the first line, must be at the start of a line
+    :param batch_rows: The number of lines in each batch
+    :param end: Byte offset to stop at, None to read until the end of the file
+    :return: Generator of tuples containing the list of decoded lines and the byte offset after the batch
+    """
+    with open_data_file(filename, start) as file:
+        position = start
+        batch = []
+        for line in file:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            batch.append(line.decode("utf-8"))
+            if len(batch) == batch_rows:
+                yield batch, position
+                batch = []
+
+        if batch:
+            yield batch, position
+
+
+def compute_file_chunks(filename, chunk_size) -> list:
+    """
+    Split a data file into byte ranges of about chunk_size bytes that are aligned to line boundaries
+    :param filename: Name of the data file
+    :param chunk_size: The approximate size of each range in bytes
+    :return: List of (start, end) byte offsets
+    """
+    file_size = os.path.getsize(filename)
+    chunks = []
+
+    with open(filename, "rb") as file:
+        start = 0
+        while start < file_size:
+            # Move the guessed boundary forward to the end of the line it falls in
+            file.seek(min(start + chunk_size, file_size))
+            file.readline()
+            end = min(file.tell(), file_size)
+            chunks.append((start, end))
+            start = end
+
+    return chunks
+
+
+class CopyStream:
+    """
+    File-like object that feeds the lines of a data file to COPY FROM STDIN.
+    Lines are read and transformed only when COPY asks for more data, so the whole
+    file is never held in memory.
+    """
+
+    def __init__(self, lines, columns, data_types):
+        """
+        :param lines: Iterator over the lines of the data file
+        :param columns: List of column names of the table
+        :param data_types: Dictionary of the data type of each column
+        """
+        self.lines = lines
+        self.plan = TransformPlan(columns, data_types)
+        self.pending = ''
+        self.rows = 0
+
+    def format_line(self, line) -> str:
+        """
+        Convert one line of the data file into a line of the COPY text format
+        :param line: The line read from the data file
+        :return: The line in COPY text format, or an empty string for blank lines
+        """
+        line = line.strip()
+        if not line:
+            return ''
+
+        self.rows += 1
+        return self.plan.copy_line(line)
+
+    def read(self, size=-1) -> str:
+        """
+        Read up to size characters of COPY data
+        :param size: The number of characters asked for by COPY, -1 for everything
+        :return: The COPY data, or an empty string once the file is exhausted
+        """
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunk = self.format_line(line)
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.pending = ''
+            return data
+
+        self.pending = data[size:]
+        return data[:size]
+
+
+def strip_line(line) -> bytes:
+    """
+    Strip a raw line of a data file the same way line.strip() strips the decoded line
+    :param line: The raw line
+    :return: The raw line without the whitespace at its start and end
+    """
+    line = line.strip(ASCII_WHITESPACE)
+
+    # Only a line starting or ending with a multibyte character can have more whitespace to strip
+    if line and (line[0] >= 0x80 or line[-1] >= 0x80):
+        line = line.decode("utf-8").strip().encode("utf-8")
+
+    return line
+
+
+class MappedCopyStream:
+    """
+    File-like object that feeds a byte range of an uncompressed data file to COPY FROM STDIN
+    straight from a memory map. The lines are handled a block at a time on the raw bytes, only the
+    fields of columns with a transform are decoded, and the other fields go to COPY as they are in the file.
+    """
+
+    def __init__(self, filename, columns, data_types, start=0, end=None):
+        """
+        :param filename: Name of the data file, it must not be compressed or empty
+        :param columns: List of column names of the table
+        :param data_types: Dictionary of the data type of each column
+        :param start: Byte offset of the first line, must be at the start of a line
+        :param end: Byte offset to stop at, None to read until the end of the file
+        """
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.position = start
+        self.end = len(self.map) if end is None else min(end, len(self.map))
+        self.plan = TransformPlan(columns, data_types)
+        self.rows = 0
+
+    def format_block(self, block) -> bytes:
+        """
+        Convert a block of whole lines of the data file into COPY text format. The lines are stripped
+        and blank lines skipped like CopyStream does, so both readers load the same rows
+        :param block: The raw lines, ending with a newline
+        :return: The lines in COPY text format, without the blank lines
+        """
+        # The lines only have to be split when one needs stripping or has a field to transform
+        if self.plan.coercers or not block.isascii() or LINE_EDGE_WHITESPACE_PATTERN.search(b'\n' + block):
+            lines = [line for line in map(strip_line, block.split(b'\n')) if line]
+            for n, line in enumerate(lines if self.plan.coercers else ()):
+                fields = line.split(b'\t')
+                for i, coercer in self.plan.coercers:
+                    # A line with missing fields is passed on as it is and rejected by COPY
+                    if i < len(fields) and fields[i] != b'NULL':
+                        fields[i] = coercer(fields[i].decode("utf-8")).encode("utf-8")
+                lines[n] = b'\t'.join(fields)
+
+            if not lines:
+                return b''
+            block = b'\n'.join(lines) + b'\n'
+
+        self.rows += block.count(b'\n')
+
+        # COPY treats the backslash as an escape character, which is rare in the data
+        if b'\\' in block:
+            block = block.replace(b'\\', b'\\\\')
+
+        if b'NULL' not in block:
+            return block
+
+        # COPY uses \N for NULL. The block is framed with a newline so every field sits between
+        # two separators, and NULLs next to each other, or on lines next to each other, need a second pass
+        # as the replacements do not overlap.
+        block = b'\n' + block
+        for _ in range(2):
+            block = block.replace(b'\tNULL\t', b'\t\\N\t').replace(b'\nNULL\t', b'\n\\N\t')
+            block = block.replace(b'\tNULL\n', b'\t\\N\n').replace(b'\nNULL\n', b'\n\\N\n')
+
+        return block[1:]
+
+    def read(self, size=-1) -> bytes:
+        """
+        Read about size bytes of COPY data, extended to the end of the last line
+        :param size: The number of bytes asked for by COPY, -1 for everything
+        :return: The COPY data, or empty bytes once the range is exhausted
+        """
+        while self.position < self.end:
+            block_end = self.end if size < 0 else min(self.position + max(size, 1), self.end)
+            if block_end < self.end:
+                newline = self.map.find(b'\n', block_end - 1, self.end)
+                block_end = self.end if newline == -1 else newline + 1
+
+            block = self.map[self.position:block_end]
+            self.position = block_end
+            if not block.endswith(b'\n'):
+                block += b'\n'
+
+            # A block of blank lines gives nothing, and empty data would end the COPY early
+            data = self.format_block(block)
+            if data:
+                return data
+
+        return b''
+
+    def close(self) -> None:
+        """
+        Close the memory map and the data file
+        :return: None
+        """
+        self.map.close()
+        self.file.close()
+
+        return None
+
+
+# Most parameters one statement can have
+MAX_STATEMENT_PARAMETERS = 65535
+
+# Binary COPY format: the signature, flags and header extension length, and the end of the data
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('!h', -1)
+# Field length of NULL, and the number of days from 0001-01-01 to 2000-01-01, the epoch of the binary format
+BINARY_NULL = struct.pack('!i', -1)
+POSTGRES_EPOCH_DAYS = datetime.date(2000, 1, 1).toordinal()
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+BOOLEAN_TRUE_VALUES = {'t', 'true', 'y', 'yes', 'on', '1'}
+
+
+def parse_binary_date(value) -> int:
+    """
+    Parse a date for the binary COPY format
+    :param value: The date, for example '2014-08-01' or '20140801'
+    :return: The number of days since 2000-01-01
+    """
+    if '-' in value:
+        year, month, day = value.split('-')
+    else:
+        year, month, day = value[:4], value[4:6], value[6:8]
+
+    return datetime.date(int(year), int(month), int(day)).toordinal() - POSTGRES_EPOCH_DAYS
+
+
+def parse_binary_time(value) -> int:
+    """
+    Parse a time for the binary COPY format
+    :param value: The time, for example '04:00:01.000000'
+    :return: The number of microseconds since midnight
+    """
+    hours, minutes, seconds = value.split(':')
+    seconds, _, fraction = seconds.partition('.')
+
+    return (int(hours) * 3600 + int(minutes) * 60 + int(seconds)) * 1000000 + int(fraction.ljust(6, '0')[:6])
+
+
+def parse_binary_timestamp(value, timezone) -> int:
+    """
+    Parse a timestamp with time zone for the binary COPY format
+    :param value: The timestamp, for example '2014-08-01 04:00:01-04'
+    :param timezone: Time zone of timestamps without an offset, the TimeZone of the session, None if it is not known
+    :return: The number of microseconds since 2000-01-01 00:00:00 UTC
+    """
+    timestamp = parse_timestamp(value)
+    if timestamp.tzinfo is None:
+        if timezone is None:
+            raise ValueError(f"timestamp without an offset in an unknown session TimeZone: {value}")
+        timestamp = timestamp.replace(tzinfo=timezone)
+
+    delta = timestamp - POSTGRES_EPOCH
+
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def get_binary_encoder(data_type, timezone):
+    """
+    Get the function that encodes the values of a column as fields of the binary COPY format
+    :param data_type: Data type of the column as information_schema reports it
+    :param timezone: Time zone of timestamps without an offset, the TimeZone of the session
+    :return: The function, which takes the text value and returns the field with its length in front
+    """
+    if data_type in ('integer', 'smallint', 'bigint'):
+        packer = {'integer': struct.Struct('!ii'), 'smallint': struct.Struct('!ih'),
+                  'bigint': struct.Struct('!iq')}[data_type]
+        size = packer.size - 4
+        return lambda value: packer.pack(size, int(value))
+
+    if data_type in ('double precision', 'real'):
+        packer = struct.Struct('!id') if data_type == 'double precision' else struct.Struct('!if')
+        size = packer.size - 4
+        return lambda value: packer.pack(size, float(value))
+
+    if data_type == 'boolean':
+        packer = struct.Struct('!i?')
+        return lambda value: packer.pack(1, value.lower() in BOOLEAN_TRUE_VALUES)
+
+    if data_type == 'date':
+        packer = struct.Struct('!ii')
+        return lambda value: packer.pack(4, parse_binary_date(value))
+
+    if data_type == 'time without time zone':
+        packer = struct.Struct('!iq')
+        return lambda value: packer.pack(8, parse_binary_time(value))
+
+    if data_type == 'timestamp with time zone':
+        packer = struct.Struct('!iq')
+        return lambda value: packer.pack(8, parse_binary_timestamp(value, timezone))
+
+    if data_type in ('character varying', 'text'):
+        length = struct.Struct('!i')
+
+        def encode_text(value) -> bytes:
+            data = value.encode("utf-8")
+            return length.pack(len(data)) + data
+
+        return encode_text
+
+    raise ValueError(f"binary COPY does not support columns of type {data_type}")
+
+
+class BinaryCopyStream:
+    """
+    File-like object that feeds the lines of a data file to COPY FROM STDIN in the binary format.
+    Every value is converted to its binary form on the client, using the column types from the
+    database schema, so the server does not have to parse the numbers and timestamps.
+    """
+
+    def __init__(self, lines, columns, data_types, timezone):
+        """
+        :param lines: Iterator over the lines of the data file
+        :param columns: List of column names of the table
+        :param data_types: Dictionary of the data type of each column
+        :param timezone: Time zone of timestamps without an offset, the TimeZone of the session
+        """
+        self.lines = lines
+        self.plan = TransformPlan(columns, data_types)
+        self.encoders = [get_binary_encoder(data_types[column], timezone) for column in columns]
+        self.field_count = struct.pack('!h', len(columns))
+        self.pending = BINARY_COPY_HEADER
+        self.finished = False
+        self.rows = 0
+
+    def format_line(self, line) -> bytes:
+        """
+        Convert one line of the data file into a row of the binary COPY format
+        :param line: The line read from the data file
+        :return: The row, or empty bytes for blank lines
+        """
+        line = line.strip()
+        if not line:
+            return b''
+
+        values = self.plan.coerce(line.split('\t'))
+        if len(values) != len(self.encoders):
+            raise ValueError(f"expected {len(self.encoders)} columns, found {len(values)}: {line}")
+
+        self.rows += 1
+        return self.field_count + b''.join([BINARY_NULL if value == 'NULL' else encoder(value)
+                                            for encoder, value in zip(self.encoders, values)])
+
+    def read(self, size=-1) -> bytes:
+        """
+        Read up to size bytes of binary COPY data
+        :param size: The number of bytes asked for by COPY, -1 for everything
+        :return: The COPY data, or empty bytes once the file is exhausted
+        """
+        chunks = [self.pending]
+        length = len(self.pending)
+        while not self.finished and (size < 0 or length < size):
+            line = next(self.lines, None)
+            if line is None:
+                chunks.append(BINARY_COPY_TRAILER)
+                self.finished = True
+                break
+            chunk = self.format_line(line)
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = b''.join(chunks)
+        if size < 0:
+            self.pending = b''
+            return data
+
+        self.pending = data[size:]
+        return data[:size]
+
+
+def get_session_timezone(cur):
+    """
+    Get the TimeZone setting of the session, which the server applies to timestamps without an offset
+    :param cur: Cursor of the Postgres connection
+    :return: The time zone, None if Python does not know it, for example a POSIX-style setting
+             or any zone on Windows without the tzdata package
+    """
+    cur.execute("SHOW TimeZone")
+    name = cur.fetchone()[0]
+
+    if zoneinfo is None:
+        return None
+
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (KeyError, ValueError, OSError):
+        # ZoneInfoNotFoundError is a KeyError
+        return None
+
+
+def binary_copy_rows(cur, table_name, lines, columns, data_types) -> int:
+    """
+    Stream lines of a data file into their table through binary COPY FROM STDIN
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to copy into
+    :param lines: Iterator over the lines of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :return: The number of rows copied
+    """
+    timezone = get_session_timezone(cur)
+    if timezone is None and 'timestamp with time zone' in data_types.values():
+        # Timestamps without an offset could not be encoded, so the server parses the text instead
+        print(f"The session TimeZone is not known to Python, loading {table_name} with text COPY.")
+        return copy_rows(cur, table_name, lines, columns, data_types)
+
+    stream = BinaryCopyStream(lines, columns, data_types, timezone)
+    cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)", stream,
+                    size=COPY_BUFFER_SIZE)
+
+    return stream.rows
+
+
+def get_insert_statement(table_name, columns, data_types, rows=1) -> tuple:
+    """
+    Construct the INSERT statement of a number of rows of a table for a server-side prepared statement
+    :param table_name: Name of the table to insert into
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param rows: The number of rows the statement inserts
+    :return: Tuple of the name of the prepared statement, the statement and the list of parameter types
+    """
+    values = ', '.join(
+        '(' + ', '.join(f"${row * len(columns) + i + 1}" for i in range(len(columns))) + ')' for row in range(rows))
+    statement = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES {values}"
+
+    return f"insert_{table_name}_{rows}", statement, [data_types[column] for column in columns] * rows
+
+
+def insert_rows(cur, table_name, lines, columns, data_types, prepared=True) -> int:
+    """
+    Insert lines of a data file into their table with one INSERT statement per line,
+    prepared once on the connection so each line is only bound and executed
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to insert into
+    :param lines: Iterator over the lines of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param prepared: False to send every INSERT as a new statement, as the original loader did
+    :return: The number of rows inserted
+    """
+    # Construct the INSERT statement dynamically based on column names
+    name, statement, parameter_types = get_insert_statement(table_name, columns, data_types)
+    placeholders = ', '.join(['%s' for _ in range(len(columns))])
+    sql_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+
+    plan = TransformPlan(columns, data_types)
+    rows = 0
+
+    # Read data line by line
+    for line in lines:
+        values = line.strip().split('\t')  # Assuming tab-separated values
+        if prepared:
+            pipeline_db.execute_prepared(cur, name, statement, parameter_types, plan.apply(values))
+        else:
+            cur.execute(sql_query, plan.apply(values))
+        rows += 1
+
+    return rows
+
+
+def insert_row_batches(cur, table_name, lines, columns, data_types, batch_rows=INSERT_BATCH_ROWS) -> int:
+    """
+    Insert lines of a data file into their table with one multi-row INSERT statement per batch of lines
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to insert into
+    :param lines: Iterator over the lines of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param batch_rows: The number of lines in each INSERT
+    :return: The number of rows inserted
+    """
+    sql_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s"
+
+    # Full batches reuse one prepared statement, as long as it stays within the parameter limit of Postgres
+    prepared = batch_rows * len(columns) <= MAX_STATEMENT_PARAMETERS
+    if prepared:
+        name, statement, parameter_types = get_insert_statement(table_name, columns, data_types, batch_rows)
+
+    plan = TransformPlan(columns, data_types)
+    rows = 0
+    batch = []
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        batch.append(plan.apply(line.split('\t')))
+        if len(batch) == batch_rows:
+            if prepared:
+                pipeline_db.execute_prepared(cur, name, statement, parameter_types,
+                                             [value for values in batch for value in values])
+            else:
+                psycopg2.extras.execute_values(cur, sql_query, batch, page_size=batch_rows)
+            rows += len(batch)
+            batch = []
+
+    if batch:
+        psycopg2.extras.execute_values(cur, sql_query, batch, page_size=batch_rows)
+        rows += len(batch)
+
+    return rows
+
+
+def copy_rows(cur, table_name, lines, columns, data_types) -> int:
+    """
+    Stream lines of a data file into their table through COPY FROM STDIN
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to copy into
+    :param lines: Iterator over the lines of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :return: The number of rows copied
+    """
+    stream = CopyStream(lines, columns, data_types)
+    cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", stream, size=COPY_BUFFER_SIZE)
+
+    return stream.rows
+
+
+def copy_mapped_file(cur, table_name, filename, columns, data_types, start=0, end=None) -> int:
+    """
+    Stream a byte range of an uncompressed data file into its table through COPY FROM STDIN, from a memory map
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to copy into
+    :param filename: Name of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param start: Byte offset of the first line, must be at the start of a line
+    :param end: Byte offset to stop at, None to read until the end of the file
+    :return: The number of rows copied
+    """
+    # An empty file cannot be memory-mapped
+    if os.path.getsize(filename) == 0:
+        return 0
+
+    stream = MappedCopyStream(filename, columns, data_types, start, end)
+    try:
+        # The raw bytes are sent as they are, so the server is told they are UTF-8
+        cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (ENCODING 'UTF8')", stream,
+                        size=COPY_BUFFER_SIZE)
+
+    finally:
+        stream.close()
+
+    return stream.rows
+
+
+def load_lines(cur, table_name, lines, columns, data_types, mode) -> int:
+    """
+    Load lines of a data file into their table using the given loader mode
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to load into
+    :param lines: Iterator over the lines of the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param mode: "copy" to stream the lines through COPY, "binary" for binary COPY,
+                 "batch" for multi-row INSERTs, "row" to run one prepared INSERT per line,
+                 "statement" to run one unprepared INSERT per line
+    :return: The number of rows loaded
+    """
+    if mode == "copy":
+        return copy_rows(cur, table_name, lines, columns, data_types)
+
+    if mode == "batch":
+        return insert_row_batches(cur, table_name, lines, columns, data_types)
+
+    if mode == "binary":
+        return binary_copy_rows(cur, table_name, lines, columns, data_types)
+
+    if mode == "statement":
+        return insert_rows(cur, table_name, lines, columns, data_types, prepared=False)
+
+    return insert_rows(cur, table_name, lines, columns, data_types)
+
+
+def validate_line(line, columns, data_types) -> str:
+    """
+    Check a line of a data file for the problems that can be found before sending it to the database
+    :param line: The line read from the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :return: The reason the line is rejected, or None if the line looks valid
+    """
+    values = line.strip().split('\t')
+    if len(values) != len(columns):
+        return f"expected {len(columns)} columns, found {len(values)}"
+
+    for value, column in zip(values, columns):
+        is_time = data_types[column] == 'time without time zone' or column in TIME_COLUMNS
+        if is_time and value != 'NULL' and not TIME_PATTERN.match(value):
+            return f"invalid time '{value}' in column {column}"
+
+    return None
+
+
+def screen_lines(lines, columns, data_types, rejects) -> list:
+    """
+    Drop blank lines and move the lines that fail validation to the rejects
+    :param lines: List of lines read from the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param rejects: List of (line, reason) tuples the rejected lines are added to
+    :return: List of the lines that passed validation
+    """
+    valid_lines = []
+    for line in lines:
+        if not line.strip():
+            continue
+
+        reason = validate_line(line, columns, data_types)
+        if reason is None:
+            valid_lines.append(line)
+        else:
+            rejects.append((line, reason))
+
+    return valid_lines
+
+
+def load_batch_isolated(cur, table_name, lines, columns, data_types, mode, rejects) -> int:
+    """
+    Load a batch of lines inside a savepoint. If the database rejects the batch it is rolled back
+    to the savepoint and split in half until the failing lines are found, so every other line
+    of the batch is still loaded and the fast path stays one bulk load per batch.
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to load into
+    :param lines: List of lines read from the data file
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param mode: "copy" to stream the lines through COPY, "row" to run one INSERT per line
+    :param rejects: List of (line, reason) tuples the rejected lines are added to
+    :return: The number of rows loaded
+    """
+    if not lines:
+        return 0
+
+    cur.execute("SAVEPOINT load_batch")
+    try:
+        rows = load_lines(cur, table_name, iter(lines), columns, data_types, mode)
+        cur.execute("RELEASE SAVEPOINT load_batch")
+        return rows
+
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT load_batch")
+        cur.execute("RELEASE SAVEPOINT load_batch")
+
+        if len(lines) == 1:
+            rejects.append((lines[0], str(e).strip().splitlines()[0]))
+            return 0
+
+    middle = len(lines) // 2
+    return (load_batch_isolated(cur, table_name, lines[:middle], columns, data_types, mode, rejects) +
+            load_batch_isolated(cur, table_name, lines[middle:], columns, data_types, mode, rejects))
+
+
+def write_rejects(table_name, rejects) -> int:
+    """
+    Append rejected lines with their reason to the rejects file of a table
+    :param table_name: Name of the table, the rejects file is named after it
+    :param rejects: List of (line, reason) tuples
+    :return: The number of lines written
+    """
+    if not rejects:
+        return 0
+
+    # Write all the rejects in one call so workers appending to the same file do not interleave
+    data = ''.join(f"{' '.join(reason.split())}\t{line.rstrip(chr(10) + chr(13))}\n" for line, reason in rejects)
+    with open(table_name + REJECTS_EXTENSION, "a") as file:
+        file.write(data)
+
+    return len(rejects)
+
+
+def load_lines_quarantined(cur, table_name, batches, columns, data_types, mode) -> tuple:
+    """
+    Load batches of lines, quarantining the bad lines in the rejects file of the table
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table to load into
+    :param batches: Iterator over the batches of lines
+    :param columns: List of column names of the table
+    :param data_types: Dictionary of the data type of each column
+    :param mode: "copy" to stream the lines through COPY, "row" to run one INSERT per line
+    :return: Tuple containing the number of rows loaded and the number of rows rejected
+    """
+    rows = 0
+    rejected = 0
+    for lines in batches:
+        rejects = []
+        lines = screen_lines(lines, columns, data_types, rejects)
+        rows += load_batch_isolated(cur, table_name, lines, columns, data_types, mode, rejects)
+        rejected += write_rejects(table_name, rejects)
+
+    return rows, rejected
+
+
+def print_load_rate(table_name, rows, total_time) -> None:
+    """
+    Print the number of rows loaded into a table and the load rate in rows per second
+    :param table_name: Name of the table
+    :param rows: The number of rows loaded
+    :param total_time: Time taken to load the table in seconds
+    :return: None
+    """
+    rate = rows / total_time if total_time > 0 else 0
+    print(f"Data inserted into {table_name} table: {rows} rows in {total_time:.2f} seconds "
+          f"({rate:.0f} rows/sec).")
+
+    return None
+
+
+def parse_timestamp(value) -> datetime.datetime:
+    """
+    Parse a timestamp of the data files, reading the UTC offset explicitly since
+    datetime.fromisoformat only accepts offsets like '-04' from Python 3.11
+    :param value: Timestamp string, for example '2014-08-01 04:00:01-04'
+    :return: The timestamp, with its offset as the time zone if it has one
+    """
+    match = TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        raise ValueError(f"invalid timestamp: {value!r}")
+
+    date, hour, minute, second, fraction, sign, offset_hours, offset_minutes, utc = match.groups()
+    timestamp = datetime.datetime.combine(
+        datetime.date.fromisoformat(date),
+        datetime.time(int(hour), int(minute), int(second), int((fraction or '.')[1:].ljust(6, '0'))))
+
+    if utc:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+    if sign:
+        offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes or 0))
+        return timestamp.replace(tzinfo=datetime.timezone(-offset if sign == '-' else offset))
+
+    return timestamp
+
+
+def get_partition_key(value, granularity) -> str:
+    """
+    Get the partition a timestamp value belongs to. The partitions are UTC days or months, so the key is
+    taken from the instant in UTC and does not depend on the offset in the file or the session TimeZone.
+    :param value: Timestamp string as it appears in the data file, for example '2014-08-01 04:00:01-04'
+    :param granularity: "day" or "month"
+    :return: The partition key, for example '2014-08-01' or '2014-08', or None if the value has no date or
+             no offset, such rows are read in the session TimeZone and left to the default partition
+    """
+    try:
+        timestamp = parse_timestamp(value.strip())
+    except ValueError:
+        return None
+
+    if timestamp.tzinfo is None:
+        return None
+
+    key = timestamp.astimezone(datetime.timezone.utc).date().isoformat()
+
+    return key if granularity == "day" else key[:7]
+
+
+def get_partition_bounds(key, granularity) -> tuple:
+    """
+    Get the range of a partition, with an explicit UTC offset so the server does not read it
+    in the session TimeZone
+    :param key: The partition key, for example '2014-08-01' or '2014-08'
+    :param granularity: "day" or "month"
+    :return: Tuple of the inclusive start and exclusive end timestamps of the partition
+    """
+    if granularity == "day":
+        start = datetime.date.fromisoformat(key)
+        end = start + datetime.timedelta(days=1)
+    else:
+        year, month = map(int, key.split('-'))
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + 1, 1, 1) if month == 12 else datetime.date(year, month + 1, 1)
+
+    return f"{start.isoformat()} 00:00:00+00", f"{end.isoformat()} 00:00:00+00"
+
+
+def create_partitions(cur, table_name, keys, granularity, unlogged=False) -> None:
+    """
+    Create the missing partitions of a range-partitioned table. Rows of a new partition that are already
+    in the default partition are moved into it, since Postgres refuses to add a range the default holds.
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the partitioned table
+    :param keys: The partition keys to create partitions for
+    :param granularity: "day" or "month"
+    :param unlogged: Create UNLOGGED partitions that skip the WAL
+    :return: None
+    """
+    default_partition = f"{table_name}_default"
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (default_partition,))
+    has_default = cur.fetchone()[0]
+
+    for key in sorted(keys):
+        partition_name = f"{table_name}_p{key.replace('-', '_')}"
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (partition_name,))
+        if cur.fetchone()[0]:
+            continue
+
+        start, end = get_partition_bounds(key, granularity)
+
+        # Take the rows of the range out of the default partition and put them back once the partition exists
+        moved_rows = 0
+        if has_default:
+            cur.execute(f"CREATE TEMP TABLE partition_moved_rows (LIKE {table_name})")
+            cur.execute(f"WITH moved AS (DELETE FROM {default_partition} "
+                        f"WHERE {PARTITION_COLUMN} >= %s AND {PARTITION_COLUMN} < %s RETURNING *) "
+                        f"INSERT INTO partition_moved_rows SELECT * FROM moved", (start, end))
+            moved_rows = cur.rowcount
+
+        cur.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE IF NOT EXISTS "
+                    f"{partition_name} PARTITION OF {table_name} "
+                    f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+        if has_default:
+            if moved_rows:
+                cur.execute(f"INSERT INTO {table_name} SELECT * FROM partition_moved_rows")
+                print(f"Moved {moved_rows} rows from {default_partition} to {partition_name}")
+            cur.execute("DROP TABLE partition_moved_rows")
+
+    return None
+
+
+def route_rows_to_partitions(table_name, suffix, spool_dir, granularity=PARTITION_GRANULARITY) -> list:
+    """
+    Split the data file of a partitioned table into one file per partition and create the partitions.
+    The split files are compressed when the data file is, to keep the extra disk space small.
+    :param table_name: Name of the partitioned table, the data file is named after it
+    :param suffix: Suffix of the table to load into, for example STAGING_SUFFIX for the staging copy
+    :param spool_dir: Directory to write the partition files to
+    :param granularity: "day" or "month"
+    :return: List of the partition files
+    """
+    filename = find_data_file(table_name)
+    print("\n======================================================\n")
+    print(f"Routing rows of {filename} to {granularity} partitions...")
+
+    columns, _ = get_defined_columns(table_name)
+    column_index = columns.index(PARTITION_COLUMN)
+    compressed = is_compressed(filename)
+
+    partition_files = {}
+    try:
+        for line in read_file_lines(filename):
+            # Rows without a usable date or offset go to a file of their own and end up in the default partition
+            values = line.split('\t')
+            key = get_partition_key(values[column_index], granularity) if len(values) > column_index else None
+            if key not in partition_files:
+                spool_name = os.path.join(spool_dir, f"{table_name}_{key or 'unrouted'}.text")
+                partition_files[key] = (gzip.open(spool_name + ".gz", "wt", compresslevel=1) if compressed
+                                        else open(spool_name, "w"))
+            partition_files[key].write(line)
+
+    finally:
+        for file in partition_files.values():
+            file.close()
+
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        # Staging copies are unlogged, the partitioned parent itself cannot be
+        create_partitions(cur, table_name + suffix, [key for key in partition_files if key], granularity,
+                          unlogged=suffix == STAGING_SUFFIX)
+        conn.commit()
+
+    finally:
+        cur.close()
+        conn.close()
+
+    print(f"Created {len(partition_files)} partition files.")
+
+    return [file.name for file in partition_files.values()]
+
+
+def detach_partitions_before(before, table_name=PARTITIONED_TABLE, drop=False) -> None:
+    """
+    Detach the partitions that only hold data older than a given date, instead of deleting the rows
+    :param before: UTC date string, partitions whose range ends on or before it are detached
+    :param table_name: Name of the partitioned table
+    :param drop: Drop the detached partitions as well
+    :return: None
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table_name,))
+        for partition_name, in cur.fetchall():
+            # The bounds are shown in the session TimeZone, so the UTC range is taken from the partition key
+            match = PARTITION_NAME_PATTERN.search(partition_name)
+            if match is None:
+                continue
+
+            key = '-'.join(part for part in match.groups() if part)
+            _, end = get_partition_bounds(key, "day" if match.group(3) else "month")
+            if end[:10] > before:
+                continue
+
+            cur.execute(f"ALTER TABLE {table_name} DETACH PARTITION {partition_name}")
+            if drop:
+                cur.execute(f"DROP TABLE {partition_name}")
+            print(f"{'Dropped' if drop else 'Detached'} partition {partition_name}")
+
+        conn.commit()
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def load_table_from_file(cur, table_name, mode, start=0, end=None, quarantine=QUARANTINE_BAD_ROWS, suffix="",
+                         filename=None) -> int:
+    """
+    Load the data file of a table, or a byte range of it, into the table using the given loader mode
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table, the data file is named after it
+    :param mode: "copy" to stream the file through COPY, "row" to run one INSERT per line
+    :param start: Byte offset in the file to start loading from
+    :param end: Byte offset in the file to stop loading at, None for the end of the file
+    :param quarantine: Move bad lines to the rejects file of the table instead of failing the load
+    :param suffix: Suffix of the table to load into, for example STAGING_SUFFIX for the staging copy
+    :param filename: Name of the data file, None for the data file named after the table
+    :return: The number of rows loaded
+    """
+    filename = filename or find_data_file(table_name)
+    if mode == "copy" and table_name in BINARY_COPY_TABLES:
+        mode = "binary"
+
+    table_name = table_name + suffix
+    print("\n======================================================\n")
+    if start or end is not None:
+        print(f"Loading bytes {start} to {end} of {filename} into table {table_name}")
+    else:
+        print(f"Loading data from {filename} into table {table_name}")
+
+    # Get column names for the table from the database schema
+    columns, data_types = get_table_columns(cur, table_name)
+
+    start_time = time.time()
+    if quarantine:
+        batches = (lines for lines, _ in read_line_batches(filename, start, QUARANTINE_BATCH_ROWS, end))
+        rows, rejected = load_lines_quarantined(cur, table_name, batches, columns, data_types, mode)
+        if rejected:
+            print(f"Quarantined {rejected} bad rows in {table_name + REJECTS_EXTENSION}")
+    elif mode == "copy" and MMAP_READER and not is_compressed(filename):
+        rows = copy_mapped_file(cur, table_name, filename, columns, data_types, start, end)
+    else:
+        rows = load_lines(cur, table_name, read_file_lines(filename, start, end), columns, data_types, mode)
+
+    print_load_rate(table_name, rows, time.time() - start_time)
+
+    return rows
+
+
+def insert_data_from_files(mode=LOAD_MODE, suffix="", timings=None) -> dict:
+    """
+    Insert data from text files into corresponding tables in a PostgreSQL database.
+    :param mode: "copy" to stream each file through COPY, "row" to run one INSERT per line
+    :param suffix: Suffix of the tables to load into, for example STAGING_SUFFIX for the staging copies
+    :param timings: Dictionary the seconds taken to load each table are written to, None to not record them
+    :return: Dictionary of the number of rows loaded into each table, empty if the load failed
+    """
+    # Connect to the database
+    conn = connect_to_db()
+    cur = conn.cursor()
+    loaded_rows = {}
+    spool_dir = tempfile.mkdtemp(dir=PARTITION_SPOOL_DIR)
+
+    try:
+        if ENCODE_IDENTIFIERS:
+            identifier_encoder.load(cur)
+
+        # Iterate over each file
+        for table_name in DATA_FILES:
+            start_time = time.time()
+            if PARTITION_GRANULARITY and table_name == PARTITIONED_TABLE:
+                # Load the partition files one after another, each lands in its own partition
+                loaded_rows[table_name] = sum(
+                    load_table_from_file(cur, table_name, mode, suffix=suffix, filename=partition_file)
+                    for partition_file in route_rows_to_partitions(table_name, suffix, spool_dir))
+            else:
+                loaded_rows[table_name] = load_table_from_file(cur, table_name, mode, suffix=suffix)
+
+            if timings is not None:
+                timings[table_name] = time.time() - start_time
+
+        if ENCODE_IDENTIFIERS:
+            print(f"Added {identifier_encoder.flush(cur)} new identifier keys.")
+
+        # Commit the transaction
+        conn.commit()
+        print("\n======================================================\n")
+        print("All data inserted successfully.")
+
+    except Exception as e:
+        # Rollback the transaction in case of an error
+        conn.rollback()
+        loaded_rows = {}
+        print(f"Error occurred: {e}")
+
+    finally:
+        # Close the cursor and connection
+        cur.close()
+        conn.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    return loaded_rows
+
+
+def load_table_worker(table_name, mode, start=0, end=None, suffix="", filename=None) -> tuple:
+    """
+    Load one table, or one byte range of its data file, in a worker process
+    on its own connection and transaction
+    :param table_name: Name of the table to load
+    :param mode: "copy" to stream the file through COPY, "row" to run one INSERT per line
+    :param start: Byte offset in the file to start loading from
+    :param end: Byte offset in the file to stop loading at, None for the end of the file
+    :param suffix: Suffix of the table to load into, for example STAGING_SUFFIX for the staging copy
+    :param filename: Name of the data file, None for the data file named after the table
+    :return: Tuple containing the table name, the number of rows loaded and the time taken
+    """
+    start_time = time.time()
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        rows = load_table_from_file(cur, table_name, mode, start, end, suffix=suffix, filename=filename)
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return table_name, rows, time.time() - start_time
+
+
+def check_parallel_load(loaded_tables, failed_tables) -> None:
+    """
+    Final consistency phase of the parallel load. Every worker commits its own part,
+    so a table that had any part fail is truncated, rather than left half loaded, and reported.
+    The tables that loaded completely keep their committed rows and are analyzed.
+    :param loaded_tables: List of tables that had at least one part loaded successfully
+    :param failed_tables: List of tables that had at least one part fail to load
+    :return: None
+    """
+    print("\n======================================================\n")
+    print("Checking consistency of the parallel load...")
+
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        if failed_tables:
+            # A failed table can still have some of its ranges committed
+            cur.execute(f"TRUNCATE {', '.join(failed_tables)}")
+            conn.commit()
+            print(f"Failed to load {', '.join(failed_tables)}, truncated them. "
+                  f"The other tables are loaded, load these again to complete the database.")
+
+        # Refresh the planner statistics of the freshly loaded tables
+        conn.autocommit = True
+        for table_name in loaded_tables:
+            if table_name not in failed_tables:
+                cur.execute(f"ANALYZE {table_name}")
+
+        if not failed_tables:
+            print("All data inserted successfully.")
+
+    except psycopg2.Error as e:
+        print(f"Error: {e}")
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def load_tables_in_parallel(table_names=None, mode=LOAD_MODE, workers=LOAD_WORKERS, chunk_size=CHUNK_SIZE,
+                            suffix="", timings=None) -> dict:
+    """
+    Load tables at the same time with a process pool, each worker on its own connection.
+    Files larger than chunk_size are split into line-aligned byte ranges that are loaded
+    concurrently into the same table. The largest pieces are started first so the total
+    time is bounded by the largest piece of work.
+    :param table_names: List of tables to load, None for all the tables in DATA_FILES
+    :param mode: "copy" to stream each file through COPY, "row" to run one INSERT per line
+    :param workers: Number of worker processes
+    :param chunk_size: Size in bytes above which a file is split into ranges
+    :param suffix: Suffix of the tables to load into, for example STAGING_SUFFIX for the staging copies
+    :param timings: Dictionary the worker seconds spent on each table are written to, None to not record them
+    :return: Dictionary of the number of rows loaded into each table, empty if any table failed to load
+    """
+    if ENCODE_IDENTIFIERS:
+        # Workers would hand out the same keys to different ids
+        print("\nIdentifier encoding assigns the keys in one process, loading the tables one after another.")
+        return insert_data_from_files(mode, suffix, timings)
+
+    start_time = time.time()
+    spool_dir = tempfile.mkdtemp(dir=PARTITION_SPOOL_DIR)
+
+    # Build the list of (size, table, file, start, end) pieces of work
+    jobs = []
+    for table_name in table_names or DATA_FILES:
+        if PARTITION_GRANULARITY and table_name == PARTITIONED_TABLE:
+            # Every partition file is its own piece of work, so the partitions load in parallel
+            filenames = route_rows_to_partitions(table_name, suffix, spool_dir)
+        else:
+            filenames = [find_data_file(table_name)]
+
+        for filename in filenames:
+            file_size = os.path.getsize(filename)
+
+            # Byte ranges of a compressed file cannot be read independently, so it is loaded as one piece
+            if file_size > chunk_size and not is_compressed(filename):
+                jobs.extend((end - start, table_name, filename, start, end)
+                            for start, end in compute_file_chunks(filename, chunk_size))
+            else:
+                jobs.append((file_size, table_name, filename, 0, None))
+
+    jobs.sort(reverse=True, key=lambda job: job[0])
+
+    loaded_rows = {}
+    failed_tables = set()
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = {executor.submit(load_table_worker, table_name, mode, start, end, suffix, filename): table_name
+                   for _, table_name, filename, start, end in jobs}
+
+        for future in as_completed(futures):
+            table_name = futures[future]
+            try:
+                _, rows, load_time = future.result()
+                loaded_rows[table_name] = loaded_rows.get(table_name, 0) + rows
+                if timings is not None:
+                    timings[table_name] = timings.get(table_name, 0) + load_time
+            except Exception as e:
+                failed_tables.add(table_name + suffix)
+                print(f"Error occurred while loading {table_name}: {e}")
+
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    check_parallel_load(sorted(table_name + suffix for table_name in loaded_rows), sorted(failed_tables))
+
+    print(f"\nParallel load finished in {time.time() - start_time:.2f} seconds.")
+
+    return {} if failed_tables else loaded_rows
+
+
+def create_checkpoint_table() -> None:
+    """
+    Create a new, empty checkpoint table for the resumable load
+    :return: None
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {CHECKPOINT_TABLE}")
+        cur.execute(f"""CREATE TABLE {CHECKPOINT_TABLE} (
+            table_name varchar(255) NOT NULL,
+            byte_offset bigint NOT NULL,
+            row_count bigint NOT NULL,
+            completed boolean NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name)
+        )""")
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error while creating the checkpoint table: {e}")
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def has_checkpoints() -> bool:
+    """
+    Check if an earlier resumable load left checkpoints behind
+    :return: True if the checkpoint table exists and has at least one checkpoint
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        if CHECKPOINT_TABLE not in pipeline_db.schema_catalog.get_table_names(cur):
+            return False
+
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {CHECKPOINT_TABLE})")
+        return cur.fetchone()[0]
+
+    finally:
+        cur.close()
+        conn.close()
+
+
+def get_checkpoint(cur, table_name) -> tuple:
+    """
+    Get the last committed checkpoint of a table
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table
+    :return: Tuple containing the byte offset, the row count and if the table is completed
+    """
+    cur.execute(f"SELECT byte_offset, row_count, completed FROM {CHECKPOINT_TABLE} WHERE table_name = %s",
+                (table_name,))
+    checkpoint = cur.fetchone()
+
+    return checkpoint if checkpoint is not None else (0, 0, False)
 
-        # Format the adjusted time including milliseconds
-        adjusted_time = f'{adjusted_hours:02}:{adjusted_minutes:02}:{adjusted_seconds:02}.{milliseconds:06}'
 
-        return adjusted_time
-    else:
-        return time_str
+def save_checkpoint(cur, table_name, byte_offset, row_count, completed) -> None:
+    """
+    Record the progress of a table, in the same transaction as the rows it covers
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table
+    :param byte_offset: Byte offset in the data file up to which the rows are loaded
+    :param row_count: The number of rows loaded so far
+    :param completed: If the whole file is loaded
+    :return: None
+    """
+    cur.execute(f"INSERT INTO {CHECKPOINT_TABLE} (table_name, byte_offset, row_count, completed) "
+                f"VALUES (%s, %s, %s, %s) "
+                f"ON CONFLICT (table_name) DO UPDATE SET byte_offset = EXCLUDED.byte_offset, "
+                f"row_count = EXCLUDED.row_count, completed = EXCLUDED.completed, updated_at = now()",
+                (table_name, byte_offset, row_count, completed))
+
+    return None
 
 
-def insert_data_from_files() -> None:
+def load_table_resumable(conn, table_name, mode, batch_rows, quarantine=QUARANTINE_BAD_ROWS) -> int:
     """
-    Insert data from text files into corresponding tables in a PostgreSQL database.
-    Returns: None
+    Load the data file of a table in batches, committing each batch together with its checkpoint.
+    Loading continues from the last committed checkpoint of the table.
+    :param conn: Connection to the Postgres Database
+    :param table_name: Name of the table, the data file is named after it
+    :param mode: "copy" to stream the batches through COPY, "row" to run one INSERT per line
+    :param batch_rows: The number of lines loaded and committed in each batch
+    :param quarantine: Move bad lines to the rejects file of the table instead of failing the load
+    :return: The number of rows loaded in this run
     """
-    # Connect to the database
-    conn = connect_to_db()
     cur = conn.cursor()
+    filename = find_data_file(table_name)
 
     try:
-        # Get list of text files in current directory
-        data_files = [
-            "agency",
-            "arrival_time",
-            "calendar",
-            "calendar_dates",
-            "real_time_data_temp",
-            "routes",
-            "shapes",
-            "stop_times",
-            "stops",
-            "trips"
-        ]
+        byte_offset, row_count, completed = get_checkpoint(cur, table_name)
+        print("\n======================================================\n")
+        if completed:
+            print(f"Table {table_name} was already loaded with {row_count} rows, skipping.")
+            return 0
+
+        print(f"Loading data from {table_name} into table {table_name} from byte {byte_offset} "
+              f"({row_count} rows already loaded)")
+
+        columns, data_types = get_table_columns(cur, table_name)
+
+        # Partitions are created batch by batch, so the rows do not all land in the default partition
+        partitioned = PARTITION_GRANULARITY and table_name == PARTITIONED_TABLE
+        partition_index = columns.index(PARTITION_COLUMN) if partitioned else None
+        partition_keys = set()
+
+        start_time = time.time()
+        rows = 0
+        for lines, byte_offset in read_line_batches(filename, byte_offset, batch_rows):
+            if partitioned:
+                keys = {get_partition_key(values[partition_index], PARTITION_GRANULARITY)
+                        for values in (line.split('\t') for line in lines) if len(values) > partition_index}
+                keys -= partition_keys | {None}
+                create_partitions(cur, table_name, keys, PARTITION_GRANULARITY)
+                partition_keys |= keys
+
+            rejects = []
+            if quarantine:
+                lines = screen_lines(lines, columns, data_types, rejects)
+                rows += load_batch_isolated(cur, table_name, lines, columns, data_types, mode, rejects)
+            else:
+                rows += load_lines(cur, table_name, iter(lines), columns, data_types, mode)
+
+            if ENCODE_IDENTIFIERS:
+                identifier_encoder.flush(cur)
+            save_checkpoint(cur, table_name, byte_offset, row_count + rows, False)
+            conn.commit()
+
+            # Rejects are only written once their batch is committed so a resumed load does not repeat them
+            write_rejects(table_name, rejects)
+
+        save_checkpoint(cur, table_name, byte_offset, row_count + rows, True)
+        conn.commit()
 
-        # Iterate over each file
-        for filename in data_files:
-            table_name = filename
-            print("\n======================================================\n")
-            print(f"Loading data from {filename} into table {table_name}")
-            filename = filename + ".text"
-
-            # Get column names for the table from the database schema
-            cur.execute(f"SELECT column_name, data_type FROM information_schema.columns "
-                        f"WHERE table_name = '{table_name}' ORDER BY ordinal_position")
-            columns_info = cur.fetchall()
-            columns = [row[0] for row in columns_info]
-            data_types = {row[0]: row[1] for row in columns_info}
-            # print(data_types)
-
-            # Construct the INSERT statement dynamically based on column names
-            placeholders = ', '.join(['%s' for _ in range(len(columns))])
-            sql_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
-
-            # Open the file and read data line by line
-            with open(filename, "r") as file:
-                for line in file:
-                    values = line.strip().split('\t')  # Assuming tab-separated values
-                    i: int
-
-                    # Adjust time values if the column is detected as a time column
-                    for i, column in enumerate(columns):
-                        if data_types[column] == 'time without time zone':
-                            values[i] = adjust_time(values[i])
-
-                    # Replace 'NULL' values with None
-                    for i in range(len(values)):
-                        if values[i] == 'NULL':
-                            values[i] = None
-                    cur.execute(sql_query, values)
-
-                print(f"Data inserted into {table_name} table.")
+        print_load_rate(table_name, rows, time.time() - start_time)
 
-        # Commit the transaction
+    finally:
+        cur.close()
+
+    return rows
+
+
+def insert_data_resumable(mode=LOAD_MODE, batch_rows=CHECKPOINT_BATCH_ROWS, timings=None) -> dict:
+    """
+    Insert data from text files into their tables with checkpointed batches.
+    If the load stops on an error, only the current batch is rolled back and
+    the next run continues from the last committed batch. Once every table is
+    loaded the checkpoints are cleared.
+    :param mode: "copy" to stream the batches through COPY, "row" to run one INSERT per line
+    :param batch_rows: The number of lines loaded and committed in each batch
+    :param timings: Dictionary the seconds taken to load each table are written to, None to not record them
+    :return: Dictionary of the number of rows loaded into each table in this run, empty if the load failed
+    """
+    conn = connect_to_db()
+    loaded_rows = {}
+
+    try:
+        if ENCODE_IDENTIFIERS:
+            # Keys assigned by the committed batches of an earlier run are read back
+            cur = conn.cursor()
+            identifier_encoder.load(cur)
+            cur.close()
+
+        for table_name in DATA_FILES:
+            start_time = time.time()
+            loaded_rows[table_name] = load_table_resumable(conn, table_name, mode, batch_rows)
+            if timings is not None:
+                timings[table_name] = time.time() - start_time
+
+        # The load is complete, so the next resumable load starts over instead of skipping every table
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM {CHECKPOINT_TABLE}")
+        cur.close()
         conn.commit()
+
         print("\n======================================================\n")
-        print("All data inserted successfully.")
+        print("All data inserted successfully, cleared the checkpoints.")
 
     except Exception as e:
-        # Rollback the transaction in case of an error
+        # Only the uncommitted batch is lost, the checkpoints keep the rest
         conn.rollback()
+        loaded_rows = {}
         print(f"Error occurred: {e}")
+        print("Run the load again to continue from the last committed batch.")
 
     finally:
-        # Close the cursor and connection
-        cur.close()
         conn.close()
 
+    return loaded_rows
+
+
+def get_table_definition(table_name) -> str:
+    """
+    Get the columns of a table as they are created, with the identifiers as integer keys when they are encoded
+    and the time columns as integer seconds when TIME_STORAGE is "seconds"
+    :param table_name: Name of the table
+    :return: The column definitions of the table
+    """
+    columns = TABLE_DEFINITIONS[table_name]
+    if ENCODE_IDENTIFIERS:
+        columns = IDENTIFIER_TYPE_PATTERN.sub(r'\1 int', columns)
+    if TIME_STORAGE == "seconds":
+        columns = TIME_TYPE_PATTERN.sub(r'\1 int', columns)
+
+    return columns
+
+
+def create_time_views(cur) -> None:
+    """
+    Create a view for every table with time columns stored as seconds, showing them in the time form.
+    Times past 24:00:00 are wrapped into the same day like adjust_time does, and the other columns are unchanged.
+    :param cur: Cursor of the Postgres connection
+    :return: None
+    """
+    for table_name in TABLE_DEFINITIONS:
+        if not TIME_TYPE_PATTERN.search(TABLE_DEFINITIONS[table_name]):
+            continue
+
+        columns, _ = get_defined_columns(table_name)
+        select_list = ', '.join(f"(({column} % 86400) * interval '1 second')::time AS {column}"
+                                if column in TIME_COLUMNS else column for column in columns)
+        cur.execute(f"CREATE OR REPLACE VIEW {table_name}{TIME_VIEW_SUFFIX} AS SELECT {select_list} FROM {table_name}")
+
+    return None
+
+
+def drop_time_views(cur) -> None:
+    """
+    Drop the time views, which would otherwise keep their tables from being dropped
+    :param cur: Cursor of the Postgres connection
+    :return: None
+    """
+    for table_name in TABLE_DEFINITIONS:
+        if TIME_TYPE_PATTERN.search(TABLE_DEFINITIONS[table_name]):
+            cur.execute(f"DROP VIEW IF EXISTS {table_name}{TIME_VIEW_SUFFIX}")
+
     return None
 
 
-def create_tables() -> None:
+def create_tables(with_constraints=True, suffix="", unlogged=False) -> None:
     """
     Function to create all the necessary tables in the database
+    :param with_constraints: Add the primary keys right away, False to add them after the load
+    :param suffix: Suffix added to every table name, for example STAGING_SUFFIX for the staging copies
+    :param unlogged: Create UNLOGGED tables that skip the WAL
     :return: None
     """
 
@@ -175,130 +2060,33 @@ def create_tables() -> None:
 
     try:
 
-        # Define SQL statements to create each table
-        sql_queries = [
-            """CREATE TABLE agency (
-                agency_id varchar(255) NOT NULL,
-                agency_name varchar(255),
-                agency_url varchar(255),
-                agency_timezone varchar(255),
-                agency_lang varchar(255),
-                agency_phone varchar(255),
-                PRIMARY KEY (agency_id)
-            )""",
-            """CREATE TABLE arrival_time (
-                time_span TIMESTAMP WITH TIME ZONE NOT NULL,
-                all_count int NULL,
-                late_count int NULL,
-                PRIMARY KEY (time_span)
-            )""",
-            """CREATE TABLE calendar (
-                service_id varchar(255) NOT NULL,
-                monday boolean NULL,
-                tuesday boolean NULL,
-                wednesday boolean NULL,
-                thursday boolean NULL,
-                friday boolean NULL,
-                saturday boolean NULL,
-                sunday boolean NULL,
-                start_date date NULL,
-                end_date date NULL,
-                PRIMARY KEY (service_id)
-            )""",
-            """CREATE TABLE calendar_dates (
-                service_id varchar(255) NOT NULL,
-                date date NOT NULL,
-                exception_type int NULL,
-                PRIMARY KEY (service_id, date)
-            )""",
-            """CREATE TABLE real_time_data_temp (
-                route_id varchar(255) NULL,
-                direction varchar(255) NULL,
-                trip_id varchar(255) NULL,
-                agency_id varchar(255) NULL,
-                origin_stop varchar(255) NULL,
-                lat float NULL,
-                lon float NULL,
-                bearing float NULL,
-                vehicle_id varchar(255) NOT NULL,
-                aimed_arrival_time TIMESTAMP WITH TIME ZONE NULL,
-                distance_from_origin float NULL,
-                presentable_distance float NULL,
-                distance_from_next_stop varchar(255) NULL,
-                next_stop varchar(255) NULL,
-                recorded_time TIMESTAMP WITH TIME ZONE NOT NULL,
-                PRIMARY KEY (recorded_time, vehicle_id)
-            )""",
-            """CREATE TABLE routes (
-                route_id varchar(255) NOT NULL,
-                agency_id varchar(255),
-                route_short_name varchar(255),
-                route_long_name varchar(255),
-                route_desc varchar(255),
-                route_type int NULL,
-                route_color varchar(255),
-                route_text_color varchar(255),
-                PRIMARY KEY (route_id)
-            )""",
-            """CREATE TABLE shapes (
-                shape_id varchar(255) NOT NULL,
-                shape_pt_lat float NULL,
-                shape_pt_lon float NULL,
-                shape_pt_sequence int NOT NULL,
-                PRIMARY KEY (shape_id, shape_pt_sequence)
-            )""",
-            # """CREATE TABLE split_shape (
-            #     route_id varchar(255) NOT NULL,
-            #     shape_id varchar(255) NOT NULL,
-            #     split_id int NOT NULL,
-            #     pt_id int NOT NULL,
-            #     lat float NOT NULL,
-            #     lon float NOT NULL,
-            #     PRIMARY KEY (shape_id, split_id, pt_id)
-            # )""",
-            # """CREATE TABLE split_shape_speed (
-            #     route_id varchar(255) NOT NULL,
-            #     shape_id varchar(255) NOT NULL,
-            #     split_id int NOT NULL,
-            #     speed float NOT NULL,
-            #     PRIMARY KEY (shape_id, split_id)
-            # )""",
-            """CREATE TABLE stop_times (
-                trip_id varchar(255) NOT NULL,
-                arrival_time time NULL,
-                departure_time time NULL,
-                stop_id varchar(255) NOT NULL,
-                stop_sequence int NOT NULL,
-                pickup_type int NULL,
-                drop_off_type int NULL,
-                PRIMARY KEY (trip_id, stop_id)
-            )""",
-            """CREATE TABLE stops (
-                stop_id varchar(255) NOT NULL,
-                stop_name varchar(255) NULL,
-                stop_desc varchar(255) NULL,
-                stop_lat float NULL,
-                stop_lon float NULL,
-                zone_id varchar(255) NULL,
-                stop_url varchar(255) NULL,
-                location_type varchar(255) NULL,
-                parent_station varchar(255) NULL,
-                PRIMARY KEY (stop_id)
-            )""",
-            """CREATE TABLE trips (
-                route_id varchar(255) NOT NULL,
-                service_id varchar(255) NULL,
-                trip_id varchar(255) NOT NULL,
-                trip_headsign varchar(255) NULL,
-                direction_id varchar(255) NULL,
-                shape_id varchar(255) NULL,
-                PRIMARY KEY (trip_id)
-            )""",
-        ]
-
-        # Execute each SQL statement to create the tables
-        for query in sql_queries:
-            cursor.execute(query)
+        # Execute the SQL statement to create each table
+        for table_name in TABLE_DEFINITIONS:
+            columns = get_table_definition(table_name)
+            if PARTITION_GRANULARITY and table_name == PARTITIONED_TABLE:
+                # Partitioned tables cannot be unlogged, only their partitions
+                cursor.execute(f"CREATE TABLE {table_name}{suffix} ({columns}) "
+                               f"PARTITION BY RANGE ({PARTITION_COLUMN})")
+                cursor.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {table_name}{suffix}_default "
+                               f"PARTITION OF {table_name}{suffix} DEFAULT")
+            else:
+                cursor.execute(f"CREATE {'UNLOGGED ' if unlogged else ''}TABLE {table_name}{suffix} ({columns})")
+
+            if with_constraints:
+                cursor.execute(f"ALTER TABLE {table_name}{suffix} ADD PRIMARY KEY ({PRIMARY_KEYS[table_name]})")
+
+        if ENCODE_IDENTIFIERS:
+            # The lookup tables are shared by every load, so the keys stay the same across reloads
+            for entity in sorted(set(IDENTIFIER_COLUMNS.values())):
+                cursor.execute(f"""CREATE TABLE IF NOT EXISTS {entity}_keys (
+                    {entity}_key int NOT NULL,
+                    {entity}_id varchar(255) NOT NULL UNIQUE,
+                    PRIMARY KEY ({entity}_key)
+                )""")
+
+        # The staging copies get their views when they are swapped in
+        if TIME_STORAGE == "seconds" and not suffix:
+            create_time_views(cursor)
 
         # Commit the transaction
         connection.commit()
@@ -313,54 +2101,497 @@ def create_tables() -> None:
     return None
 
 
-def create_table_load_data() -> None:
+def build_table_constraints(table_name, memory, suffix="") -> list:
+    """
+    Build the primary key and the indexes of one table on its own connection
+    :param table_name: Name of the table
+    :param memory: Value of maintenance_work_mem for the builds, for example "1GB"
+    :param suffix: Suffix of the table and its index names, for example STAGING_SUFFIX for the staging copy
+    :return: List of (statement, time taken) tuples for the builds of the table
+    """
+    conn = connect_to_db()
+    conn.autocommit = True
+    cur = conn.cursor()
+    timings = []
+
+    try:
+        cur.execute("SET maintenance_work_mem = %s", (memory,))
+
+        statements = [f"ALTER TABLE {table_name}{suffix} ADD PRIMARY KEY ({PRIMARY_KEYS[table_name]})"]
+        statements.extend(f"CREATE INDEX IF NOT EXISTS {index_name}{suffix} ON {table_name}{suffix}({columns})"
+                          for index_name, columns in INDEX_DEFINITIONS.get(table_name, []))
+
+        # The primary key locks the whole table, so the builds of one table run one after another
+        for statement in statements:
+            start_time = time.time()
+            cur.execute(statement)
+            timings.append((statement, time.time() - start_time))
+            print(f"{statement}: {timings[-1][1]:.2f} seconds")
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return timings
+
+
+def build_constraints_and_indexes(workers=INDEX_BUILD_WORKERS, memory=INDEX_BUILD_MEMORY, suffix="") -> None:
+    """
+    Build the primary keys and indexes after the load of the fast build. The tables are
+    handled in parallel, each on its own connection.
+    Duplicate keys that slipped in without the primary keys show up here as a failed build.
+    :param workers: Number of tables built at the same time
+    :param memory: Value of maintenance_work_mem for each build, for example "1GB"
+    :param suffix: Suffix of the tables to build on, for example STAGING_SUFFIX for the staging copies
+    :return: None
+    """
+    print("\n======================================================\n")
+    print("Building primary keys and indexes...")
+    start_time = time.time()
+
+    # Start with the largest tables so they do not finish last
+    conn = connect_to_db()
+    cur = conn.cursor()
+    cur.execute("SELECT relname FROM pg_class WHERE relname = ANY(%s) ORDER BY pg_relation_size(oid) DESC",
+                ([table_name + suffix for table_name in PRIMARY_KEYS],))
+    table_names = [row[0][:len(row[0]) - len(suffix)] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_table_constraints, table_name, memory, suffix): table_name
+                   for table_name in table_names}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except psycopg2.Error as e:
+                print(f"Error while building the keys of {futures[future]}: {e}")
+
+    print(f"\nPrimary keys and indexes built in {time.time() - start_time:.2f} seconds.")
+
+    return None
+
+
+def drop_staging_tables(suffix=STAGING_SUFFIX) -> None:
+    """
+    Drop the staging copies of the tables left behind by an earlier reload
+    :param suffix: Suffix of the staging tables
+    :return: None
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {', '.join(table_name + suffix for table_name in TABLE_DEFINITIONS)}")
+        conn.commit()
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def validate_staging_tables(loaded_rows, suffix=STAGING_SUFFIX) -> bool:
+    """
+    Check that every staging table holds exactly the rows the loader reported for it
+    :param loaded_rows: Dictionary of the number of rows loaded into each table
+    :param suffix: Suffix of the staging tables
+    :return: True if every table was loaded and the row counts match
+    """
+    print("\n======================================================\n")
+    print("Validating staging tables...")
+
+    conn = connect_to_db()
+    cur = conn.cursor()
+    valid = True
+
+    try:
+        for table_name in DATA_FILES:
+            if table_name not in loaded_rows:
+                print(f"Table {table_name} was not loaded.")
+                valid = False
+                continue
+
+            cur.execute(f"SELECT COUNT(*) FROM {table_name}{suffix}")
+            rows_count = cur.fetchone()[0]
+            if rows_count != loaded_rows[table_name]:
+                print(f"Table {table_name}{suffix} has {rows_count} rows, expected {loaded_rows[table_name]}.")
+                valid = False
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return valid
+
+
+def swap_in_staging_tables(suffix=STAGING_SUFFIX) -> None:
+    """
+    Switch the staging tables to LOGGED and swap them in for the live tables.
+    All the renames happen in one transaction, so readers see either the old
+    tables or the new ones and never a half-loaded table.
+    :param suffix: Suffix of the staging tables
+    :return: None
+    """
+    print("\n======================================================\n")
+    print("Swapping in staging tables...")
+
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        # Writing the data to the WAL happens here, once per table, instead of once per row
+        conn.autocommit = True
+        partitions = {}
+        for table_name in TABLE_DEFINITIONS:
+            # A partitioned table holds no data itself, its partitions are switched instead
+            cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass",
+                        (table_name + suffix,))
+            partitions[table_name] = [row[0] for row in cur.fetchall()]
+
+            for logged_table in partitions[table_name] or [table_name + suffix]:
+                start_time = time.time()
+                cur.execute(f"ALTER TABLE {logged_table} SET LOGGED")
+                print(f"Table {logged_table} set to LOGGED in {time.time() - start_time:.2f} seconds.")
+
+        conn.autocommit = False
+        drop_time_views(cur)
+        for table_name in TABLE_DEFINITIONS:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+            cur.execute(f"ALTER TABLE {table_name}{suffix} RENAME TO {table_name}")
+            for partition_name in partitions[table_name]:
+                cur.execute(f"ALTER TABLE {partition_name} RENAME TO "
+                            f"{partition_name.replace(table_name + suffix, table_name, 1)}")
+            cur.execute(f"ALTER INDEX IF EXISTS {table_name}{suffix}_pkey RENAME TO {table_name}_pkey")
+            for index_name, _ in INDEX_DEFINITIONS.get(table_name, []):
+                cur.execute(f"ALTER INDEX IF EXISTS {index_name}{suffix} RENAME TO {index_name}")
+
+        if TIME_STORAGE == "seconds":
+            create_time_views(cur)
+
+        conn.commit()
+        print("Staging tables swapped in successfully.")
+
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error while swapping in staging tables: {e}")
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
+def reload_with_staging(timings=None) -> dict:
+    """
+    Full reload through UNLOGGED staging copies of the tables. The live tables keep
+    serving queries during the whole load and are only replaced once the staging
+    copies are loaded and validated.
+    :param timings: Dictionary the seconds taken to load each table are written to, None to not record them
+    :return: Dictionary of the number of rows loaded into each table, empty if the load failed or was not swapped in
+    """
+    drop_staging_tables()
+    create_tables(with_constraints=not FAST_BUILD, suffix=STAGING_SUFFIX, unlogged=True)
+
+    if PARALLEL_LOAD:
+        loaded_rows = load_tables_in_parallel(mode=LOAD_MODE, suffix=STAGING_SUFFIX, timings=timings)
+    else:
+        loaded_rows = insert_data_from_files(LOAD_MODE, suffix=STAGING_SUFFIX, timings=timings)
+
+    if FAST_BUILD:
+        build_constraints_and_indexes(suffix=STAGING_SUFFIX)
+
+    if validate_staging_tables(loaded_rows):
+        swap_in_staging_tables()
+    else:
+        print("Staging tables failed validation, the live tables were left untouched.")
+        loaded_rows = {}
+
+    return loaded_rows
+
+
+def get_high_water_mark(cur, table_name, time_column):
+    """
+    Get the stored high-water mark of a table. The first incremental ingest
+    starts from the newest row already in the table.
+    :param cur: Cursor of the Postgres connection
+    :param table_name: Name of the table
+    :param time_column: Column the high-water mark is taken from
+    :return: The high-water mark, or None if the table is empty
+    """
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        table_name varchar(255) NOT NULL,
+        high_water_mark TIMESTAMP WITH TIME ZONE NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+        PRIMARY KEY (table_name)
+    )""")
+
+    cur.execute(f"SELECT high_water_mark FROM {WATERMARK_TABLE} WHERE table_name = %s", (table_name,))
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+
+    cur.execute(f"SELECT MAX({time_column}) FROM {table_name}")
+    return cur.fetchone()[0]
+
+
+def ingest_delta_file(conn, filename, table_name=DELTA_TABLE, time_column=DELTA_TIME_COLUMN,
+                      mode=LOAD_MODE) -> int:
+    """
+    Load one file of new observations into a table. Only rows newer than the high-water mark
+    are upserted, and the high-water mark moves forward in the same transaction.
+    :param conn: Connection to the Postgres Database
+    :param filename: Name of the data file with the new observations
+    :param table_name: Name of the table to ingest into
+    :param time_column: Column the high-water mark is taken from
+    :param mode: "copy" to stream the file through COPY, "row" to run one INSERT per line
+    :return: The number of rows upserted
+    """
+    cur = conn.cursor()
+    delta_table = table_name + "_delta"
+
+    try:
+        print("\n======================================================\n")
+        print(f"Ingesting new data from {filename} into table {table_name}")
+        start_time = time.time()
+
+        if ENCODE_IDENTIFIERS:
+            identifier_encoder.load(cur)
+
+        high_water_mark = get_high_water_mark(cur, table_name, time_column)
+        print(f"High-water mark of {table_name}: {high_water_mark}")
+
+        # Stage the whole file in a temporary table, then move only the new rows over
+        cur.execute(f"CREATE TEMP TABLE {delta_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP")
+        columns, data_types = get_table_columns(cur, table_name)
+        staged = load_lines(cur, delta_table, read_file_lines(filename), columns, data_types, mode)
+
+        if PARTITION_GRANULARITY and table_name == PARTITIONED_TABLE:
+            # New days or months need their partitions before the rows arrive
+            key_format = 'YYYY-MM-DD' if PARTITION_GRANULARITY == "day" else 'YYYY-MM'
+            cur.execute(f"SELECT DISTINCT to_char({PARTITION_COLUMN} AT TIME ZONE 'UTC', %(format)s) "
+                        f"FROM {delta_table} "
+                        f"WHERE %(mark)s::timestamptz IS NULL OR {PARTITION_COLUMN} > %(mark)s",
+                        {"format": key_format, "mark": high_water_mark})
+            create_partitions(cur, table_name, [row[0] for row in cur.fetchall()], PARTITION_GRANULARITY)
+
+        key_columns = [column.strip() for column in PRIMARY_KEYS[table_name].split(',')]
+        column_list = ', '.join(columns)
+        updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key_columns)
+
+        # DISTINCT ON keeps a key that appears twice in the file from being updated twice by one statement
+        cur.execute(f"INSERT INTO {table_name} ({column_list}) "
+                    f"SELECT DISTINCT ON ({PRIMARY_KEYS[table_name]}) {column_list} FROM {delta_table} "
+                    f"WHERE %(mark)s::timestamptz IS NULL OR {time_column} > %(mark)s "
+                    f"ORDER BY {PRIMARY_KEYS[table_name]} "
+                    f"ON CONFLICT ({PRIMARY_KEYS[table_name]}) DO UPDATE SET {updates}",
+                    {"mark": high_water_mark})
+        upserted = cur.rowcount
+
+        cur.execute(f"INSERT INTO {WATERMARK_TABLE} (table_name, high_water_mark) "
+                    f"SELECT %s, MAX({time_column}) FROM {delta_table} HAVING MAX({time_column}) IS NOT NULL "
+                    f"ON CONFLICT (table_name) DO UPDATE SET "
+                    f"high_water_mark = GREATEST({WATERMARK_TABLE}.high_water_mark, EXCLUDED.high_water_mark), "
+                    f"updated_at = now()",
+                    (table_name,))
+        if ENCODE_IDENTIFIERS:
+            identifier_encoder.flush(cur)
+        conn.commit()
+
+        print(f"Read {staged} rows, skipped {staged - upserted} rows at or before the high-water mark.")
+        print_load_rate(table_name, upserted, time.time() - start_time)
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cur.close()
+
+    return upserted
+
+
+def ingest_real_time_delta(filenames=None) -> None:
+    """
+    Incrementally ingest new real-time observation files into real_time_data_temp.
+    The static GTFS tables are left untouched, and each file is its own transaction.
+    :param filenames: List of data files with new observations, None for DELTA_FILES
+    :return: None
+    """
+    conn = connect_to_db()
+
+    try:
+        for filename in filenames or DELTA_FILES:
+            ingest_delta_file(conn, filename)
+
+        print("\n======================================================\n")
+        print("All new data ingested successfully.")
+
+    except Exception as e:
+        print(f"Error occurred: {e}")
+
+    finally:
+        conn.close()
+
+    return None
+
+
+def create_table_load_data(timings=None) -> dict:
     """
     This function calls the necessary function for Q1.
     We create tables, load them, delete unnecessary data and add constraints.
     All of this is done in this function by calling different functions.
-    :return: None
+    The loader settings are read when it is called, so Benchmark NY Bus Loader.py can change them.
+    :param timings: Dictionary the seconds taken to load each table are written to, None to not record them
+    :return: Dictionary of the number of rows loaded into each table, empty if the load failed
+             or only ingested new observations
     """
+    loaded_rows = {}
+
+    if DELTA_INGEST:
+        # Only add the new real-time observations to the existing tables
+        ingest_real_time_delta()
+    elif STAGING_RELOAD:
+        # Load into staging copies and swap them in, the live tables stay readable
+        loaded_rows = reload_with_staging(timings)
+    elif RESUMABLE_LOAD:
+        # Continue an earlier resumable load instead of starting over
+        if has_checkpoints():
+            print("\nFound checkpoints of an earlier load, resuming it.")
+        else:
+            create_tables(with_constraints=not FAST_BUILD)
+            create_checkpoint_table()
+
+        loaded_rows = insert_data_resumable(LOAD_MODE, timings=timings)
+
+        if FAST_BUILD:
+            build_constraints_and_indexes()
+    else:
+        # Call function create tables
+        create_tables(with_constraints=not FAST_BUILD)
 
-    # Call function create tables
-    create_tables()
+        # Call function to load tables
+        if PARALLEL_LOAD:
+            loaded_rows = load_tables_in_parallel(mode=LOAD_MODE, timings=timings)
+        else:
+            loaded_rows = insert_data_from_files(LOAD_MODE, timings=timings)
 
-    # Call function to load tables
-    insert_data_from_files()
+        if FAST_BUILD:
+            build_constraints_and_indexes()
+
+    if PARTITION_GRANULARITY and DETACH_PARTITIONS_BEFORE:
+        # Old observations leave the partitioned table without deleting their rows
+        detach_partitions_before(DETACH_PARTITIONS_BEFORE, drop=DROP_DETACHED_PARTITIONS)
 
     # Count total rows in each table
     count_total_rows()
 
-    return None
+    return loaded_rows
+
+
+def format_size(size) -> str:
+    """
+    Format a size in bytes for the console
+    :param size: Size in bytes
+    :return: The size with a unit, for example '1.5 GB'
+    """
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+
+    return f"{size:.1f} TB"
+
+
+def get_table_statistics(cur) -> list:
+    """
+    Get the estimated row counts and on-disk sizes of all the tables from the statistics.
+    A partitioned table is reported once with the totals of its partitions.
+    :param cur: Cursor of the Postgres connection
+    :return: List of (table name, estimated rows, live rows, heap bytes, index bytes, toast bytes) tuples
+    """
+    cur.execute("""
+        SELECT c.relname,
+               SUM(GREATEST(l.reltuples, 0))::bigint,
+               SUM(COALESCE(s.n_live_tup, 0))::bigint,
+               SUM(pg_relation_size(l.oid))::bigint,
+               SUM(pg_indexes_size(l.oid))::bigint,
+               SUM(COALESCE(pg_total_relation_size(NULLIF(l.reltoastrelid, 0)), 0))::bigint
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL pg_partition_tree(c.oid) t
+        JOIN pg_class l ON l.oid = t.relid
+        LEFT JOIN pg_stat_user_tables s ON s.relid = l.oid
+        WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition AND t.isleaf
+        GROUP BY c.relname
+        ORDER BY c.relname
+    """)
+
+    return cur.fetchall()
+
+
+def count_table_rows(table_name) -> tuple:
+    """
+    Count the rows of one table exactly on its own connection
+    :param table_name: Name of the table
+    :return: Tuple containing the table name and its number of rows
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(f"SELECT COUNT(*) FROM {table_name}")
+        return table_name, cur.fetchone()[0]
+
+    finally:
+        cur.close()
+        conn.close()
 
 
-def count_total_rows() -> None:
+def count_total_rows(exact=EXACT_ROW_COUNTS, workers=COUNT_WORKERS) -> None:
     """
-    This function counts the total number of rows in all the tables for a given database
+    This function reports the number of rows and the on-disk size of all the tables for a given database.
+    The row counts are estimates from the statistics, refreshed with ANALYZE, unless exact counts are asked for.
+    :param exact: Count the rows with COUNT(*), a full scan of every table, run on several connections
+    :param workers: Number of tables counted at the same time for the exact counts
     :return: None
     """
     # Connect to the PostgreSQL database
     conn = connect_to_db()
+    conn.autocommit = True
     cur = conn.cursor()
 
     print("\n======================================================\n")
     try:
-        # Get a list of all tables in the database
-        cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
-        tables = cur.fetchall()
+        # ANALYZE samples the tables, which is much cheaper than reading every row
+        start_time = time.time()
+        cur.execute("ANALYZE")
+        statistics = get_table_statistics(cur)
+        print(f"Statistics refreshed in {time.time() - start_time:.2f} seconds.\n")
+
+        exact_counts = {}
+        if exact:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                exact_counts = dict(executor.map(count_table_rows, [row[0] for row in statistics]))
 
         total_rows = 0
+        total_size = 0
 
-        # Iterate over each table and count the rows
-        for table in tables:
-            table_name = table[0]
-            cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-            rows_count = cur.fetchone()[0]
+        for table_name, estimated_rows, live_rows, heap_size, index_size, toast_size in statistics:
+            rows_count = exact_counts.get(table_name, estimated_rows)
             total_rows += rows_count
+            total_size += heap_size + index_size + toast_size
 
-            print(f"Table '{table_name}' has {rows_count} rows.")
+            print(f"Table '{table_name}' has {'' if exact else 'about '}{rows_count} rows "
+                  f"({live_rows} live rows in pg_stat_user_tables). Heap: {format_size(heap_size)}, "
+                  f"indexes: {format_size(index_size)}, toast: {format_size(toast_size)}")
 
         print("\n======================================================\n")
-        print(f"Total rows in all tables: {total_rows}")
+        print(f"Total rows in all tables: {'' if exact else 'about '}{total_rows}")
+        print(f"Total size of all tables: {format_size(total_size)}")
 
     except psycopg2.Error as e:
         print(f"Error: {e}")
@@ -373,12 +2604,178 @@ def count_total_rows() -> None:
     return None
 
 
+def get_defined_columns(table_name) -> tuple:
+    """
+    Get the column names and data types of a table from TABLE_DEFINITIONS, without a database
+    :param table_name: Name of the table
+    :return: Tuple containing the list of column names and the dictionary of column data types
+    """
+    columns = []
+    data_types = {}
+    for definition in get_table_definition(table_name).strip().split(',\n'):
+        column, sql_type = definition.split(None, 1)
+        sql_type = sql_type.lower().replace('not null', '').replace('null', '').strip()
+        columns.append(column)
+        data_types[column] = DEFINED_TYPE_NAMES.get(sql_type, sql_type)
+
+    return columns, data_types
+
+
+def benchmark_transform_plan(table_name=BENCHMARK_TABLE, max_lines=BENCHMARK_LINES) -> None:
+    """
+    Micro-benchmark of the line parsing of the loader, comparing the per-line column type
+    lookups of transform_values with the compiled TransformPlan. No database is needed.
+    :param table_name: Name of the table whose data file is parsed
+    :param max_lines: The number of lines of the file to parse
+    :return: None
+    """
+    print("\n======================================================\n")
+    filename = find_data_file(table_name)
+    print(f"Benchmarking the parsing of {max_lines} lines of {filename}...")
+
+    columns, data_types = get_defined_columns(table_name)
+    lines = []
+    end = 0
+    for line in read_file_lines(filename):
+        end += len(line.encode("utf-8"))
+        line = line.strip()
+        if line:
+            lines.append(line)
+        if len(lines) == max_lines:
+            break
+
+    start_time = time.time()
+    for line in lines:
+        values = transform_values(line.split('\t'), columns, data_types)
+        '\t'.join('\\N' if value is None else value.replace('\\', '\\\\') for value in values)
+    baseline_time = time.time() - start_time
+
+    start_time = time.time()
+    plan = TransformPlan(columns, data_types)
+    for line in lines:
+        plan.copy_line(line)
+    plan_time = time.time() - start_time
+
+    print(f"Per-line type lookups: {len(lines) / baseline_time:.0f} lines/sec")
+    print(f"Compiled transform plan: {len(lines) / plan_time:.0f} lines/sec")
+    print(f"Speedup: {baseline_time / plan_time:.2f}x")
+
+    if not is_compressed(filename):
+        # Reading the file is part of these two, the COPY data of the same lines is produced
+        # from the decoded lines of the file and from the raw bytes of a memory map
+        start_time = time.time()
+        stream = CopyStream(read_file_lines(filename, 0, end), columns, data_types)
+        while stream.read(COPY_BUFFER_SIZE):
+            pass
+        lines_time = time.time() - start_time
+
+        start_time = time.time()
+        stream = MappedCopyStream(filename, columns, data_types, 0, end)
+        while stream.read(COPY_BUFFER_SIZE):
+            pass
+        stream.close()
+        mapped_time = time.time() - start_time
+
+        print(f"Decoded lines read from the file: {stream.rows / lines_time:.0f} lines/sec")
+        print(f"Raw bytes read from a memory map: {stream.rows / mapped_time:.0f} lines/sec")
+        print(f"Speedup: {lines_time / mapped_time:.2f}x")
+
+    return None
+
+
+def benchmark_copy_formats(table_names=COPY_BENCHMARK_TABLES) -> None:
+    """
+    Compare text and binary COPY of the data files of tables that are mostly numbers and timestamps.
+    Each file is copied into an empty temporary copy of its table in both formats, and the time
+    the client spends producing the COPY data is measured on its own. The two copies are then
+    compared, a table is only safe to add to BINARY_COPY_TABLES if they hold the same rows.
+    :param table_names: List of the tables to compare, they must exist
+    :return: None
+    """
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    try:
+        for table_name in table_names:
+            print("\n======================================================\n")
+            filename = find_data_file(table_name)
+            print(f"Comparing text and binary COPY of {filename}...")
+
+            columns, data_types = get_table_columns(cur, table_name)
+            timezone = get_session_timezone(cur)
+
+            for copy_format in ("text", "binary"):
+                copy_table = f"{table_name}_copy_{copy_format}"
+                cur.execute(f"CREATE TEMP TABLE {copy_table} (LIKE {table_name})")
+
+                # The COPY data without a server, what the client costs
+                start_time = time.time()
+                if copy_format == "binary":
+                    stream = BinaryCopyStream(read_file_lines(filename), columns, data_types, timezone)
+                elif MMAP_READER and not is_compressed(filename):
+                    stream = MappedCopyStream(filename, columns, data_types)
+                else:
+                    stream = CopyStream(read_file_lines(filename), columns, data_types)
+                size = 0
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    size += len(data)
+                client_time = time.time() - start_time
+
+                start_time = time.time()
+                if copy_format == "binary":
+                    rows = binary_copy_rows(cur, copy_table, read_file_lines(filename), columns, data_types)
+                elif MMAP_READER and not is_compressed(filename):
+                    rows = copy_mapped_file(cur, copy_table, filename, columns, data_types)
+                else:
+                    rows = copy_rows(cur, copy_table, read_file_lines(filename), columns, data_types)
+                total_time = time.time() - start_time
+
+                print(f"{copy_format.capitalize()} COPY: {rows / total_time:.0f} rows/sec, "
+                      f"{size / (1 << 20):.1f} MB of COPY data, {client_time:.2f} seconds on the client "
+                      f"and {total_time:.2f} seconds in total")
+
+            # Rows in one copy and not the other, counting duplicates
+            text_table, binary_table = f"{table_name}_copy_text", f"{table_name}_copy_binary"
+            cur.execute(f"SELECT (SELECT count(*) FROM (SELECT * FROM {text_table} EXCEPT ALL "
+                        f"SELECT * FROM {binary_table}) missing) + (SELECT count(*) FROM (SELECT * FROM "
+                        f"{binary_table} EXCEPT ALL SELECT * FROM {text_table}) extra)")
+            differences = cur.fetchone()[0]
+            if differences:
+                print(f"{differences} rows differ between the text and binary COPY, "
+                      f"do not add {table_name} to BINARY_COPY_TABLES.")
+            else:
+                print("Text and binary COPY loaded the same rows.")
+
+            conn.rollback()
+
+    except (psycopg2.Error, ValueError) as e:
+        conn.rollback()
+        print(f"Error: {e}")
+
+    finally:
+        cur.close()
+        conn.close()
+
+    return None
+
+
 def main() -> None:
     """
     Main function of the code that calls the required functions in order.
     :return: None
     """
 
+    if RUN_TRANSFORM_BENCHMARK:
+        benchmark_transform_plan()
+        return None
+
+    if RUN_COPY_FORMAT_BENCHMARK:
+        benchmark_copy_formats()
+        return None
+
     start_time = time.time()
 
     # Call the function to create tables and load the data
@@ -391,9 +2788,9 @@ def main() -> None:
         f"Entire Database loaded successfully in: {total_total_time // 3600} Hours, {(total_total_time % 3600) // 60} "
         f"Minutes, and {(total_total_time % 3600) % 60} seconds.")
 
-    # Connect to and close the connection to the database, in case it was missed somewhere
-    conn = connect_to_db()
-    conn.close()
+    # Close the pooled connections, in case one was missed somewhere
+    pipeline_db.print_connection_stats()
+    pipeline_db.close_all_connections()
 
     return None
 
@@ -7,72 +7,936 @@ This code loads data from the text files that the user provides into the desired
 This code also creates the tables needed for this data.
 
 Steps to take before running this code:
-1. Enter your postgres project database connection details in the fields given in the code below
+1. Enter your postgres project and MongoDB connection details in pipeline.ini (see pipeline_db.py)
 2. Run the code
 
 In the console, a few details are printed on running the code:
 1. Confirmation that collections are created
-2. Confirmation that the data is inserted into the desired collection
-3. The result of queries before and after indexing
-4. The functional dependency search results
+2. Confirmation that the data is inserted into the desired collection, with the documents inserted per second
+   and the peak memory it added while loading
+3. The throughput of the read, build and write stages of each collection
+4. The result of queries before and after indexing
+5. The functional dependency search results
 
 """
 
 
+import itertools
+import pickle
+import os
+import queue
+import sys
+import tempfile
+import threading
 import time
+import bson
 import psycopg2
+from bson.raw_bson import RawBSONDocument
 from psycopg2 import Error
+from pymongo.errors import BulkWriteError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import combinations
-from pymongo import MongoClient
-
-# Postgres connection settings
-DB_NAME = "Project"
-DB_USER = "postgres"
-DB_PASSWORD = ""
-DB_HOST = "localhost"
-DB_PORT = ""
-
-# MongoDB's connection settings
-connection_url = ""
-mongo_db_name = ""
+import pipeline_db
+
+# Storage of the stop_times times, set in pipeline.ini for Load NY Bus Dataset.py and this code,
+# "time" or "seconds" for integer seconds since the start of the service day
+TIME_STORAGE = pipeline_db.SETTINGS["pipeline"]["time_storage"]
+# Identifiers stored as integer keys, set in pipeline.ini for Load NY Bus Dataset.py and this code.
+# The documents and the query results get the string ids back from the <entity>_keys lookup tables.
+ENCODE_IDENTIFIERS = pipeline_db.get_boolean_setting("pipeline", "encode_identifiers")
+# Documents sent to MongoDB in one insert_many, and the most bytes of documents buffered before they are sent,
+# set in pipeline.ini
+MONGO_BATCH_SIZE = int(pipeline_db.SETTINGS["mongodb"]["batch_size"])
+MONGO_MAX_BATCH_BYTES = int(pipeline_db.SETTINGS["mongodb"]["max_batch_bytes"])
+# Rows read from Postgres at a time by the server-side cursors of the migration
+FETCH_SIZE = 10000
+# Seconds between the samples of the memory used while loading a collection
+MEMORY_SAMPLE_INTERVAL = 0.05
+# Load Real_Time_Data, Arrival_Time and Trips from one scan of real_time_data_temp instead of three
+SHARED_REAL_TIME_SCAN = True
+# Rows a grouping of the shared scan keeps in memory before it spills them to disk, and the number of
+# spill files it hashes them into. Directory of the spill files, None for the system temporary directory.
+SPILL_MEMORY_ROWS = 1000000
+SPILL_PARTITIONS = 64
+SPILL_DIRECTORY = None
+# Load the collections in parallel threads, and run the Postgres reads, the document building and the
+# MongoDB writes of each collection in their own threads, handing batches on through bounded queues
+CONCURRENT_MIGRATION = False
+MIGRATION_WORKERS = 4
+# Rows handed from one stage to the next at a time, and the most batches waiting between two stages
+STAGE_BATCH_SIZE = 1000
+STAGE_QUEUE_SIZE = 8
+
+# Numbers the server-side cursors, whose names must be unique in a transaction
+cursor_numbers = itertools.count()
 
 
 def connect_to_db():
     """
-    Connect to the Postgres Database using the parameters defined above.
-    :return: connection to the Postgres Database
+    Connect to the Postgres Database using the settings of pipeline_db.py.
+    :return: connection to the Postgres Database, borrowed from the shared pool until it is closed
     """
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-    return conn
+    return pipeline_db.connect_to_db()
 
 
 def connect_to_mongodb():
     """
-    Connect to the MongoDB Database using the parameters defined above
+    Connect to the MongoDB Database using the settings of pipeline_db.py.
+    The client is shared by all the functions, so it is not closed after each collection.
     :return: Database connection to the MongoDB and Client
     """
     try:
-        client = MongoClient(connection_url)
-        db = client[mongo_db_name]
+        client = pipeline_db.get_mongo_client()
+        db = pipeline_db.get_mongo_database()
         return db, client
     except Exception as e:
         print("Error connecting to MongoDB:", e)
 
 
+class MongoBulkWriter:
+    """
+    Buffers the documents of a collection and inserts them with one unordered insert_many per batch,
+    instead of one round trip per document. A batch is sent when it has MONGO_BATCH_SIZE documents
+    or MONGO_MAX_BATCH_BYTES bytes of BSON, whichever comes first.
+    """
+
+    def __init__(self, collection, batch_size=MONGO_BATCH_SIZE, max_batch_bytes=MONGO_MAX_BATCH_BYTES):
+        """
+        :param collection: The MongoDB collection to insert into
+        :param batch_size: The most documents in one insert_many
+        :param max_batch_bytes: The most bytes of BSON buffered before the batch is sent
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.batch = []
+        self.batch_bytes = 0
+        self.inserted = 0
+        self.failed = 0
+        self.insert_time = 0.0
+        self.start_time = time.time()
+
+    def insert(self, document) -> None:
+        """
+        Add a document to the batch, sending the batch if it is full
+        :param document: The document as a dictionary
+        :return: None
+        """
+        # The document is encoded once here, the size is known and insert_many sends the bytes as they are
+        document = RawBSONDocument(bson.encode(document))
+        self.batch.append(document)
+        self.batch_bytes += len(document.raw)
+
+        if len(self.batch) >= self.batch_size or self.batch_bytes >= self.max_batch_bytes:
+            self.flush()
+
+        return None
+
+    def flush(self) -> None:
+        """
+        Insert the buffered documents. The batch is unordered, so a document that fails does
+        not stop the rest of the batch, and the failures are counted and reported.
+        :return: None
+        """
+        if not self.batch:
+            return None
+
+        start_time = time.time()
+        try:
+            # insert_many does not collect the ids of raw documents, so the batch itself is counted
+            self.collection.insert_many(self.batch, ordered=False)
+            self.inserted += len(self.batch)
+        except BulkWriteError as e:
+            self.inserted += e.details["nInserted"]
+            self.failed += len(e.details["writeErrors"])
+            print(f"Failed to insert {len(e.details['writeErrors'])} documents into {self.collection.name}: "
+                  f"{e.details['writeErrors'][0]['errmsg']}")
+        self.insert_time += time.time() - start_time
+
+        self.batch = []
+        self.batch_bytes = 0
+
+        return None
+
+    def close(self) -> int:
+        """
+        Insert what is left in the batch and print the insert rate of the collection
+        :return: The number of documents inserted
+        """
+        self.flush()
+
+        total_time = time.time() - self.start_time
+        print(f"\nInserted {self.inserted} documents into {self.collection.name} in {total_time:.2f} seconds "
+              f"({self.inserted / total_time if total_time else 0:.0f} docs/sec), "
+              f"{self.insert_time:.2f} seconds of it waiting on MongoDB")
+        if self.failed:
+            print(f"Failed to insert {self.failed} documents")
+
+        return self.inserted
+
+
+class IdentifierDecoder:
+    """
+    Turns the integer keys of the encoded identifier columns back into their string ids. The lookup
+    tables are read once, the first time a result with an identifier column is decoded.
+    """
+
+    def __init__(self):
+        self.ids = None
+        self.lock = threading.Lock()
+
+    def load(self) -> dict:
+        """
+        Read the lookup tables, once for all the threads of the migration
+        :return: Dictionary of the ids of each entity by their key
+        """
+        with self.lock:
+            if self.ids is None:
+                conn = connect_to_db()
+                cur = conn.cursor()
+                try:
+                    ids = {}
+                    for entity in sorted(set(pipeline_db.IDENTIFIER_COLUMNS.values())):
+                        cur.execute(f"SELECT {entity}_key, {entity}_id FROM {entity}_keys")
+                        ids[entity] = dict(cur.fetchall())
+                    self.ids = ids
+
+                finally:
+                    cur.close()
+                    conn.close()
+
+        return self.ids
+
+    def get_decoders(self, columns) -> list:
+        """
+        Find the encoded identifier columns of a result
+        :param columns: List of the column names of the result
+        :return: List of the position of each identifier column with the ids of its entity,
+                 empty without ENCODE_IDENTIFIERS
+        """
+        if not ENCODE_IDENTIFIERS:
+            return []
+
+        entities = [(i, pipeline_db.IDENTIFIER_COLUMNS[column]) for i, column in enumerate(columns)
+                    if column in pipeline_db.IDENTIFIER_COLUMNS]
+        if not entities:
+            return []
+
+        ids = self.load()
+        return [(i, ids[entity]) for i, entity in entities]
+
+    @staticmethod
+    def decode(row, decoders) -> tuple:
+        """
+        Replace the keys in a row with their ids
+        :param row: The row
+        :param decoders: The identifier columns of the row, from get_decoders
+        :return: The row with the ids
+        """
+        if not decoders:
+            return row
+
+        row = list(row)
+        for i, ids in decoders:
+            # Columns that are not encoded, for example in a table Phase 3 created, keep their value
+            if isinstance(row[i], int):
+                row[i] = ids.get(row[i], row[i])
+
+        return tuple(row)
+
+
+identifier_decoder = IdentifierDecoder()
+
+
+class RowStream:
+    """
+    The rows of a query, read through a named server-side cursor FETCH_SIZE rows at a time,
+    so only one batch of the table is held in memory however large the table is
+    """
+
+    def __init__(self, conn, query, fetch_size=FETCH_SIZE, decode=True):
+        """
+        :param conn: Connection to the Postgres Database, the cursor lives in its open transaction
+        :param query: The SELECT query
+        :param fetch_size: The number of rows fetched at a time
+        :param decode: Give the encoded identifiers as their string ids
+        """
+        self.conn = conn
+        self.query = query
+        self.fetch_size = fetch_size
+        self.decode = decode
+        self.rows = 0
+
+    def __iter__(self):
+        cursor = self.conn.cursor(name=f"migration_cursor_{next(cursor_numbers)}")
+        try:
+            cursor.execute(self.query)
+            decoders = None
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                self.rows += len(rows)
+
+                # The columns of a server-side cursor are only known after the first fetch
+                if decoders is None:
+                    decoders = identifier_decoder.get_decoders(
+                        [column[0] for column in cursor.description]) if self.decode else []
+                if decoders:
+                    rows = [identifier_decoder.decode(row, decoders) for row in rows]
+                yield from rows
+
+        finally:
+            cursor.close()
+
+
+class MergeJoin:
+    """
+    Embedding engine for the nested documents. The parent and the child table are both streamed sorted
+    on the join key and merged, giving each parent row with its child rows one group at a time, so only
+    the largest group is ever held in memory instead of the whole child table. The rows are merged on
+    the keys as they are stored, and the encoded identifiers are only decoded once they are joined.
+    """
+
+    def __init__(self, conn, parent_table, parent_key, child_table, child_key):
+        """
+        :param conn: Connection to the Postgres Database
+        :param parent_table: Table of the documents
+        :param parent_key: Column of the parent table to join on
+        :param child_table: Table of the embedded documents
+        :param child_key: Column of the child table to join on
+        """
+        cur = conn.cursor()
+        parent_columns, parent_types = pipeline_db.schema_catalog.get_columns(cur, parent_table)
+        child_columns, child_types = pipeline_db.schema_catalog.get_columns(cur, child_table)
+        cur.close()
+
+        # Keys of different types, for example stops.stop_id after Phase 3 made it an integer while
+        # stop_times.stop_id is still text, are joined on their text form
+        self.text_keys = parent_types[parent_key] != child_types[child_key]
+        parent_order = f"{parent_key}::text" if self.text_keys else parent_key
+        child_order = f"{child_key}::text" if self.text_keys else child_key
+
+        # Text keys are sorted by byte value, the order Python compares strings in, whatever the
+        # collation of the database is
+        if self.text_keys or parent_types[parent_key] in ("character varying", "text"):
+            parent_order += ' COLLATE "C"'
+            child_order += ' COLLATE "C"'
+
+        self.parents = RowStream(conn, f"SELECT * FROM {parent_table} ORDER BY {parent_order}", decode=False)
+        self.children = RowStream(conn, f"SELECT * FROM {child_table} WHERE {child_key} IS NOT NULL "
+                                        f"ORDER BY {child_order}", decode=False)
+        self.parent_index = parent_columns.index(parent_key)
+        self.child_index = child_columns.index(child_key)
+        self.parent_decoders = identifier_decoder.get_decoders(parent_columns)
+        self.child_decoders = identifier_decoder.get_decoders(child_columns)
+
+    @property
+    def rows(self) -> int:
+        """
+        :return: The number of parent rows read so far
+        """
+        return self.parents.rows
+
+    def get_key(self, row, index):
+        """
+        Get the join key of a row in the form the rows are sorted on
+        :param row: The row
+        :param index: Position of the key in the row
+        :return: The key, as text if the two tables have keys of different types
+        """
+        return str(row[index]) if self.text_keys else row[index]
+
+    def __iter__(self):
+        children = iter(self.children)
+        child = next(children, None)
+        # Nothing compares equal to the starting key
+        group_key = object()
+        group = []
+
+        for parent in self.parents:
+            key = self.get_key(parent, self.parent_index)
+
+            # A repeated parent key gets the same children again
+            if key != group_key:
+                group_key = key
+                group = []
+
+                # Children without a parent are skipped
+                while child is not None and self.get_key(child, self.child_index) < key:
+                    child = next(children, None)
+
+                while child is not None and self.get_key(child, self.child_index) == key:
+                    group.append(identifier_decoder.decode(child, self.child_decoders))
+                    child = next(children, None)
+
+            yield identifier_decoder.decode(parent, self.parent_decoders), group
+
+
+class StagePipeline:
+    """
+    The three stages of loading a collection: reading the rows from Postgres, building the documents and
+    writing them to MongoDB. With CONCURRENT_MIGRATION each stage runs in its own thread and hands batches
+    to the next through a bounded queue, so the three overlap, otherwise they take turns in one thread.
+    The time each stage is busy is measured either way, which shows the stage that limits the load.
+    """
+
+    STAGES = ("read", "build", "write")
+    # Marks the end of the batches in a queue
+    DONE = object()
+
+    def __init__(self, name, source, build, writer, concurrent=CONCURRENT_MIGRATION, batch_size=STAGE_BATCH_SIZE,
+                 queue_size=STAGE_QUEUE_SIZE):
+        """
+        :param name: Name of the collection
+        :param source: Iterable of the rows, or of the rows with their embedded rows
+        :param build: Function that builds the document of one item of the source
+        :param writer: MongoBulkWriter of the collection
+        :param concurrent: Run the stages in their own threads
+        :param batch_size: The number of items handed on at a time
+        :param queue_size: The most batches waiting between two stages
+        """
+        self.name = name
+        self.source = source
+        self.build = build
+        self.writer = writer
+        self.concurrent = concurrent
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.busy = dict.fromkeys(self.STAGES, 0.0)
+        self.items = dict.fromkeys(self.STAGES, 0)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def read_batches(self):
+        """
+        Read the source in batches
+        :return: Generator of the lists of items
+        """
+        source = iter(self.source)
+        while True:
+            start_time = time.perf_counter()
+            batch = list(itertools.islice(source, self.batch_size))
+            self.busy["read"] += time.perf_counter() - start_time
+            if not batch:
+                return
+
+            self.items["read"] += len(batch)
+            yield batch
+
+    def build_batch(self, batch) -> list:
+        """
+        Build the documents of a batch
+        :param batch: List of the items read from the source
+        :return: List of the documents
+        """
+        start_time = time.perf_counter()
+        documents = [self.build(item) for item in batch]
+        self.busy["build"] += time.perf_counter() - start_time
+        self.items["build"] += len(documents)
+
+        return documents
+
+    def write_batch(self, documents) -> None:
+        """
+        Hand the documents of a batch to the bulk writer
+        :param documents: List of the documents
+        :return: None
+        """
+        start_time = time.perf_counter()
+        for document in documents:
+            self.writer.insert(document)
+        self.busy["write"] += time.perf_counter() - start_time
+        self.items["write"] += len(documents)
+
+        return None
+
+    def put(self, batches, batch) -> None:
+        """
+        Put a batch in a queue, waiting while the queue is full unless the pipeline is stopped
+        :param batches: The queue
+        :param batch: The batch, or DONE
+        :return: None
+        """
+        while not self.stopped.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return None
+            except queue.Full:
+                continue
+
+        return None
+
+    def get(self, batches):
+        """
+        Take a batch from a queue, waiting while the queue is empty unless the pipeline is stopped
+        :param batches: The queue
+        :return: The batch, DONE at the end or once the pipeline is stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                return batches.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return self.DONE
+
+    def run_stage(self, batches, results, stage) -> None:
+        """
+        Run the read or the build stage in its thread, always ending its output with DONE
+        :param batches: Queue of the input batches, None for the read stage
+        :param results: Queue of the output batches
+        :param stage: "read" or "build"
+        :return: None
+        """
+        try:
+            if stage == "read":
+                for batch in self.read_batches():
+                    if self.stopped.is_set():
+                        break
+                    self.put(results, batch)
+            else:
+                for batch in iter(lambda: self.get(batches), self.DONE):
+                    self.put(results, self.build_batch(batch))
+
+        except Exception as e:
+            self.error = self.error or e
+
+        finally:
+            self.put(results, self.DONE)
+
+        return None
+
+    def run(self) -> int:
+        """
+        Load the collection and print the throughput of each stage
+        :return: The number of documents inserted
+        """
+        if not self.concurrent:
+            for batch in self.read_batches():
+                self.write_batch(self.build_batch(batch))
+        else:
+            read_batches = queue.Queue(self.queue_size)
+            built_batches = queue.Queue(self.queue_size)
+            threads = [threading.Thread(target=self.run_stage, args=(None, read_batches, "read"), daemon=True),
+                       threading.Thread(target=self.run_stage, args=(read_batches, built_batches, "build"),
+                                        daemon=True)]
+            for thread in threads:
+                thread.start()
+
+            # The write stage runs in this thread
+            try:
+                for documents in iter(built_batches.get, self.DONE):
+                    self.write_batch(documents)
+            finally:
+                self.stopped.set()
+                for thread in threads:
+                    thread.join()
+
+            if self.error is not None:
+                raise self.error
+
+        start_time = time.perf_counter()
+        inserted = self.writer.close()
+        self.busy["write"] += time.perf_counter() - start_time
+
+        self.print_stage_throughput()
+
+        return inserted
+
+    def print_stage_throughput(self) -> None:
+        """
+        Print the items each stage handled per second of the time it was busy
+        :return: None
+        """
+        print(f"\nStages of the {self.name} Collection:")
+        for stage in self.STAGES:
+            rate = self.items[stage] / self.busy[stage] if self.busy[stage] else 0
+            print(f"{stage.capitalize()}: {self.items[stage]} in {self.busy[stage]:.2f} busy seconds "
+                  f"({rate:.0f}/sec)")
+        print(f"Slowest stage: {max(self.STAGES, key=self.busy.get)}")
+
+        return None
+
+
+def get_resident_memory() -> int:
+    """
+    Get the memory the process currently uses
+    :return: The resident memory in bytes, the peak so far where /proc is not available (macOS),
+             0 where neither /proc nor the resource module is available (Windows without psutil)
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakMemoryMonitor:
+    """
+    Samples the resident memory of the process in a background thread to find its peak while a collection
+    loads. ru_maxrss only gives the peak of the whole run, which the first large collection would decide.
+    The memory of the process is taken as a baseline when sampling starts, so that the peak reported is only
+    what the collection added and not what the collections loaded before it still hold.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        """
+        :param interval: Seconds between the samples
+        """
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self) -> None:
+        """
+        Take samples until the monitor is stopped
+        :return: None
+        """
+        while True:
+            self.peak = max(self.peak, get_resident_memory())
+            if self.stopped.wait(self.interval):
+                break
+
+        return None
+
+    def start(self) -> None:
+        """
+        Take the baseline and start sampling
+        :return: None
+        """
+        self.baseline = get_resident_memory()
+        self.thread.start()
+
+        return None
+
+    def stop(self) -> int:
+        """
+        Stop sampling
+        :return: The peak resident memory in bytes above the baseline
+        """
+        self.stopped.set()
+        self.thread.join()
+
+        return max(self.peak, get_resident_memory()) - self.baseline
+
+
+class PartitionedGrouping:
+    """
+    Groups rows by a key for the shared scan of real_time_data_temp. The rows are kept in memory until
+    there are more than max_rows of them, then they are written to spill files on disk, hashed on the key,
+    so that later only one spill file at a time has to fit in memory.
+    """
+
+    def __init__(self, name, partitions=SPILL_PARTITIONS, max_rows=SPILL_MEMORY_ROWS):
+        """
+        :param name: Name of the grouping, for the console
+        :param partitions: The number of spill files
+        :param max_rows: The most rows kept in memory
+        """
+        self.name = name
+        self.partitions = partitions
+        self.max_rows = max_rows
+        self.groups = {}
+        self.rows = 0
+        self.files = None
+
+    def add(self, key, row) -> None:
+        """
+        Add a row to the group of its key
+        :param key: The key to group on
+        :param row: The row
+        :return: None
+        """
+        self.groups.setdefault(key, []).append(row)
+        self.rows += 1
+
+        if self.rows > self.max_rows:
+            self.spill()
+
+        return None
+
+    def spill(self) -> None:
+        """
+        Append the groups in memory to the spill files and empty the memory
+        :return: None
+        """
+        if self.files is None:
+            print(f"Spilling the {self.name} grouping to {self.partitions} files on disk...")
+            self.files = [tempfile.TemporaryFile(dir=SPILL_DIRECTORY) for _ in range(self.partitions)]
+
+        for file, groups in zip(self.files, self.split(self.partitions)):
+            if groups:
+                pickle.dump(groups, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.groups = {}
+        self.rows = 0
+
+        return None
+
+    def split(self, partitions) -> list:
+        """
+        Split the groups in memory by the hash of their key
+        :param partitions: The number of parts
+        :return: List of the dictionaries of the groups of each part
+        """
+        if partitions == 1:
+            return [self.groups]
+
+        parts = [{} for _ in range(partitions)]
+        for key, rows in self.groups.items():
+            parts[hash(key) % partitions][key] = rows
+
+        return parts
+
+    def get_partitions(self, partitions):
+        """
+        Read the groups back one part at a time, the groups of a key spilled more than once are put together
+        :param partitions: The number of parts, 1 is only possible if the grouping was never spilled
+        :return: Generator of the dictionaries of the groups of each part
+        """
+        if self.files is None:
+            yield from self.split(partitions)
+            return
+
+        self.spill()
+        for file in self.files:
+            file.seek(0)
+            groups = {}
+            while True:
+                try:
+                    for key, rows in pickle.load(file).items():
+                        groups.setdefault(key, []).extend(rows)
+                except EOFError:
+                    break
+            file.close()
+            yield groups
+
+
+def join_groupings(parents, children):
+    """
+    Join two groupings on their keys one part at a time, the way MergeJoin joins two sorted tables
+    :param parents: Grouping of the parent rows, one row per key
+    :param children: Grouping of the child rows
+    :return: Generator of each parent row with the list of its child rows
+    """
+    # Both sides are split the same way when either of them had to go to disk
+    partitions = 1 if parents.files is None and children.files is None else SPILL_PARTITIONS
+
+    for parent_groups, child_groups in zip(parents.get_partitions(partitions), children.get_partitions(partitions)):
+        for key, parent_rows in parent_groups.items():
+            for parent in parent_rows:
+                yield parent, child_groups.get(key, [])
+
+
+def build_real_time_data_dict(rtdt, exclude=None) -> dict:
+    """
+    Build the document of a row of real_time_data_temp
+    :param rtdt: The row
+    :param exclude: Field left out of the document, for example the key of the document it is embedded in
+    :return: The document, with None for the missing values
+    """
+    rtdt_dict = {
+        "Route_Id": rtdt[0] if rtdt[0] is not None else None,
+        "Direction": rtdt[1] if rtdt[1] is not None else None,
+        "Trip_Id": rtdt[2] if rtdt[2] is not None else None,
+        "Agency_Id": rtdt[3] if rtdt[3] is not None else None,
+        "Origin_Stop": rtdt[4] if rtdt[4] is not None else None,
+        "Lat": rtdt[5] if rtdt[5] is not None else None,
+        "Lon": rtdt[6] if rtdt[6] is not None else None,
+        "Bearing": rtdt[7] if rtdt[7] is not None else None,
+        "Vehicle_Id": rtdt[8] if rtdt[8] is not None else None,
+        "Aimed_Arrival_time": rtdt[9].isoformat() if rtdt[9] is not None else None,
+        "Distance_From_Origin": rtdt[10] if rtdt[10] is not None else None,
+        "Presentable_Distance": rtdt[11] if rtdt[11] is not None else None,
+        "Distance_From_Next_Stop": rtdt[12] if rtdt[12] is not None else None,
+        "Next_Stop": rtdt[13] if rtdt[13] is not None else None,
+        "Recorded_Time": rtdt[14].isoformat() if rtdt[14] is not None else None,
+    }
+
+    if exclude is not None:
+        del rtdt_dict[exclude]
+
+    return rtdt_dict
+
+
+def build_real_time_data_document(rtdt) -> dict:
+    """
+    Build the Real_Time_Data document of a row of real_time_data_temp
+    :param rtdt: The row
+    :return: The document, without the fields that have no value
+    """
+    # Remove fields with None values
+    return {key: value for key, value in build_real_time_data_dict(rtdt).items() if value is not None}
+
+
+def build_arrival_time_dict(arrival_time, rtdt_rows) -> dict:
+    """
+    Build the Arrival_Time document of a row of arrival_time
+    :param arrival_time: The row
+    :param rtdt_rows: The rows of real_time_data_temp with this aimed arrival time
+    :return: The document, without the fields that have no value
+    """
+    arrival_time_dict = {
+        "_id": arrival_time[0].isoformat(),
+        "All_Count": arrival_time[1] if arrival_time[1] is not None else None,
+        "Late_Count": arrival_time[2] if arrival_time[2] is not None else None,
+        "Real_Time_Data": [build_real_time_data_dict(rtdt, "Aimed_Arrival_time") for rtdt in rtdt_rows] or None
+    }
+
+    # Remove fields with None values
+    return {key: value for key, value in arrival_time_dict.items() if value is not None}
+
+
+def build_trip_dict(trip, rtdt_rows) -> dict:
+    """
+    Build the Trips document of a row of trips
+    :param trip: The row
+    :param rtdt_rows: The rows of real_time_data_temp of this trip
+    :return: The document, without the fields that have no value
+    """
+    trips_dict = {
+        "_id": trip[2],
+        "Route_Id": trip[0] if trip[0] is not None else None,
+        "Service_Id": trip[1] if trip[1] is not None else None,
+        "Trip_Headsign": trip[3] if trip[3] is not None else None,
+        "Direction_Id": trip[4] if trip[4] is not None else None,
+        "Shape_Id": trip[5] if trip[5] is not None else None,
+        "Real_Time_Data": [build_real_time_data_dict(rtdt, "Trip_Id") for rtdt in rtdt_rows] or None
+    }
+
+    # Remove fields with None values
+    return {key: value for key, value in trips_dict.items() if value is not None}
+
+
+def build_calendar_dict(calendar_row, calendar_dates_rows) -> dict:
+    """
+    Build the Calendar document of a row of calendar
+    :param calendar_row: The row
+    :param calendar_dates_rows: The rows of calendar_dates of this service
+    :return: The document, without the fields that have no value
+    """
+    calendar_dates_list = []
+    for calendar_dates in calendar_dates_rows:
+        dates_dict = {
+            "Date": calendar_dates[1].strftime('%Y-%m-%d') if calendar_dates[1] is not None else None,
+            "Exception_Type": calendar_dates[2] if calendar_dates[2] is not None else None
+        }
+        calendar_dates_list.append(dates_dict)
+
+    calendar_dict = {
+        "_id": calendar_row[0],
+        "Monday": calendar_row[1] if calendar_row[1] is not None else None,
+        "Tuesday": calendar_row[2] if calendar_row[2] is not None else None,
+        "Wednesday": calendar_row[3] if calendar_row[3] is not None else None,
+        "Thursday": calendar_row[4] if calendar_row[4] is not None else None,
+        "Friday": calendar_row[5] if calendar_row[5] is not None else None,
+        "Saturday": calendar_row[6] if calendar_row[6] is not None else None,
+        "Sunday": calendar_row[7] if calendar_row[7] is not None else None,
+        "Start_Date": calendar_row[8].strftime('%Y-%m-%d') if calendar_row[8] is not None else None,
+        "End_Date": calendar_row[9].strftime('%Y-%m-%d') if calendar_row[9] is not None else None,
+        "Calendar_Dates": calendar_dates_list or None
+    }
+
+    # Remove fields with None values
+    return {key: value for key, value in calendar_dict.items() if value is not None}
+
+
+def build_stop_dict(stops, stop_times_rows) -> dict:
+    """
+    Build the Stops document of a row of stops
+    :param stops: The row
+    :param stop_times_rows: The rows of stop_times of this stop
+    :return: The document, without the fields that have no value
+    """
+    stop_times_list = []
+    for stop_times in stop_times_rows:
+        single_stop_times_dict = {
+            "Trip_Id": stop_times[0] if stop_times[0] is not None else None,
+            "Arrival_Time": stop_times[1].isoformat() if stop_times[1] is not None else None,
+            "Departure_Time": stop_times[2].isoformat() if stop_times[2] is not None else None,
+            "Stop_Sequence": stop_times[4] if stop_times[4] is not None else None,
+            "Pickup_Type": stop_times[5] if stop_times[5] is not None else None,
+            "Drop_Off_Type": stop_times[6] if stop_times[6] is not None else None,
+        }
+        stop_times_list.append(single_stop_times_dict)
+
+    stops_dict = {
+        "_id": stops[0],
+        "Stop_Name": stops[1] if stops[1] is not None else None,
+        "Stop_Desc": stops[2] if stops[2] is not None else None,
+        "Stop_Lat": stops[3] if stops[3] is not None else None,
+        "Stop_Lon": stops[4] if stops[4] is not None else None,
+        "Zone_Id": stops[5] if stops[5] is not None else None,
+        "Stop_URL": stops[6] if stops[6] is not None else None,
+        "Location_Type": stops[7] if stops[7] is not None else None,
+        "Parent_Station": stops[8] if stops[8] is not None else None,
+        "Stop_Times": stop_times_list or None
+    }
+
+    # Remove fields with None values
+    return {key: value for key, value in stops_dict.items() if value is not None}
+
+
+def build_route_dict(route, trips_rows) -> dict:
+    """
+    Build the Routes document of a row of routes
+    :param route: The row
+    :param trips_rows: The rows of trips of this route
+    :return: The document, without the fields that have no value
+    """
+    trips_list = []
+    for trip in trips_rows:
+        single_trip_dict = {
+            "Trip_Id": trip[2],
+            # "Route_Id": trip[0] if trip[0] is not None else None,
+            "Service_Id": trip[1] if trip[1] is not None else None,
+            "Trip_Headsign": trip[3] if trip[3] is not None else None,
+            "Direction_Id": trip[4] if trip[4] is not None else None,
+            # "Shape_Id": trip[5] if trip[5] is not None else None,
+        }
+        trips_list.append(single_trip_dict)
+
+    route_dict = {
+        "_id": route[0],
+        "Agency_Id": route[1] if route[1] is not None else None,
+        "Route_Short_Name": route[2] if route[2] is not None else None,
+        "Route_Long_Name": route[2] if route[2] is not None else None,
+        "Route_Desc": route[2] if route[2] is not None else None,
+        "Route_Type": route[2] if route[2] is not None else None,
+        "Route_Color": route[2] if route[2] is not None else None,
+        "Route_Text_Color": route[2] if route[2] is not None else None,
+        # "Real_Time_Data": rtdt_dict.get(route[0], None),
+        "Trips": trips_list or None
+    }
+
+    # Remove fields with None values
+    return {key: value for key, value in route_dict.items() if value is not None}
+
+
 def create_collections():
     """
     Create the collections in the MongoDB database
     :return: None
     """
     # Connect to MongoDB
-    mongo_client = MongoClient(connection_url)
-    mongo_db = mongo_client[mongo_db_name]
+    mongo_db, _ = connect_to_mongodb()
     mongo_db.create_collection("Calendar")
     mongo_db.create_collection("Arrival_Time")
     mongo_db.create_collection("Stops")
@@ -81,7 +945,6 @@ def create_collections():
     mongo_db.create_collection("Real_Time_Data")
     print("\n======================================================\n")
     print("Created collections:", mongo_db.list_collection_names())
-    mongo_client.close()
 
 
 def load_calendar():
@@ -94,63 +957,25 @@ def load_calendar():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
     calendar_collection = mongodb['Calendar']
 
-    # Fetch all data from PostgreSQL and organize them into a dictionary
-    calendar_dates_dict = {}
-    postgres_cursor.execute("SELECT * FROM calendar_dates")
-    calendar_dates_data = postgres_cursor.fetchall()
-    for calendar_dates in calendar_dates_data:
-        service_id = calendar_dates[0]
-        dates_dict = {
-            "Date": calendar_dates[1].strftime('%Y-%m-%d') if calendar_dates[1] is not None else None,
-            "Exception_Type": calendar_dates[2] if calendar_dates[2] is not None else None
-        }
-        if service_id in calendar_dates_dict:
-            calendar_dates_dict[service_id].append(dates_dict)
-        else:
-            calendar_dates_dict[service_id] = [dates_dict]
-
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM calendar")
-    calendar_data = postgres_cursor.fetchall()
-
-    successful_calendar_entry = 0
-
-    # Transform and load data into MongoDB
-    for calendar_row in calendar_data:
-        calendar_dict = {
-            "_id": calendar_row[0],
-            "Monday": calendar_row[1] if calendar_row[1] is not None else None,
-            "Tuesday": calendar_row[2] if calendar_row[2] is not None else None,
-            "Wednesday": calendar_row[3] if calendar_row[3] is not None else None,
-            "Thursday": calendar_row[4] if calendar_row[4] is not None else None,
-            "Friday": calendar_row[5] if calendar_row[5] is not None else None,
-            "Saturday": calendar_row[6] if calendar_row[6] is not None else None,
-            "Sunday": calendar_row[7] if calendar_row[7] is not None else None,
-            "Start_Date": calendar_row[8].strftime('%Y-%m-%d') if calendar_row[8] is not None else None,
-            "End_Date": calendar_row[9].strftime('%Y-%m-%d') if calendar_row[9] is not None else None,
-            "Calendar_Dates": calendar_dates_dict.get(calendar_row[0], None)
-        }
+    # Stream the calendar and its dates from PostgreSQL, both sorted on the service id
+    calendar_data = MergeJoin(postgres_conn, "calendar", "service_id", "calendar_dates", "service_id")
 
-        # Remove fields with None values
-        calendar_dict = {key: value for key, value in calendar_dict.items() if value is not None}
+    writer = MongoBulkWriter(calendar_collection)
 
-        # Insert post document into MongoDB
-        calendar_collection.insert_one(calendar_dict)
-        successful_calendar_entry += 1
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_calendar_entry = StagePipeline("Calendar", calendar_data,
+                                              lambda item: build_calendar_dict(*item), writer).run()
 
-    print(f"\nTotal entries from Postgres: {len(calendar_data)}")
+    print(f"\nTotal entries from Postgres: {calendar_data.rows}")
     print(f"Total entries added to MongoDB: {successful_calendar_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
 
 
 def load_arrival_time():
@@ -163,69 +988,26 @@ def load_arrival_time():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
     arrival_time_collection = mongodb['Arrival_Time']
 
-    # Fetch all data from PostgreSQL and organize them into a dictionary
-    rtdt_dict = {}
-    postgres_cursor.execute("SELECT * FROM real_time_data_temp")
-    rtdt_data = postgres_cursor.fetchall()
-    for rtdt in rtdt_data:
-        aimed_arrival_time = rtdt[9]
-        single_rtdt_dict = {
-            "Route_Id": rtdt[0] if rtdt[0] is not None else None,
-            "Direction": rtdt[1] if rtdt[1] is not None else None,
-            "Trip_Id": rtdt[2] if rtdt[2] is not None else None,
-            "Agency_Id": rtdt[3] if rtdt[3] is not None else None,
-            "Origin_Stop": rtdt[4] if rtdt[4] is not None else None,
-            "Lat": rtdt[5] if rtdt[5] is not None else None,
-            "Lon": rtdt[6] if rtdt[6] is not None else None,
-            "Bearing": rtdt[7] if rtdt[7] is not None else None,
-            "Vehicle_Id": rtdt[8] if rtdt[8] is not None else None,
-            # "Aimed_Arrival_time": rtdt[9].isoformat() if rtdt[9] is not None else None,
-            "Distance_From_Origin": rtdt[10] if rtdt[10] is not None else None,
-            "Presentable_Distance": rtdt[11] if rtdt[11] is not None else None,
-            "Distance_From_Next_Stop": rtdt[12] if rtdt[12] is not None else None,
-            "Next_Stop": rtdt[13] if rtdt[13] is not None else None,
-            "Recorded_Time": rtdt[14].isoformat() if rtdt[14] is not None else None,
-        }
-        if aimed_arrival_time in rtdt_dict:
-            rtdt_dict[aimed_arrival_time].append(single_rtdt_dict)
-        else:
-            rtdt_dict[aimed_arrival_time] = [single_rtdt_dict]
-
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM arrival_time")
-    arrival_time_data = postgres_cursor.fetchall()
+    # Stream the arrival times and the real time data from PostgreSQL, both sorted on the arrival time
+    arrival_time_data = MergeJoin(postgres_conn, "arrival_time", "time_span",
+                                  "real_time_data_temp", "aimed_arrival_time")
 
-    successful_entry = 0
-
-    # Transform and load data into MongoDB
-    for arrival_time in arrival_time_data:
-        arrival_time_dict = {
-            "_id": arrival_time[0].isoformat(),
-            "All_Count": arrival_time[1] if arrival_time[1] is not None else None,
-            "Late_Count": arrival_time[2] if arrival_time[2] is not None else None,
-            "Real_Time_Data": rtdt_dict.get(arrival_time[0], None)
-        }
+    writer = MongoBulkWriter(arrival_time_collection)
 
-        # Remove fields with None values
-        arrival_time_dict = {key: value for key, value in arrival_time_dict.items() if value is not None}
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_entry = StagePipeline("Arrival_Time", arrival_time_data,
+                                     lambda item: build_arrival_time_dict(*item), writer).run()
 
-        # Insert post document into MongoDB
-        arrival_time_collection.insert_one(arrival_time_dict)
-        successful_entry += 1
-
-    print(f"\nTotal entries from Postgres: {len(arrival_time_data)}")
+    print(f"\nTotal entries from Postgres: {arrival_time_data.rows}")
     print(f"Total entries added to MongoDB: {successful_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
 
 
 def load_stops():
@@ -238,66 +1020,26 @@ def load_stops():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
     stops_collection = mongodb['Stops']
 
-    # Fetch all data from PostgreSQL and organize them into a dictionary
-    stop_times_dict = {}
-    postgres_cursor.execute("SELECT * FROM stop_times")
-    stop_times_data = postgres_cursor.fetchall()
-    for stop_times in stop_times_data:
-        stop_id = stop_times[3]
-        single_stop_times_dict = {
-            "Trip_Id": stop_times[0] if stop_times[0] is not None else None,
-            "Arrival_Time": stop_times[1].isoformat() if stop_times[1] is not None else None,
-            "Departure_Time": stop_times[2].isoformat() if stop_times[2] is not None else None,
-            "Stop_Sequence": stop_times[4] if stop_times[4] is not None else None,
-            "Pickup_Type": stop_times[5] if stop_times[5] is not None else None,
-            "Drop_Off_Type": stop_times[6] if stop_times[6] is not None else None,
-        }
-        if stop_id in stop_times_dict:
-            stop_times_dict[stop_id].append(single_stop_times_dict)
-        else:
-            stop_times_dict[stop_id] = [single_stop_times_dict]
-
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM stops")
-    stops_data = postgres_cursor.fetchall()
-
-    successful_entry = 0
-
-    # Transform and load data into MongoDB
-    for stops in stops_data:
-        stops_dict = {
-            "_id": stops[0],
-            "Stop_Name": stops[1] if stops[1] is not None else None,
-            "Stop_Desc": stops[2] if stops[2] is not None else None,
-            "Stop_Lat": stops[3] if stops[3] is not None else None,
-            "Stop_Lon": stops[4] if stops[4] is not None else None,
-            "Zone_Id": stops[5] if stops[5] is not None else None,
-            "Stop_URL": stops[6] if stops[6] is not None else None,
-            "Location_Type": stops[7] if stops[7] is not None else None,
-            "Parent_Station": stops[8] if stops[8] is not None else None,
-            "Stop_Times": stop_times_dict.get(stops[0], None)
-        }
+    # Stream the stops and their stop times from PostgreSQL, both sorted on the stop id
+    # With the times stored as seconds, the view has them in the time form
+    stop_times_table = "stop_times_time" if TIME_STORAGE == "seconds" else "stop_times"
+    stops_data = MergeJoin(postgres_conn, "stops", "stop_id", stop_times_table, "stop_id")
 
-        # Remove fields with None values
-        stops_dict = {key: value for key, value in stops_dict.items() if value is not None}
+    writer = MongoBulkWriter(stops_collection)
 
-        # Insert post document into MongoDB
-        stops_collection.insert_one(stops_dict)
-        successful_entry += 1
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_entry = StagePipeline("Stops", stops_data, lambda item: build_stop_dict(*item), writer).run()
 
-    print(f"\nTotal entries from Postgres: {len(stops_data)}")
+    print(f"\nTotal entries from Postgres: {stops_data.rows}")
     print(f"Total entries added to MongoDB: {successful_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
 
 
 def load_routes():
@@ -310,7 +1052,6 @@ def load_routes():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
@@ -344,59 +1085,19 @@ def load_routes():
     #     else:
     #         rtdt_dict[Route_Id] = [single_rtdt_dict]
 
-    trips_dict = {}
-    postgres_cursor.execute("SELECT * FROM trips")
-    trips_data = postgres_cursor.fetchall()
-    for trip in trips_data:
-        Route_Id = trip[0]
-        single_trip_dict = {
-            "Trip_Id": trip[2],
-            # "Route_Id": trip[0] if trip[0] is not None else None,
-            "Service_Id": trip[1] if trip[1] is not None else None,
-            "Trip_Headsign": trip[3] if trip[3] is not None else None,
-            "Direction_Id": trip[4] if trip[4] is not None else None,
-            # "Shape_Id": trip[5] if trip[5] is not None else None,
-        }
-        if Route_Id in trips_dict:
-            trips_dict[Route_Id].append(single_trip_dict)
-        else:
-            trips_dict[Route_Id] = [single_trip_dict]
-
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM routes")
-    routes_data = postgres_cursor.fetchall()
-
-    successful_entry = 0
-
-    # Transform and load data into MongoDB
-    for route in routes_data:
-        route_dict = {
-            "_id": route[0],
-            "Agency_Id": route[1] if route[1] is not None else None,
-            "Route_Short_Name": route[2] if route[2] is not None else None,
-            "Route_Long_Name": route[2] if route[2] is not None else None,
-            "Route_Desc": route[2] if route[2] is not None else None,
-            "Route_Type": route[2] if route[2] is not None else None,
-            "Route_Color": route[2] if route[2] is not None else None,
-            "Route_Text_Color": route[2] if route[2] is not None else None,
-            # "Real_Time_Data": rtdt_dict.get(route[0], None),
-            "Trips": trips_dict.get(route[0], None)
-        }
+    # Stream the routes and their trips from PostgreSQL, both sorted on the route id
+    routes_data = MergeJoin(postgres_conn, "routes", "route_id", "trips", "route_id")
 
-        # Remove fields with None values
-        route_dict = {key: value for key, value in route_dict.items() if value is not None}
+    writer = MongoBulkWriter(routes_collection)
 
-        # Insert post document into MongoDB
-        routes_collection.insert_one(route_dict)
-        successful_entry += 1
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_entry = StagePipeline("Routes", routes_data, lambda item: build_route_dict(*item), writer).run()
 
-    print(f"\nTotal entries from Postgres: {len(routes_data)}")
+    print(f"\nTotal entries from Postgres: {routes_data.rows}")
     print(f"Total entries added to MongoDB: {successful_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
 
 
 def load_trips():
@@ -409,72 +1110,24 @@ def load_trips():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
     trips_collection = mongodb['Trips']
 
-    # Fetch all data from PostgreSQL and organize them into a dictionary
-    rtdt_dict = {}
-    postgres_cursor.execute("SELECT * FROM real_time_data_temp")
-    rtdt_data = postgres_cursor.fetchall()
-    for rtdt in rtdt_data:
-        Trip_Id = rtdt[2]
-        single_rtdt_dict = {
-            "Route_Id": rtdt[0] if rtdt[0] is not None else None,
-            "Direction": rtdt[1] if rtdt[1] is not None else None,
-            # "Trip_Id": rtdt[2] if rtdt[2] is not None else None,
-            "Agency_Id": rtdt[3] if rtdt[3] is not None else None,
-            "Origin_Stop": rtdt[4] if rtdt[4] is not None else None,
-            "Lat": rtdt[5] if rtdt[5] is not None else None,
-            "Lon": rtdt[6] if rtdt[6] is not None else None,
-            "Bearing": rtdt[7] if rtdt[7] is not None else None,
-            "Vehicle_Id": rtdt[8] if rtdt[8] is not None else None,
-            "Aimed_Arrival_time": rtdt[9].isoformat() if rtdt[9] is not None else None,
-            "Distance_From_Origin": rtdt[10] if rtdt[10] is not None else None,
-            "Presentable_Distance": rtdt[11] if rtdt[11] is not None else None,
-            "Distance_From_Next_Stop": rtdt[12] if rtdt[12] is not None else None,
-            "Next_Stop": rtdt[13] if rtdt[13] is not None else None,
-            "Recorded_Time": rtdt[14].isoformat() if rtdt[14] is not None else None,
-        }
-        if Trip_Id in rtdt_dict:
-            rtdt_dict[Trip_Id].append(single_rtdt_dict)
-        else:
-            rtdt_dict[Trip_Id] = [single_rtdt_dict]
-
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM trips")
-    trips_data = postgres_cursor.fetchall()
-
-    successful_entry = 0
-
-    # Transform and load data into MongoDB
-    for trip in trips_data:
-        trips_dict = {
-            "_id": trip[2],
-            "Route_Id": trip[0] if trip[0] is not None else None,
-            "Service_Id": trip[1] if trip[1] is not None else None,
-            "Trip_Headsign": trip[3] if trip[3] is not None else None,
-            "Direction_Id": trip[4] if trip[4] is not None else None,
-            "Shape_Id": trip[5] if trip[5] is not None else None,
-            "Real_Time_Data": rtdt_dict.get(trip[2], None)
-        }
+    # Stream the trips and their real time data from PostgreSQL, both sorted on the trip id
+    trips_data = MergeJoin(postgres_conn, "trips", "trip_id", "real_time_data_temp", "trip_id")
 
-        # Remove fields with None values
-        trips_dict = {key: value for key, value in trips_dict.items() if value is not None}
+    writer = MongoBulkWriter(trips_collection)
 
-        # Insert post document into MongoDB
-        trips_collection.insert_one(trips_dict)
-        successful_entry += 1
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_entry = StagePipeline("Trips", trips_data, lambda item: build_trip_dict(*item), writer).run()
 
-    print(f"\nTotal entries from Postgres: {len(trips_data)}")
+    print(f"\nTotal entries from Postgres: {trips_data.rows}")
     print(f"Total entries added to MongoDB: {successful_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
 
 
 def load_real_time_data():
@@ -487,65 +1140,120 @@ def load_real_time_data():
 
     # Connect to PostgreSQL
     postgres_conn = connect_to_db()
-    postgres_cursor = postgres_conn.cursor()
 
     # Connect to MongoDB
     mongodb, mongo_client = connect_to_mongodb()
     real_time_data_collection = mongodb['Real_Time_Data']
 
-    # Fetch data from PostgreSQL
-    postgres_cursor.execute("SELECT * FROM real_time_data_temp")
-    real_time_data_data = postgres_cursor.fetchall()
-
-    successful_rtdt_entry = 0
-
-    # Transform and load data into MongoDB
-    for rtdt in real_time_data_data:
-        rtdt_dict = {
-            "Route_Id": rtdt[0] if rtdt[0] is not None else None,
-            "Direction": rtdt[1] if rtdt[1] is not None else None,
-            "Trip_Id": rtdt[2] if rtdt[2] is not None else None,
-            "Agency_Id": rtdt[3] if rtdt[3] is not None else None,
-            "Origin_Stop": rtdt[4] if rtdt[4] is not None else None,
-            "Lat": rtdt[5] if rtdt[5] is not None else None,
-            "Lon": rtdt[6] if rtdt[6] is not None else None,
-            "Bearing": rtdt[7] if rtdt[7] is not None else None,
-            "Vehicle_Id": rtdt[8] if rtdt[8] is not None else None,
-            "Aimed_Arrival_time": rtdt[9].isoformat() if rtdt[9] is not None else None,
-            "Distance_From_Origin": rtdt[10] if rtdt[10] is not None else None,
-            "Presentable_Distance": rtdt[11] if rtdt[11] is not None else None,
-            "Distance_From_Next_Stop": rtdt[12] if rtdt[12] is not None else None,
-            "Next_Stop": rtdt[13] if rtdt[13] is not None else None,
-            "Recorded_Time": rtdt[14].isoformat() if rtdt[14] is not None else None,
-        }
+    # Stream data from PostgreSQL
+    real_time_data_data = RowStream(postgres_conn, "SELECT * FROM real_time_data_temp")
 
-        # Remove fields with None values
-        rtdt_dict = {key: value for key, value in rtdt_dict.items() if value is not None}
+    writer = MongoBulkWriter(real_time_data_collection)
 
-        # Insert post document into MongoDB
-        real_time_data_collection.insert_one(rtdt_dict)
-        successful_rtdt_entry += 1
+    # Transform and load data into MongoDB, the stages overlapping with CONCURRENT_MIGRATION
+    successful_rtdt_entry = StagePipeline("Real_Time_Data", real_time_data_data, build_real_time_data_document,
+                                          writer).run()
 
-    print(f"\nTotal entries from Postgres: {len(real_time_data_data)}")
+    print(f"\nTotal entries from Postgres: {real_time_data_data.rows}")
     print(f"Total entries added to MongoDB: {successful_rtdt_entry}")
 
     # Close connections
-    postgres_cursor.close()
     postgres_conn.close()
-    mongo_client.close()
+
+
+def load_real_time_collections():
+    """
+    Load the Real Time Data, Arrival Time and Trips Collections from one scan of real_time_data_temp.
+    Each row goes straight into Real_Time_Data and is grouped on its aimed arrival time and on its trip
+    id for the other two, spilling the groupings to disk when they grow past SPILL_MEMORY_ROWS rows.
+    :return: None
+    """
+    print("\n======================================================\n")
+    print("Loading the Real Time Data, Arrival Time and Trips Collections in MongoDB from one scan...")
+
+    # Connect to PostgreSQL
+    postgres_conn = connect_to_db()
+
+    # Connect to MongoDB
+    mongodb, mongo_client = connect_to_mongodb()
+
+    arrival_time_groups = PartitionedGrouping("Arrival_Time")
+    trip_groups = PartitionedGrouping("Trips")
+
+    # Stream data from PostgreSQL once, feeding all three collections
+    real_time_data_data = RowStream(postgres_conn, "SELECT * FROM real_time_data_temp")
+
+    def build_and_group(rtdt) -> dict:
+        """
+        Group a row for the other two collections and build its Real_Time_Data document
+        :param rtdt: The row of real_time_data_temp
+        :return: The document
+        """
+        # Rows without a key are not embedded anywhere
+        if rtdt[9] is not None:
+            arrival_time_groups.add(rtdt[9], rtdt)
+        if rtdt[2] is not None:
+            trip_groups.add(rtdt[2], rtdt)
+
+        return build_real_time_data_document(rtdt)
+
+    writer = MongoBulkWriter(mongodb['Real_Time_Data'])
+    inserted = StagePipeline("Real_Time_Data", real_time_data_data, build_and_group, writer).run()
+
+    print(f"\nTotal entries from Postgres: {real_time_data_data.rows}")
+    print(f"Total entries added to MongoDB: {inserted}")
+
+    # The parent tables are small, they are grouped the same way and joined to the groupings of the scan
+    for table_name, key_index, child_groups, collection_name, build_dict in (
+            ("arrival_time", 0, arrival_time_groups, "Arrival_Time", build_arrival_time_dict),
+            ("trips", 2, trip_groups, "Trips", build_trip_dict)):
+        print("\n======================================================\n")
+        print(f"Loading the {collection_name} Collection in MongoDB...")
+
+        parent_groups = PartitionedGrouping(table_name)
+        parent_data = RowStream(postgres_conn, f"SELECT * FROM {table_name}")
+        for parent in parent_data:
+            parent_groups.add(parent[key_index], parent)
+
+        writer = MongoBulkWriter(mongodb[collection_name])
+        inserted = StagePipeline(collection_name, join_groupings(parent_groups, child_groups),
+                                 lambda item: build_dict(*item), writer).run()
+
+        print(f"\nTotal entries from Postgres: {parent_data.rows}")
+        print(f"Total entries added to MongoDB: {inserted}")
+
+    # Close connections
+    postgres_conn.close()
 
 
 def load_data_into_MongoDB():
     """
-    Call functions to load each of the different collections
+    Call functions to load each of the different collections, printing the peak memory used by each,
+    or load them in parallel with CONCURRENT_MIGRATION
     :return: None
     """
-    load_real_time_data()
-    load_calendar()
-    load_arrival_time()
-    load_stops()
-    load_routes()
-    load_trips()
+    if SHARED_REAL_TIME_SCAN:
+        collection_loaders = (load_real_time_collections, load_calendar, load_stops, load_routes)
+    else:
+        collection_loaders = (load_real_time_data, load_calendar, load_arrival_time, load_stops, load_routes,
+                              load_trips)
+
+    if CONCURRENT_MIGRATION:
+        # The collections do not depend on each other, so they load at the same time and share the peak memory
+        monitor = PeakMemoryMonitor()
+        monitor.start()
+        with ThreadPoolExecutor(max_workers=MIGRATION_WORKERS) as executor:
+            futures = [executor.submit(load_collection) for load_collection in collection_loaders]
+            for future in as_completed(futures):
+                future.result()
+        print(f"\nPeak memory added while loading the collections: {monitor.stop() / (1 << 20):.1f} MB")
+        return None
+
+    for load_collection in collection_loaders:
+        monitor = PeakMemoryMonitor()
+        monitor.start()
+        load_collection()
+        print(f"Peak memory added while loading: {monitor.stop() / (1 << 20):.1f} MB")
 
 
 def create_and_load_data_into_MongoDB():
@@ -670,10 +1378,7 @@ def relation_sets():
     try:
 
         # Find column names
-        cur.execute("SELECT column_name FROM information_schema.columns "
-                    "WHERE table_name = 'transitdata' ORDER BY ordinal_position")
-        columns = cur.fetchall()
-        cleaned_column_names = [column[0] for column in columns]
+        cleaned_column_names, _ = pipeline_db.schema_catalog.get_columns(cur, 'transitdata')
 
         # Execute SQL query to fetch data
         cur.execute("SELECT * FROM transitdata")
@@ -935,10 +1640,6 @@ def execute_query(query) -> None:
     :return: None
     """
 
-    # Connect to the database
-    connection = connect_to_db()
-    cursor = connection.cursor()
-
     try:
 
         """
@@ -952,11 +1653,6 @@ def execute_query(query) -> None:
     except Exception as e:
         print("Error:", e)
 
-    finally:
-        # Close cursor and connection
-        cursor.close()
-        connection.close()
-
     return None
 
 
@@ -979,8 +1675,9 @@ def print_sql_results(query) -> None:
         cursor.execute(query)
 
         if cursor.description is not None:
-            # Fetch all rows from the result
-            rows = cursor.fetchall()
+            # Fetch all rows from the result, with the encoded identifiers as their string ids
+            decoders = identifier_decoder.get_decoders([column[0] for column in cursor.description])
+            rows = [identifier_decoder.decode(row, decoders) for row in cursor.fetchall()]
 
             print("Query Result:")
             for i, row in enumerate(rows):
@@ -1020,7 +1717,9 @@ def queries():
               "GROUP BY r.route_id "
               "ORDER BY late_percentage DESC;")
 
-    query2 = ("SELECT EXTRACT(HOUR FROM arrival_time) AS hour_of_day, COUNT(*) AS arrival_count "
+    # Times stored as seconds give the hour with integer arithmetic, wrapped into the same day like the time form
+    hour_of_day = "arrival_time % 86400 / 3600" if TIME_STORAGE == "seconds" else "EXTRACT(HOUR FROM arrival_time)"
+    query2 = (f"SELECT {hour_of_day} AS hour_of_day, COUNT(*) AS arrival_count "
               "FROM stop_times "
               "GROUP BY hour_of_day "
               "ORDER BY arrival_count DESC "
@@ -1101,17 +1800,17 @@ def create_indexes():
     connection = connect_to_db()
     cursor = connection.cursor()
 
-    query1 = ("CREATE INDEX ROUTEINDEX ON ROUTES(ROUTE_ID)")
+    query1 = ("CREATE INDEX IF NOT EXISTS ROUTEINDEX ON ROUTES(ROUTE_ID)")
 
-    query2 = ("CREATE INDEX RTDTINDEX ON REAL_TIME_DATA_TEMP(aimed_arrival_time, route_id)")
+    query2 = ("CREATE INDEX IF NOT EXISTS RTDTINDEX ON REAL_TIME_DATA_TEMP(aimed_arrival_time, route_id)")
 
-    query3 = ("CREATE INDEX STOPTIMEINDEX ON STOP_TIMES(ARRIVAL_TIME, TRIP_ID, STOP_ID)")
+    query3 = ("CREATE INDEX IF NOT EXISTS STOPTIMEINDEX ON STOP_TIMES(ARRIVAL_TIME, TRIP_ID, STOP_ID)")
 
-    query4 = ("CREATE INDEX STOPINDEX ON STOPS(STOP_ID)")
+    query4 = ("CREATE INDEX IF NOT EXISTS STOPINDEX ON STOPS(STOP_ID)")
 
-    query5 = ("CREATE INDEX TRIPINDEX ON TRIPS(TRIP_ID, ROUTE_ID, SERVICE_ID)")
+    query5 = ("CREATE INDEX IF NOT EXISTS TRIPINDEX ON TRIPS(TRIP_ID, ROUTE_ID, SERVICE_ID)")
 
-    query6 = ("CREATE INDEX CALENDARINDEX ON CALENDAR(SERVICE_ID)")
+    query6 = ("CREATE INDEX IF NOT EXISTS CALENDARINDEX ON CALENDAR(SERVICE_ID)")
 
     cursor.execute(query1)
     cursor.execute(query2)
@@ -1120,7 +1819,8 @@ def create_indexes():
     cursor.execute(query5)
     cursor.execute(query6)
 
-    # Close cursor and connection
+    # Commit the indexes and close cursor and connection
+    connection.commit()
     cursor.close()
     connection.close()
     print("Indexes Created")
@@ -1148,6 +1848,10 @@ def main():
 
     functional_dependencies()
 
+    # See how many connections the pool saved and close them
+    pipeline_db.print_connection_stats()
+    pipeline_db.close_all_connections()
+
 
 if __name__ == "__main__":
     main()
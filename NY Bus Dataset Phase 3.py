@@ -27,7 +27,7 @@ Association Mining:
     also visualize it using plots
 
 Steps to take before running this code:
-1. Enter your postgres project database connection details in the fields given in the code below
+1. Enter your postgres project database connection details in pipeline.ini (see pipeline_db.py)
 2. Import all the necessary packages from the import part of the code
 3. Run the code
 
@@ -44,29 +44,15 @@ from psycopg2 import Error
 import random
 import time
 import matplotlib.pyplot as plt
-
-
-# Postgres connection settings
-DB_NAME = "Project"
-DB_USER = "postgres"
-DB_PASSWORD = ""
-DB_HOST = "localhost"
-DB_PORT = ""
+import pipeline_db
 
 
 def connect_to_db():
     """
-    Connect to the Postgres Database using the parameters defined above.
-    :return: connection to the Postgres Database
+    Connect to the Postgres Database using the settings of pipeline_db.py.
+    :return: connection to the Postgres Database, borrowed from the shared pool until it is closed
     """
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-    return conn
+    return pipeline_db.connect_to_db()
 
 
 def print_time(total_time) -> None:
@@ -117,7 +103,8 @@ def adjust_time(time_str) -> str:
 
 def get_last_level_from_database() -> int:
     """
-    Get the last level from the database by querying the information schema
+    Get the last level from the database using the schema catalog, which only queries the
+    information schema again after the lattice tables are created or dropped
     :return: The int value of the last level (e.g., 3 from 'Level3')
     """
     # print("\nFetching the last level from the database...")
@@ -125,9 +112,8 @@ def get_last_level_from_database() -> int:
     connection = connect_to_db()
     cursor = connection.cursor()
 
-    # Query the information schema to get all table names
-    cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public';")
-    table_names = [record[0] for record in cursor.fetchall()]
+    # Get all table names from the schema catalog
+    table_names = pipeline_db.schema_catalog.get_table_names(cursor)
 
     # Extract the integer values from table names related to lattice
     lattice_levels = [int(name.replace('level', '')) for name in table_names if name.startswith('level')]
@@ -277,6 +263,17 @@ def automated_lattice_creation() -> int:
     return level - 1
 
 
+def get_column_type(cursor, table_name, column_name) -> str:
+    """
+    Get the data type of a column from the schema catalog
+    :param cursor: Cursor of the Postgres connection
+    :param table_name: Name of the table
+    :param column_name: Name of the column
+    :return: The data type of the column, for example "integer"
+    """
+    return pipeline_db.schema_catalog.get_column_type(cursor, table_name, column_name)
+
+
 def create_tripstops_table() -> None:
     """
     Function to create all the necessary tables in the database
@@ -295,10 +292,13 @@ def create_tripstops_table() -> None:
 
     try:
 
+        # Trip ids loaded with identifier encoding are already integer keys
+        trip_id_type = "INT" if get_column_type(cursor, "stop_times", "trip_id") == "integer" else "VARCHAR"
+
         # Define SQL statements to create each table
 
         create_tripstops_table = ("CREATE TABLE TripStops "
-                                  "(Trip_Id VARCHAR, Stop_Id INT, PRIMARY KEY (Trip_Id, Stop_Id));")
+                                  f"(Trip_Id {trip_id_type}, Stop_Id INT, PRIMARY KEY (Trip_Id, Stop_Id));")
 
         # Execute each SQL statement to create the tables
         cursor.execute(create_tripstops_table)
@@ -391,11 +391,13 @@ def populate_tripstops_table() -> None:
     print("\nTotal rows processed: " + str(success + failed))
     print(f"Successful: {success}, Failed: {failed}\n")
 
-    # Define the SQL statement to alter the column type
-    sql = "ALTER TABLE Stops ALTER COLUMN Stop_Id TYPE INT USING Stop_Id::integer;"
+    # Stop ids loaded with identifier encoding are integer keys already
+    if get_column_type(cur, "stops", "stop_id") != "integer":
+        # Define the SQL statement to alter the column type
+        sql = "ALTER TABLE Stops ALTER COLUMN Stop_Id TYPE INT USING Stop_Id::integer;"
 
-    # Execute the SQL statement
-    cur.execute(sql)
+        # Execute the SQL statement
+        cur.execute(sql)
 
     # Close the database connection
     conn.commit()
@@ -784,6 +786,10 @@ def main() -> None:
     # Make plots for association mining
     # make_plots(association_rules, association_rules_confidence)
 
+    # See how many connections the pool saved and close them
+    pipeline_db.print_connection_stats()
+    pipeline_db.close_all_connections()
+
     print("\n=======================End-of-Code=======================\n")
 
     return None
@@ -0,0 +1,549 @@
+"""
+Filename: pipeline_db.py
+Author: Meet Gandhi, Hrishit Kotadia, Prabhav Karve
+ID: mg1905, hjk5029, pk6004
+
+This code holds the connections and settings shared by all the scripts of the Project.
+The Postgres connections come from one thread-safe pool, so a connection that a function closes
+is handed to the next function instead of logging in again, and the MongoDB client is created once.
+The tables and columns of the database are read with one catalog query and kept until a script
+changes the schema, and statements run many times are prepared once per connection.
+
+Settings are read from pipeline.ini in the same directory as this file, for example:
+
+    [postgres]
+    dbname = Project
+    user = postgres
+    password =
+    host = localhost
+    port =
+
+    [mongodb]
+    connection_url = mongodb://localhost:27017
+    db_name = Project
+    batch_size = 1000
+    max_batch_bytes = 16777216
+
+    [pipeline]
+    time_storage = time
+    encode_identifiers = false
+
+Every setting can also be given with an environment variable named NYBUS_<SECTION>_<KEY>,
+for example NYBUS_POSTGRES_PASSWORD, which takes precedence over the file.
+"""
+import configparser
+import os
+import re
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+try:
+    from pymongo import MongoClient
+except ImportError:
+    MongoClient = None
+
+# Settings file shared by the scripts
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline.ini")
+# Prefix of the environment variables that override the settings file
+ENVIRONMENT_PREFIX = "NYBUS_"
+
+# Settings with their default values, used when neither the file nor the environment sets them
+DEFAULT_SETTINGS = {
+    "postgres": {
+        "dbname": "Project",
+        "user": "postgres",
+        "password": "",
+        "host": "localhost",
+        "port": "",
+    },
+    "mongodb": {
+        "connection_url": "",
+        "db_name": "",
+        # Documents the migration sends to MongoDB in one insert_many, and the most bytes of BSON it buffers
+        "batch_size": "1000",
+        "max_batch_bytes": "16777216",
+    },
+    "pipeline": {
+        # "time" or "seconds", see TIME_STORAGE in Load NY Bus Dataset.py
+        "time_storage": "time",
+        # Store the string identifiers as integer keys, see ENCODE_IDENTIFIERS in Load NY Bus Dataset.py
+        "encode_identifiers": "false",
+        # Number of unused connections the pool keeps open for reuse
+        "max_idle_connections": "8",
+    },
+}
+
+
+def load_settings(filename=CONFIG_FILE) -> dict:
+    """
+    Read the settings from the settings file and the environment
+    :param filename: Name of the settings file, it is fine if it does not exist
+    :return: Dictionary of the settings of each section
+    """
+    parser = configparser.ConfigParser()
+    parser.read(filename)
+
+    settings = {}
+    for section, defaults in DEFAULT_SETTINGS.items():
+        settings[section] = {}
+        for key, default in defaults.items():
+            value = parser.get(section, key, fallback=default)
+            settings[section][key] = os.environ.get(f"{ENVIRONMENT_PREFIX}{section}_{key}".upper(), value)
+
+    return settings
+
+
+SETTINGS = load_settings()
+
+# Identifier columns that are dictionary-encoded with the encode_identifiers setting, and the entity each one
+# refers to. The keys of an entity are in its <entity>_keys lookup table.
+IDENTIFIER_COLUMNS = {
+    "trip_id": "trip",
+    "stop_id": "stop",
+    "origin_stop": "stop",
+    "next_stop": "stop",
+    "route_id": "route",
+    "service_id": "service",
+    "shape_id": "shape",
+    "vehicle_id": "vehicle",
+}
+
+
+def get_boolean_setting(section, key) -> bool:
+    """
+    Read a yes or no setting, accepting the same values as configparser
+    :param section: Section of the setting
+    :param key: Name of the setting
+    :return: The value of the setting
+    """
+    value = SETTINGS[section][key].lower()
+    if value not in configparser.ConfigParser.BOOLEAN_STATES:
+        raise ValueError(f"Setting {key} in [{section}] is not a boolean: {value}")
+
+    return configparser.ConfigParser.BOOLEAN_STATES[value]
+
+
+# Statements that change the tables or columns in the schema catalog, temporary tables are not in it
+DDL_PATTERN = re.compile(r'^\s*(CREATE|DROP|ALTER)\b(?!\s+TEMP)', re.IGNORECASE)
+
+# Every table and view of the current schema, the one the scripts create their tables in, with its columns
+# in order. Tables of other schemas could have the same names. Tables without columns have one row with NULLs.
+CATALOG_QUERY = """
+    SELECT t.table_name, c.column_name, c.data_type
+    FROM information_schema.tables t
+    LEFT JOIN information_schema.columns c ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+    WHERE t.table_schema = current_schema()
+    ORDER BY t.table_name, c.ordinal_position
+"""
+
+
+class SchemaCatalog:
+    """
+    Cache of the tables and columns of the database. It is loaded with one catalog query the first time
+    a script asks for it, and loaded again after DDL run through the pipeline connections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = None
+        self.generation = 0
+        self.loads = 0
+
+    def invalidate(self) -> None:
+        """
+        Forget the cached tables, the next lookup reads the catalog again
+        :return: None
+        """
+        with self.lock:
+            self.tables = None
+            self.generation += 1
+
+        return None
+
+    def load(self, cur) -> dict:
+        """
+        Get the cached tables, reading the catalog if the cache is empty
+        :param cur: Cursor used to read the catalog, so tables created in its transaction are seen
+        :return: Dictionary of the columns of each table, each a dictionary of column name to data type
+        """
+        with self.lock:
+            tables = self.tables
+            generation = self.generation
+
+        if tables is not None:
+            return tables
+
+        cur.execute(CATALOG_QUERY)
+        tables = {}
+        for table_name, column_name, data_type in cur.fetchall():
+            columns = tables.setdefault(table_name, {})
+            if column_name is not None:
+                columns[column_name] = data_type
+
+        with self.lock:
+            # DDL run while the catalog was read makes the result stale, so it is only used this once
+            if generation == self.generation:
+                self.tables = tables
+            self.loads += 1
+
+        return tables
+
+    def get_table_names(self, cur) -> list:
+        """
+        Get the names of the tables and views of the database
+        :param cur: Cursor of the Postgres connection
+        :return: List of the table names
+        """
+        return list(self.load(cur))
+
+    def get_columns(self, cur, table_name) -> tuple:
+        """
+        Get the column names and data types of a table
+        :param cur: Cursor of the Postgres connection
+        :param table_name: Name of the table
+        :return: Tuple of the list of column names and the dictionary of column data types, empty if there is no table
+        """
+        columns = self.load(cur).get(table_name, {})
+
+        return list(columns), dict(columns)
+
+    def get_column_type(self, cur, table_name, column_name):
+        """
+        Get the data type of a column
+        :param cur: Cursor of the Postgres connection
+        :param table_name: Name of the table
+        :param column_name: Name of the column
+        :return: The data type as information_schema reports it, for example "integer", None if there is no column
+        """
+        return self.load(cur).get(table_name, {}).get(column_name)
+
+
+schema_catalog = SchemaCatalog()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that adds every statement it sends to the round-trip and time counters of its connection
+    """
+
+    def execute(self, query, vars=None):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.count(1, time.perf_counter() - start_time)
+            if isinstance(query, str) and DDL_PATTERN.match(query):
+                self.connection.change_schema()
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.connection.count(len(vars_list), time.perf_counter() - start_time)
+
+    def copy_expert(self, sql, file, size=8192):
+        start_time = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.connection.count(1, time.perf_counter() - start_time)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """
+    Postgres connection that keeps count of its round trips and of the time spent on them
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+        self.round_trips = 0
+        self.query_time = 0.0
+        # Statements prepared on this connection, by name
+        self.prepared = {}
+        self.schema_changed = False
+
+    def count(self, round_trips, query_time) -> None:
+        """
+        Add to the counters of the connection
+        :param round_trips: The number of round trips to the server
+        :param query_time: Time taken by them in seconds
+        :return: None
+        """
+        self.round_trips += round_trips
+        self.query_time += query_time
+
+        return None
+
+    def change_schema(self) -> None:
+        """
+        Note DDL run on the connection. The schema catalog is emptied now and again when the
+        transaction ends, since other connections only see the change after the commit.
+        :return: None
+        """
+        self.schema_changed = True
+        schema_catalog.invalidate()
+
+        return None
+
+    def end_transaction(self) -> None:
+        """
+        Empty the schema catalog if the transaction that just ended changed the schema
+        :return: None
+        """
+        if self.schema_changed:
+            self.schema_changed = False
+            schema_catalog.invalidate()
+
+        return None
+
+    def commit(self):
+        start_time = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.count(1, time.perf_counter() - start_time)
+            self.end_transaction()
+
+    def rollback(self):
+        start_time = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            self.count(1, time.perf_counter() - start_time)
+            self.end_transaction()
+
+
+class PooledConnection:
+    """
+    A connection borrowed from the pool. It is used like a psycopg2 connection,
+    but close() hands it back to the pool instead of closing it.
+    """
+
+    def __init__(self, pool, conn):
+        """
+        :param pool: The pool the connection is borrowed from
+        :param conn: The psycopg2 connection
+        """
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self) -> None:
+        """
+        Return the connection to the pool, rolling back anything left uncommitted
+        :return: None
+        """
+        if self._conn is not None:
+            self._pool.put(self._conn)
+            object.__setattr__(self, "_conn", None)
+
+        return None
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of Postgres connections. A connection is only opened when no
+    returned one is waiting, and at most max_idle connections are kept for reuse.
+    A forked process starts with an empty pool, the inherited connections belong to its parent.
+    """
+
+    def __init__(self, settings, max_idle):
+        """
+        :param settings: Dictionary of the psycopg2 connection parameters
+        :param max_idle: Number of unused connections kept open for reuse
+        """
+        self.settings = settings
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget the idle connections and the counters, without closing the connections
+        :return: None
+        """
+        self.pid = os.getpid()
+        self.idle = []
+        self.stats = {"connections opened": 0, "checkouts": 0, "round trips": 0,
+                      "connect time": 0.0, "query time": 0.0}
+
+        return None
+
+    def get(self) -> PooledConnection:
+        """
+        Borrow a connection from the pool, opening a new one if none is waiting
+        :return: The borrowed connection
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+
+            self.stats["checkouts"] += 1
+            conn = self.idle.pop() if self.idle else None
+
+        if conn is None:
+            start_time = time.perf_counter()
+            conn = psycopg2.connect(connection_factory=CountingConnection, **self.settings)
+            with self.lock:
+                self.stats["connections opened"] += 1
+                self.stats["connect time"] += time.perf_counter() - start_time
+
+        return PooledConnection(self, conn)
+
+    def put(self, conn) -> None:
+        """
+        Take a connection back. It is closed if it is broken or the pool already keeps enough connections.
+        :param conn: The psycopg2 connection
+        :return: None
+        """
+        if not conn.closed:
+            try:
+                # The next borrower gets a connection in the default state
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = True
+                conn.cursor().execute("RESET ALL")
+                conn.autocommit = False
+            except psycopg2.Error:
+                conn.close()
+
+        with self.lock:
+            if self.pid != os.getpid():
+                return None
+
+            self.stats["round trips"] += conn.round_trips
+            self.stats["query time"] += conn.query_time
+            conn.round_trips = 0
+            conn.query_time = 0.0
+
+            if not conn.closed and len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                conn = None
+
+        if conn is not None:
+            conn.close()
+
+        return None
+
+    def close_all(self) -> None:
+        """
+        Close the connections waiting in the pool
+        :return: None
+        """
+        with self.lock:
+            idle = self.idle if self.pid == os.getpid() else []
+            self.idle = []
+
+        for conn in idle:
+            conn.close()
+
+        return None
+
+
+connection_pool = ConnectionPool(SETTINGS["postgres"], int(SETTINGS["pipeline"]["max_idle_connections"]))
+mongo_client = None
+mongo_client_lock = threading.Lock()
+
+
+def connect_to_db() -> PooledConnection:
+    """
+    Connect to the Postgres Database using the shared settings, reusing a pooled connection when there is one
+    :return: connection to the Postgres Database, close() returns it to the pool
+    """
+    return connection_pool.get()
+
+
+def execute_prepared(cur, name, statement, parameter_types, values) -> None:
+    """
+    Run a statement as a server-side prepared statement. It is prepared the first time the connection
+    runs it and kept with the connection in the pool, so later runs skip parsing and planning.
+    :param cur: Cursor of the Postgres connection
+    :param name: Name of the prepared statement
+    :param statement: The statement, with $1, $2, ... for the parameters
+    :param parameter_types: List of the data types of the parameters
+    :param values: List of the values of the parameters
+    :return: None
+    """
+    prepared = cur.connection.prepared
+
+    if prepared.get(name) != statement:
+        # The same name with another statement, for example after the columns of the table changed
+        if name in prepared:
+            cur.execute(f"DEALLOCATE {name}")
+            del prepared[name]
+        cur.execute(f"PREPARE {name} ({', '.join(parameter_types)}) AS {statement}")
+        prepared[name] = statement
+
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+
+    return None
+
+
+def get_mongo_client():
+    """
+    Get the MongoDB client shared by every function, creating it on first use
+    :return: The MongoDB client
+    """
+    global mongo_client
+
+    with mongo_client_lock:
+        if mongo_client is None:
+            if MongoClient is None:
+                raise ImportError("pymongo is needed for the MongoDB connection")
+            mongo_client = MongoClient(SETTINGS["mongodb"]["connection_url"])
+
+    return mongo_client
+
+
+def get_mongo_database():
+    """
+    Get the MongoDB database of the Project
+    :return: The MongoDB database
+    """
+    return get_mongo_client()[SETTINGS["mongodb"]["db_name"]]
+
+
+def print_connection_stats() -> None:
+    """
+    Print how many connections were opened and reused, and the round trips and time spent on them
+    :return: None
+    """
+    stats = connection_pool.stats
+
+    print("\n======================================================\n")
+    print(f"Postgres connections opened: {stats['connections opened']} "
+          f"for {stats['checkouts']} uses, taking {stats['connect time']:.2f} seconds")
+    print(f"Round trips on returned connections: {stats['round trips']}, "
+          f"taking {stats['query time']:.2f} seconds")
+    print(f"Schema catalog reads: {schema_catalog.loads}")
+
+    return None
+
+
+def close_all_connections() -> None:
+    """
+    Close the pooled Postgres connections and the MongoDB client at the end of a script
+    :return: None
+    """
+    global mongo_client
+
+    connection_pool.close_all()
+
+    with mongo_client_lock:
+        if mongo_client is not None:
+            mongo_client.close()
+            mongo_client = None
+
+    return None